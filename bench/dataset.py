@@ -0,0 +1,116 @@
+"""
+Синтетические базы support_db.json для бенчмарков.
+
+generate_data(users, ...) возвращает словарь в формате SupportDB: пользователи с username и счётчиком
+обращений, обращения и жалобы (часть открыта, у части открытых обращений есть агент), баны с причинами,
+агенты и логи рассылок. Из командной строки пишет файл так же, как его пишет SupportDB:
+
+    python bench/dataset.py --users 100000 -o support_db.json
+    python bench/dataset.py --users 1000000 --tickets 50000 --complaints 500 --bans 20000 -o big.json
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# Агенты получают id вне диапазона пользователей
+AGENT_ID_BASE = 9_000_000_000
+USER_ID_BASE = 100_000_000
+BAN_REASONS = ("спам", "оскорбления", "флуд", "мошенничество", "51", "реклама")
+MESSAGES = ("Технические работы сегодня с 02:00 до 04:00.", "Обновили правила поддержки, прочитайте закреп.",
+            "Поддержка работает в праздники в обычном режиме.")
+
+
+def generate_data(users, tickets=None, complaints=None, bans=None, broadcast_logs=50, agents=10,
+                  open_ratio=0.2, taken_ratio=0.5, seed=0):
+    """База на users пользователей; tickets, complaints и bans по умолчанию 30 %, 1 % и 0.5 % от них"""
+    rng = random.Random(seed)
+    tickets = round(users * 0.3) if tickets is None else min(tickets, users)
+    complaints = round(users * 0.01) if complaints is None else min(complaints, users)
+    bans = round(users * 0.005) if bans is None else min(bans, users)
+    data = {"tickets": {}, "active_chats": {}, "banned": [], "agents": {}, "ban_reasons": {},
+            "user_metadata": {}, "complaints": {}}
+
+    for num in range(1, agents + 1):
+        data["agents"][str(AGENT_ID_BASE + num)] = {"num": num, "replies": rng.randint(0, 5000),
+                                                    "bans": rng.randint(0, 50)}
+
+    uids = []
+    for n in range(users):
+        uid = str(USER_ID_BASE + n * 7 + rng.randint(0, 6))
+        uids.append(uid)
+        # Примерно у пятой части пользователей нет username
+        username = f"user{n}_{rng.randint(0, 9999)}" if rng.random() > 0.2 else None
+        data["user_metadata"][uid] = {"username": username, "ticket_count": 0}
+
+    thread_id = 1
+    for kind, count in (("tickets", tickets), ("complaints", complaints)):
+        for uid in rng.sample(uids, count):
+            is_open = rng.random() < open_ratio
+            data[kind][uid] = {"thread_id": thread_id, "status": "open" if is_open else "closed",
+                               "admin_msg_id": thread_id + 1}
+            thread_id += 2
+            if kind == "tickets":
+                data["user_metadata"][uid]["ticket_count"] = rng.randint(1, 5)
+                if is_open and rng.random() < taken_ratio:
+                    data["active_chats"][uid] = {"agent_num": rng.randint(1, agents)}
+
+    for uid in rng.sample(uids, bans):
+        data["banned"].append(int(uid))
+        data["ban_reasons"][uid] = {"reason": rng.choice(BAN_REASONS), "agent_num": rng.randint(1, agents)}
+
+    if broadcast_logs:
+        started = datetime(2025, 1, 1)
+        data["broadcast_logs"] = []
+        for n in range(broadcast_logs):
+            failed = rng.randint(0, users // 20)
+            data["broadcast_logs"].append({
+                "timestamp": (started + timedelta(days=n)).strftime("%d.%m.%Y %H:%M:%S"),
+                "sender_id": "1",
+                "sender_username": "owner",
+                "total_users": users,
+                "success": users - failed,
+                "failed": failed,
+                "message": rng.choice(MESSAGES)
+            })
+    return data
+
+
+def open_tickets(data):
+    """[(uid, thread_id, admin_msg_id)] открытых обращений"""
+    return [(uid, ticket["thread_id"], ticket["admin_msg_id"])
+            for uid, ticket in data["tickets"].items() if ticket["status"] == "open"]
+
+
+def write_db(data, path):
+    """Пишет базу тем же форматом, что SupportDB без журнала"""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, required=True)
+    parser.add_argument("--tickets", type=int, help="пользователей с обращениями (по умолчанию 30 %%)")
+    parser.add_argument("--complaints", type=int, help="пользователей с жалобами (по умолчанию 1 %%)")
+    parser.add_argument("--bans", type=int, help="заблокированных (по умолчанию 0.5 %%)")
+    parser.add_argument("--broadcast-logs", type=int, default=50)
+    parser.add_argument("--agents", type=int, default=10)
+    parser.add_argument("--open-ratio", type=float, default=0.2, help="доля открытых обращений и жалоб")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="support_db.json")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    data = generate_data(args.users, args.tickets, args.complaints, args.bans, args.broadcast_logs, args.agents,
+                         args.open_ratio, seed=args.seed)
+    write_db(data, args.output)
+    print(f"{args.output}: {len(data['user_metadata'])} users, {len(data['tickets'])} tickets, "
+          f"{len(data['complaints'])} complaints, {len(data['banned'])} bans, "
+          f"{os.path.getsize(args.output) / 1024 / 1024:.1f} MB in {time.perf_counter() - started:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
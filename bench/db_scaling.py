@@ -0,0 +1,224 @@
+"""
+Масштабирование хранилища: время загрузки и записи, пиковая память и размер файла по размерам базы.
+
+Для каждого размера bench/dataset.py генерирует support_db.json (для --backend sqlite он переносится в SQLite
+через migrate_json_to_sqlite), затем отдельный процесс (чтобы пик RSS относился только к этой базе) гоняет
+хранилище только через его публичный API. Каждая фаза замеряется напрямую в одном и том же повторе:
+json.load файла (для json), открытие базы, save() без флашера, одно изменение при запущенном флашере,
+flush() этого изменения и самая долгая пауза event loop во время flush().
+
+    python bench/db_scaling.py --sizes 1000,10000,100000,1000000 --json before.json
+    python bench/db_scaling.py --sizes 1000,10000,100000,1000000 --compare before.json
+    python bench/db_scaling.py --sizes 1000,100000 --backend sqlite --compare before.json
+
+--support подставляет другой support.py, например прошлой версии (git show <commit>:support.py > old/support.py).
+"""
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SUPPORT_PY = os.path.join(BENCH_DIR, os.pardir, "support.py")
+# Флашер запущен, но сам не срабатывает: на диск пишет только flush() замера
+FLUSH_INTERVAL_MS = 3600 * 1000
+
+COLUMNS = (
+    # ключ, заголовок, ширина, формат
+    ("users", "users", 9, "{:d}"),
+    ("file_mb", "file MB", 8, "{:.1f}"),
+    ("parse_s", "parse s", 8, "{:.3f}"),
+    ("load_s", "load s", 8, "{:.3f}"),
+    ("save_s", "save s", 8, "{:.3f}"),
+    ("change_ms", "change ms", 9, "{:.3f}"),
+    ("flush_s", "flush s", 8, "{:.3f}"),
+    ("stall_ms", "loop ms", 8, "{:.1f}"),
+    ("rss_base_mb", "base MB", 8, "{:.0f}"),
+    ("rss_load_mb", "+load MB", 9, "{:.0f}"),
+    ("rss_save_mb", "+save MB", 9, "{:.0f}"),
+)
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def open_store(support, backend, path):
+    if backend == "sqlite":
+        return support.SQLiteSupportDB(path)
+    if "flush_interval_ms" in inspect.signature(support.SupportDB).parameters:
+        return support.SupportDB(path, flush_interval_ms=FLUSH_INTERVAL_MS, max_pending=10 ** 9)
+    # Версия без отложенной записи: каждое изменение пишет базу сразу
+    return support.SupportDB(path)
+
+
+async def watch_loop(gaps, tick=0.001):
+    """Промежутки между пробуждениями корутины: самый долгий — столько event loop не отвечал"""
+    last = time.perf_counter()
+    while True:
+        await asyncio.sleep(tick)
+        now = time.perf_counter()
+        gaps.append(now - last)
+        last = now
+
+
+async def measure_flush(db, uid):
+    """Изменение и его flush() при запущенном флашере; None там, где у версии хранилища нет флашера"""
+    started = time.perf_counter()
+    db.increment_ticket(uid)
+    change = time.perf_counter() - started
+    if not hasattr(db, "flush"):
+        return change, None, None
+    gaps = []
+    watcher = asyncio.create_task(watch_loop(gaps))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await db.flush()
+    flush = time.perf_counter() - started
+    watcher.cancel()
+    return change, flush, max(gaps, default=0.0)
+
+
+async def measure_async(db, uid):
+    if hasattr(db, "start"):
+        db.start()
+    try:
+        return await measure_flush(db, uid)
+    finally:
+        if hasattr(db, "close"):
+            await db.close()
+
+
+def measure(path, backend, repeat, support_py):
+    """Работает в отдельном процессе: замеры одной базы, результат — JSON в stdout"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(support_py)))
+    import support
+
+    base = peak_rss_mb()
+    best = {}
+
+    def keep(key, value):
+        if value is not None:
+            best[key] = min(best.get(key, value), value)
+
+    after_load = None
+    for _ in range(repeat):
+        if backend == "json":
+            started = time.perf_counter()
+            with open(path, "r", encoding="utf-8") as f:
+                json.load(f)
+            keep("parse_s", time.perf_counter() - started)
+        db = None
+        started = time.perf_counter()
+        db = open_store(support, backend, path)
+        keep("load_s", time.perf_counter() - started)
+        if after_load is None:
+            after_load = peak_rss_mb()
+        uid = db.get_all_user_ids()[0]
+        users = len(db.get_all_user_ids())
+        # Флашер ещё не запущен: save() пишет базу сразу, как при DB_FLUSH_INTERVAL_MS=0
+        started = time.perf_counter()
+        db.save()
+        keep("save_s", time.perf_counter() - started)
+        change, flush, stall = asyncio.run(measure_async(db, uid))
+        keep("change_ms", change * 1000)
+        keep("flush_s", flush)
+        keep("stall_ms", None if stall is None else stall * 1000)
+    after_save = peak_rss_mb()
+
+    # Фаз, которых у бэкенда или версии хранилища нет, в строке нет: в таблице они «-»
+    return dict(best, **{
+        "users": users,
+        "file_mb": os.path.getsize(path) / 1024 / 1024,
+        "rss_base_mb": base,
+        "rss_load_mb": after_load - base,
+        "rss_save_mb": after_save - after_load,
+    })
+
+
+def run_size(users, args, workdir):
+    # Генерация тоже в отдельном процессе: ru_maxrss наследуется дочерним, и пик генератора испортил бы замер
+    path = os.path.join(workdir, f"support_db_{users}.json")
+    subprocess.run([sys.executable, os.path.join(BENCH_DIR, "dataset.py"), "--users", str(users),
+                    "--seed", str(args.seed), "-o", path], stdout=sys.stderr, check=True)
+
+    # support.py открывает базу по умолчанию в рабочем каталоге при импорте: даём ему пустой
+    empty = tempfile.mkdtemp(dir=workdir)
+    env = dict(os.environ, SUPPORT_BOT_TOKEN="123456:bench", SUPPORT_CHAT_ID="-1001234567890", OWNER_ID="1",
+               SUPPORT_EVENTS_FILE="", SUPPORT_DB_BACKEND="json", DB_JOURNAL="0")
+    if args.backend == "sqlite":
+        json_path, path = path, os.path.join(workdir, f"support_db_{users}.sqlite3")
+        migrate = (f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(SUPPORT_PY))!r}); "
+                   f"import support; support.migrate_json_to_sqlite({json_path!r}, {path!r})")
+        subprocess.run([sys.executable, "-c", migrate], cwd=empty, env=env, stdout=sys.stderr, check=True)
+        os.remove(json_path)
+    worker = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", path, "--backend", args.backend,
+                             "--repeat", str(args.repeat), "--support", args.support],
+                            cwd=empty, env=env, capture_output=True, text=True)
+    for leftover in (path, f"{path}-wal", f"{path}-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    if worker.returncode:
+        raise RuntimeError(f"Measuring {users} users failed:\n{worker.stderr}")
+    return json.loads(worker.stdout.strip().splitlines()[-1])
+
+
+def print_table(rows, baseline=None):
+    print(" ".join(f"{title:>{width}}" for _, title, width, _ in COLUMNS))
+    for row in rows:
+        print(" ".join(f"{'-' if row.get(key) is None else fmt.format(row[key]):>{width}}"
+                       for key, _, width, fmt in COLUMNS))
+        before = (baseline or {}).get(row["users"])
+        if before:
+            # Отношение к прошлому прогону: < 1 — стало лучше
+            cells = [f"{'vs base':>{COLUMNS[0][2]}}"]
+            for key, _, width, _ in COLUMNS[1:]:
+                ratio = f"×{row[key] / before[key]:.2f}" if before.get(key) and row.get(key) is not None else "-"
+                cells.append(f"{ratio:>{width}}")
+            print(" ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="пользователей через запятую")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json", help="SupportDB или SQLiteSupportDB")
+    parser.add_argument("--support", default=SUPPORT_PY, help="какой support.py замерять")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов замера, по каждой фазе берётся лучший")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="сохранить результаты")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.backend, args.repeat, args.support)))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = {row["users"]: row for row in json.load(f)["results"]}
+
+    rows = []
+    with tempfile.TemporaryDirectory(prefix="support-db-scaling-") as workdir:
+        for users in (int(size) for size in args.sizes.split(",")):
+            rows.append(run_size(users, args, workdir))
+    print(f"Python {sys.version.split()[0]}, {args.backend}, best of {args.repeat}; RSS columns: baseline "
+          f"after import, peak growth during load and during save")
+    print_table(rows, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "backend": args.backend, "repeat": args.repeat,
+                       "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""
+Офлайн-бенчмарк хендлеров support.py на поддельном Bot API.
+
+Бот работает в процессе как обычно (Application, KeyedUpdateProcessor, SupportRateLimiter, LogSink, флашер базы),
+но HTTP-запросы к Bot API отвечает FakeBotAPI с заданной задержкой и долей ошибок. На синтетических базах
+разного размера прогоняются сценарии: новые обращения, ответы агентов в темах, кнопки взять/закрыть/бан
+и рассылка. Для каждого — пропускная способность, p50/p99 времени действия и запросов к API на действие.
+
+Рассылка идёт через broadcast_job, как в боте: порции по BROADCAST_CHUNK с сохранением курсора и темп
+BROADCAST_RATE, поэтому её пропускная способность упирается в настройки, а не в код. Лимиты
+SupportRateLimiter по умолчанию сняты, чтобы мерить хендлеры; --real-limits включает настроенные RATE_LIMIT_*.
+
+    python bench/offline_bench.py --sizes 1000,100000,1000000 --actions 500 --latency 0.05
+    python bench/offline_bench.py --sizes 1000 --scenarios reply,take --json before.json
+
+В Telegram ничего не уходит; файлы базы пишутся во временный каталог.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SUPPORT_CHAT_ID = -1001234567890
+OWNER_ID = 1
+
+# support.py читает настройки и открывает базу при импорте: подменяем окружение и рабочий каталог заранее
+INVOKED_FROM = os.getcwd()
+WORKDIR = tempfile.mkdtemp(prefix="support-bench-")
+os.chdir(WORKDIR)
+os.environ.update(SUPPORT_BOT_TOKEN="123456:bench", SUPPORT_CHAT_ID=str(SUPPORT_CHAT_ID), OWNER_ID=str(OWNER_ID),
+                  SUPPORT_EVENTS_FILE="", SUPPORT_DB_BACKEND="json")
+sys.path[:0] = [os.path.join(BENCH_DIR, os.pardir), BENCH_DIR]
+
+import logging  # noqa: E402
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, CallbackContext, ExtBot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import support  # noqa: E402
+from dataset import generate_data, open_tickets, write_db  # noqa: E402
+
+SCENARIOS = ("ticket", "reply", "take", "ban", "close", "broadcast")
+NEW_USER_ID_BASE = 5_000_000_000
+
+
+class FakeBotAPI(BaseRequest):
+    """Bot API в памяти: отвечает правдоподобными объектами, с задержкой latency + random() * jitter секунд"""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = Counter()
+        self.errors = Counter()
+        self.next_id = 10_000_000
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def message(self, params):
+        chat_id = int(params.get("chat_id", SUPPORT_CHAT_ID))
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        return {"message_id": self.new_id(), "date": int(time.time()), "chat": chat, "text": params.get("text", "")}
+
+    def result(self, method, params):
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup"):
+            return self.message(params)
+        if method == "copyMessage":
+            return {"message_id": self.new_id()}
+        if method == "copyMessages":
+            return [{"message_id": self.new_id()} for _ in params.get("message_ids", ())]
+        if method == "createForumTopic":
+            return {"message_thread_id": self.new_id(), "name": params.get("name", ""), "icon_color": 7322096}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.rng.random() * self.jitter)
+        if self.error_rate and endpoint != "getMe" and self.rng.random() < self.error_rate:
+            self.errors[endpoint] += 1
+            return 502, b'{"ok": false, "error_code": 502, "description": "Bad Gateway"}'
+        return 200, json.dumps({"ok": True, "result": self.result(endpoint, params)}).encode()
+
+
+class UpdateFactory:
+    """Синтетические апдейты в формате Bot API"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.update_id = 0
+
+    def _update(self, **payload):
+        self.update_id += 1
+        return Update.de_json({"update_id": self.update_id, **payload}, self.bot)
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user{uid}", "username": f"user{uid}"}
+
+    def _support_message(self, agent_id, text, thread_id=None, message_id=None):
+        message = {"message_id": message_id or self.update_id, "date": int(time.time()), "text": text,
+                   "chat": {"id": SUPPORT_CHAT_ID, "type": "supergroup", "title": "Support", "is_forum": True},
+                   "from": self._user(agent_id)}
+        if thread_id:
+            message.update(message_thread_id=thread_id, is_topic_message=True)
+        return message
+
+    def private_message(self, uid, text):
+        return self._update(message={"message_id": self.update_id + 1, "date": int(time.time()), "text": text,
+                                     "chat": {"id": uid, "type": "private", "first_name": f"user{uid}"},
+                                     "from": self._user(uid)})
+
+    def support_message(self, agent_id, text, thread_id=None):
+        return self._update(message=self._support_message(agent_id, text, thread_id, self.update_id + 1))
+
+    def click(self, agent_id, data, thread_id, message_id):
+        return self._update(callback_query={"id": str(self.update_id + 1), "from": self._user(agent_id),
+                                            "chat_instance": "bench", "data": data,
+                                            "message": self._support_message(agent_id, "🆕", thread_id, message_id)})
+
+
+def make_actions(scenario, factory, data, count, rng):
+    """Действия сценария: каждое — список апдейтов, которые шлёт один человек подряд"""
+    agents = [int(uid) for uid in data["agents"]] or [OWNER_ID]
+    tickets = open_tickets(data) or [(uid, None, None) for uid in list(data["user_metadata"])[:1]]
+    users = list(data["user_metadata"])
+    actions = []
+    for n in range(count):
+        agent = rng.choice(agents)
+        uid, thread_id, admin_msg_id = tickets[n % len(tickets)]
+        if scenario == "ticket":
+            actions.append([factory.private_message(NEW_USER_ID_BASE + factory.update_id, "Здравствуйте, помогите")])
+        elif scenario == "reply":
+            actions.append([factory.support_message(agent, "Ответ агента", thread_id)])
+        elif scenario in ("take", "close"):
+            args = ("tk", support.b36(int(uid))) if scenario == "take" else ("cl", support.b36(int(uid)), "0")
+            actions.append([factory.click(agent, support.pack_callback(*args), thread_id, admin_msg_id)])
+        elif scenario == "ban":
+            target = int(rng.choice(users))
+            actions.append([factory.click(agent, support.pack_callback("bn", support.b36(target)), thread_id,
+                                          admin_msg_id),
+                            factory.support_message(agent, "спам")])
+    return actions
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def drain(app):
+    """Дожидается логов и альбомов, которые хендлеры отдали в фон"""
+    await support.media_groups.close()
+    await support.log_sink.close()
+    support.log_sink.start(app.bot)
+
+
+async def run_actions(app, actions, concurrency):
+    latencies = []
+    pending = iter(actions)
+
+    async def worker():
+        for action in pending:
+            started = time.perf_counter()
+            for update in action:
+                await app.update_processor.process_update(update, app.process_update(update))
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run_broadcast(app, data, count):
+    """Рассылка на count последних по user_id пользователей через задачу broadcast_job"""
+    recipients = sorted(int(uid) for uid in data["user_metadata"])
+    count = min(count, len(recipients))
+    # Курсор перед последними count получателями: задача продолжает с него, как после перезапуска бота
+    cursor = recipients[-count - 1] if count < len(recipients) else None
+    support.db.save_broadcast_job({
+        "state": "running", "text": "📣 <b>Бенчмарк</b>", "message": "Бенчмарк", "sender_username": "owner",
+        "total": count, "cursor": cursor, "success": 0, "failed": 0, "errors": {},
+        "chat_id": OWNER_ID, "message_id": 1
+    })
+    await support.broadcast_job(CallbackContext(app))
+    if support.db.get_broadcast_job():
+        raise RuntimeError("broadcast_job did not finish the broadcast")
+    return count
+
+
+def db_saves():
+    count = total = 0.0
+    for _, histogram in support.metrics.series("support_db_save_seconds"):
+        count += histogram.count
+        total += histogram.sum
+    return count, total
+
+
+async def bench_size(users, args):
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    data = generate_data(users, seed=args.seed)
+    path = os.path.join(WORKDIR, f"support_db_{users}.json")
+    write_db(data, path)
+    support.db = support.SupportDB(path, support.DB_FLUSH_INTERVAL_MS, support.DB_FLUSH_MAX_PENDING)
+    print(f"\n== {users} users, {len(open_tickets(data))} open tickets "
+          f"(generated and loaded in {time.perf_counter() - started:.1f} s)")
+    print_header()
+
+    api = FakeBotAPI(args.latency, args.jitter, args.error_rate, args.seed)
+    if args.real_limits:
+        limiter = support.SupportRateLimiter(support.RATE_LIMIT_GLOBAL, support.RATE_LIMIT_PRIVATE,
+                                             support.RATE_LIMIT_GROUP_PER_MINUTE, support.RATE_LIMIT_MAX_RETRIES,
+                                             support.RATE_LIMIT_SUPPORT_CHAT)
+    else:
+        limiter = support.SupportRateLimiter(1e9, 1e9, 1e9, support.RATE_LIMIT_MAX_RETRIES)
+    bot = ExtBot(support.TOKEN, request=api, get_updates_request=FakeBotAPI(), rate_limiter=limiter)
+    app = Application.builder().bot(bot).concurrent_updates(support.KeyedUpdateProcessor(args.concurrency)).build()
+    support.add_handlers(app)
+    factory = UpdateFactory(bot)
+
+    await app.initialize()
+    await support.on_startup(app)
+    await app.start()
+    rows = []
+    try:
+        for scenario in args.scenarios:
+            calls_before = sum(api.calls.values())
+            saves_before = db_saves()
+            started = time.perf_counter()
+            if scenario == "broadcast":
+                actions = await run_broadcast(app, data, args.broadcast)
+                latencies = []
+            else:
+                batch = make_actions(scenario, factory, data, args.actions, rng)
+                latencies = await run_actions(app, batch, args.concurrency)
+                actions = len(batch)
+            elapsed = time.perf_counter() - started
+            await drain(app)
+            saves = [after - before for after, before in zip(db_saves(), saves_before)]
+            rows.append({
+                "users": users, "scenario": scenario, "actions": actions,
+                "throughput": actions / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(latencies, 0.5) * 1000, "p99_ms": percentile(latencies, 0.99) * 1000,
+                "api_calls_per_action": (sum(api.calls.values()) - calls_before) / max(actions, 1),
+                "db_saves": int(saves[0]), "db_save_ms": saves[1] / saves[0] * 1000 if saves[0] else 0.0,
+            })
+            print_row(rows[-1])
+    finally:
+        await app.stop()
+        await support.on_stop(app)
+        await app.shutdown()
+        await support.on_shutdown(app)
+    if args.verbose:
+        print("Bot API calls:", ", ".join(f"{method} {count}" for method, count in api.calls.most_common()))
+        if api.errors:
+            print("Injected errors:", ", ".join(f"{method} {count}" for method, count in api.errors.most_common()))
+    return rows
+
+
+async def run_all(sizes, args):
+    rows = []
+    for size in sizes:
+        rows += await bench_size(size, args)
+    return rows
+
+
+def print_header():
+    print(f"{'scenario':<10} {'actions':>8} {'actions/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'API/action':>10} "
+          f"{'DB saves':>9} {'save ms':>8}")
+
+
+def print_row(row):
+    latency = (f"{row['p50_ms']:>8.1f} {row['p99_ms']:>8.1f}" if row["scenario"] != "broadcast"
+               else f"{'-':>8} {'-':>8}")
+    print(f"{row['scenario']:<10} {row['actions']:>8} {row['throughput']:>10.1f} {latency} "
+          f"{row['api_calls_per_action']:>10.2f} {row['db_saves']:>9} {row['db_save_ms']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,100000,1000000", help="размеры баз, пользователей через запятую")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"из {', '.join(SCENARIOS)}")
+    parser.add_argument("--actions", type=int, default=500, help="действий на сценарий")
+    parser.add_argument("--broadcast", type=int, default=500,
+                        help="получателей рассылки (темп задаёт BROADCAST_RATE из окружения)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка Bot API, секунд")
+    parser.add_argument("--jitter", type=float, default=0.02, help="случайная добавка к задержке, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов, отвечающих 502")
+    parser.add_argument("--real-limits", action="store_true", help="настроенные RATE_LIMIT_* вместо снятых лимитов")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="сохранить результаты для сравнения прогонов")
+    parser.add_argument("--verbose", action="store_true", help="запросы к API по методам и лог бота")
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    print(f"Fake Bot API latency {args.latency * 1000:.0f}+{args.jitter * 1000:.0f} ms, "
+          f"errors {args.error_rate:.1%}, concurrency {args.concurrency}, workdir {WORKDIR}")
+    # Один event loop на все размеры: очереди и замки support.py привязываются к нему
+    rows = asyncio.run(run_all([int(size) for size in args.sizes.split(",")], args))
+    if args.json:
+        with open(os.path.join(INVOKED_FROM, args.json), "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
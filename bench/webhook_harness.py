@@ -0,0 +1,224 @@
+"""
+Локальный стенд для webhook-режима support.py.
+
+Поднимает заглушку Bot API, запускает бота с SUPPORT_WEBHOOK_URL и SUPPORT_BOT_API_URL на неё
+и шлёт в webhook синтетические Update (личные сообщения пользователей). Задержка считается от POST
+до момента, когда бот переслал это сообщение в тему (copyMessage в заглушке).
+
+    python bench/webhook_harness.py --updates 1000 --users 100 --concurrency 50
+
+Нужен python-telegram-bot[webhooks]; в Telegram ничего не уходит.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import httpx
+
+SUPPORT_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "support.py")
+TOKEN = "123456:stub"
+SUPPORT_CHAT_ID = -1001234567890
+SECRET = "harness-secret"
+
+
+class StubBotAPI(ThreadingHTTPServer):
+    """Заглушка Bot API: на всё отвечает ok и запоминает, когда какое сообщение переслано"""
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, port):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.relayed = {}  # (from_chat_id, message_id) -> time.perf_counter()
+        self.webhook_set = threading.Event()
+        self.next_id = 1000
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего Bot API
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or "{}")
+        return {key: values[0] for key, values in parse_qs(body).items()}
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        params = self._params()
+        server = self.server
+        with server.lock:
+            server.calls[method] += 1
+        chat = {"id": int(params.get("chat_id", SUPPORT_CHAT_ID)), "type": "supergroup", "title": "stub"}
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}
+        elif method == "setWebhook":
+            server.webhook_set.set()
+            result = True
+        elif method == "createForumTopic":
+            result = {"message_thread_id": server.new_id(), "name": params.get("name", ""), "icon_color": 7322096}
+        elif method == "sendMessage":
+            result = {"message_id": server.new_id(), "date": int(time.time()), "chat": chat, "text": ""}
+        elif method in ("copyMessage", "copyMessages"):
+            ids = json.loads(params["message_ids"]) if method == "copyMessages" else [params["message_id"]]
+            now = time.perf_counter()
+            with server.lock:
+                for message_id in ids:
+                    server.relayed[(int(params["from_chat_id"]), int(message_id))] = now
+            result = {"message_id": server.new_id()} if method == "copyMessage" \
+                else [{"message_id": server.new_id()} for _ in ids]
+        else:
+            result = True
+
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"},
+            "text": f"Сообщение {update_id}"
+        }
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                # Без секрета webhook отвечает 403 — значит, сервер уже слушает
+                await client.post(url, content=b"{}")
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("Webhook server did not start")
+
+
+async def post_updates(url, count, users, concurrency):
+    posted = {}
+    post_latency = []
+    queue = asyncio.Queue()
+    for n in range(count):
+        queue.put_nowait(n + 1)
+
+    async def worker(client):
+        while not queue.empty():
+            update_id = queue.get_nowait()
+            user_id = 10_000 + update_id % users
+            started = time.perf_counter()
+            posted[(user_id, update_id)] = started
+            response = await client.post(url, json=make_update(update_id, user_id),
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            response.raise_for_status()
+            post_latency.append(time.perf_counter() - started)
+
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return posted, post_latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8081, help="порт webhook бота")
+    parser.add_argument("--stub-port", type=int, default=8082, help="порт заглушки Bot API")
+    parser.add_argument("--timeout", type=float, default=60, help="секунд ждать пересылки всех сообщений")
+    args = parser.parse_args()
+
+    stub = StubBotAPI(args.stub_port)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    workdir = tempfile.mkdtemp(prefix="support-harness-")
+    env = dict(
+        os.environ,
+        SUPPORT_BOT_TOKEN=TOKEN,
+        SUPPORT_CHAT_ID=str(SUPPORT_CHAT_ID),
+        OWNER_ID="1",
+        SUPPORT_BOT_API_URL=f"http://127.0.0.1:{args.stub_port}",
+        SUPPORT_WEBHOOK_URL=f"http://127.0.0.1:{args.port}",
+        SUPPORT_WEBHOOK_LISTEN="127.0.0.1",
+        SUPPORT_WEBHOOK_PORT=str(args.port),
+        SUPPORT_WEBHOOK_SECRET=SECRET,
+        LOG_BATCH_WINDOW="0.5",
+        # У заглушки нет flood control: ограничитель не должен подмешивать лимиты Telegram в замер
+        RATE_LIMIT_GLOBAL="100000",
+        RATE_LIMIT_PRIVATE="100000",
+        RATE_LIMIT_GROUP_PER_MINUTE="6000000",
+        RATE_LIMIT_SUPPORT_CHAT="100000",
+    )
+    bot = subprocess.Popen([sys.executable, os.path.abspath(SUPPORT_PY)], cwd=workdir, env=env,
+                           stdout=subprocess.DEVNULL, stderr=open(os.path.join(workdir, "bot.log"), "w"))
+    url = f"http://127.0.0.1:{args.port}/{env.get('SUPPORT_WEBHOOK_PATH', 'telegram')}"
+    try:
+        if not stub.webhook_set.wait(30):
+            raise RuntimeError(f"Bot did not call setWebhook, see {workdir}/bot.log")
+        asyncio.run(wait_ready(url))
+
+        started = time.perf_counter()
+        posted, post_latency = asyncio.run(post_updates(url, args.updates, args.users, args.concurrency))
+        deadline = time.monotonic() + args.timeout
+        while len(stub.relayed) < len(posted) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        elapsed = max(stub.relayed.values(), default=started) - started
+
+        latency = [stub.relayed[key] - t for key, t in posted.items() if key in stub.relayed]
+        print(f"Updates: {len(posted)}, relayed: {len(latency)}, users: {args.users}, concurrency: {args.concurrency}")
+        print(f"Throughput: {len(latency) / elapsed:.1f} updates/s" if elapsed > 0 else "Throughput: n/a")
+        print(f"Webhook POST: p50 {percentile(post_latency, 0.5) * 1000:.1f} ms, "
+              f"p95 {percentile(post_latency, 0.95) * 1000:.1f} ms")
+        print(f"End-to-end:   p50 {percentile(latency, 0.5) * 1000:.1f} ms, "
+              f"p95 {percentile(latency, 0.95) * 1000:.1f} ms, max {max(latency, default=0) * 1000:.1f} ms, "
+              f"mean {statistics.fmean(latency) * 1000 if latency else 0:.1f} ms")
+        print("Bot API calls:", ", ".join(f"{method} {count}" for method, count in stub.calls.most_common()))
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        stub.shutdown()
+        print(f"Bot log and database: {workdir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,929 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import copy
+import functools
+import gzip
+import heapq
+import html
+import importlib.util
 import logging
 import json
 import os
-from datetime import datetime
+import re
+import shutil
+import sqlite3
+import string
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from telegram.constants import ChatType
+from telegram.ext import (Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler,
+                          CallbackQueryHandler, ContextTypes, filters)
+from telegram.constants import ChatType, InlineKeyboardButtonLimit, MessageLimit
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 
 # Загрузка конфигурации
 load_dotenv()
 TOKEN = os.getenv("SUPPORT_BOT_TOKEN")
+DB_BACKEND = os.getenv("SUPPORT_DB_BACKEND", "json")  # json или sqlite
 SUPPORT_CHAT_ID = int(os.getenv("SUPPORT_CHAT_ID"))
 OWNER_ID = int(os.getenv("OWNER_ID"))
 DB_FILE = "support_db.json"
+DB_SQLITE_FILE = os.getenv("SUPPORT_DB_SQLITE_FILE", "support_db.sqlite3")
+# Отложенная запись БД: не чаще раза в DB_FLUSH_INTERVAL_MS или сразу после DB_FLUSH_MAX_PENDING изменений.
+# DB_FLUSH_INTERVAL_MS=0 возвращает синхронную запись при каждом save()
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "1000"))
+DB_FLUSH_MAX_PENDING = int(os.getenv("DB_FLUSH_MAX_PENDING", "100"))
+# Журнальный режим: изменения дописываются в support_db.json.journal.N, снимок пересобирается
+# после DB_JOURNAL_COMPACT_EVERY записей
+DB_JOURNAL = os.getenv("DB_JOURNAL", "0") == "1"
+DB_JOURNAL_COMPACT_EVERY = int(os.getenv("DB_JOURNAL_COMPACT_EVERY", "10000"))
 LOGS_THREAD_ID = 743  # ID канала логов в группе
+# Локальный журнал событий send_log (JSONL с ротацией); пустой SUPPORT_EVENTS_FILE отключает запись
+EVENTS_FILE = os.getenv("SUPPORT_EVENTS_FILE", "support_events.jsonl")
+EVENTS_MAX_BYTES = int(os.getenv("SUPPORT_EVENTS_MAX_BYTES", str(10 * 1024 * 1024)))
+EVENTS_BACKUPS = int(os.getenv("SUPPORT_EVENTS_BACKUPS", "10"))
+EVENTS_COMPRESS = os.getenv("SUPPORT_EVENTS_COMPRESS", "0") == "1"
+LOG_BATCH_WINDOW = float(os.getenv("LOG_BATCH_WINDOW", "2"))  # секунд, за которые логи склеиваются в одно сообщение
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "1000"))  # событий в очереди канала логов, лишние вытесняют старые
+# Рассылка: общий лимит Telegram ~30 сообщений в секунду, держимся чуть ниже
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))  # получателей между сохранениями курсора
+BROADCAST_STATUS_INTERVAL = 10  # секунд между обновлениями статуса рассылки
+# Исходящие запросы: всего в секунду, в один личный чат в секунду, в одну группу в минуту,
+# в чат поддержки в секунду (у него своё ведро с запасом на минуту); повторов при сбоях.
+# Для Telegram чат поддержки — обычная группа, поэтому по умолчанию его темп — тот же групповой лимит
+RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "30"))
+RATE_LIMIT_PRIVATE = float(os.getenv("RATE_LIMIT_PRIVATE", "1"))
+RATE_LIMIT_GROUP_PER_MINUTE = float(os.getenv("RATE_LIMIT_GROUP_PER_MINUTE", "20"))
+RATE_LIMIT_SUPPORT_CHAT = float(os.getenv("RATE_LIMIT_SUPPORT_CHAT", str(RATE_LIMIT_GROUP_PER_MINUTE / 60)))
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))
+USERS_PAGE_SIZE = 25  # пользователей на странице каталога
+ADMIN_KB_CACHE_SIZE = 1024  # клавиатур тикетов в LRU-кэше
+# Сколько апдейтов обрабатывается одновременно; апдейты одного пользователя или темы всё равно идут по порядку
+CONCURRENT_UPDATES = int(os.getenv("SUPPORT_CONCURRENT_UPDATES", "32"))
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1"))  # секунд тишины, после которых альбом пересылается
+# Webhook вместо polling: SUPPORT_WEBHOOK_URL — публичный адрес (https://bot.example.com), на нём
+# слушается SUPPORT_WEBHOOK_PATH; SUPPORT_WEBHOOK_SECRET обязателен. Без python-telegram-bot[webhooks]
+# или при ошибке запуска webhook бот откатывается на polling
+WEBHOOK_URL = os.getenv("SUPPORT_WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("SUPPORT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("SUPPORT_WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("SUPPORT_WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("SUPPORT_WEBHOOK_SECRET")
+BOT_API_URL = os.getenv("SUPPORT_BOT_API_URL")  # свой сервер Bot API (или заглушка для замеров) вместо api.telegram.org
+PROMPT_TIMEOUT = int(os.getenv("SUPPORT_PROMPT_TIMEOUT", "600"))  # секунд до сброса брошенного запроса ввода
+# Метрики в формате Prometheus на http://SUPPORT_METRICS_LISTEN:SUPPORT_METRICS_PORT/metrics; 0 — не поднимать
+METRICS_PORT = int(os.getenv("SUPPORT_METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("SUPPORT_METRICS_LISTEN", "127.0.0.1")
+SLOW_HANDLER_MS = int(os.getenv("SUPPORT_SLOW_HANDLER_MS", "1000"))  # вызовы хендлеров дольше этого пишутся в лог
+PROFILE_INTERVAL_MS = int(os.getenv("SUPPORT_PROFILE_INTERVAL_MS", "10"))  # период выборок профайлера из /admin
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def b36(number):
+    """Короткая запись неотрицательного числа для callback_data; обратно — int(text, 36)"""
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = ""
+    while True:
+        number, rest = divmod(number, 36)
+        text = digits[rest] + text
+        if not number:
+            return text
+
+
+# --- МЕТРИКИ ---
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как в Prometheus"""
+    SECONDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=SECONDS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum, histogram.count, histogram.max = self.sum, self.count, self.max
+        return histogram
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попадает квантиль q (для последней корзины — максимум)"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Счётчики, гистограммы и датчики в памяти процесса: формат Prometheus и сводка в /admin"""
+
+    def __init__(self):
+        self.counters = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.gauges = {}  # имя -> функция без аргументов
+        self.help = {}  # имя -> описание
+        self._lock = threading.Lock()
+        self._server = None
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=Histogram.SECONDS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, text, func):
+        """Датчик читается в момент выгрузки: func возвращает текущее значение (длину очереди и т.п.)"""
+        self.describe(name, text)
+        self.gauges[name] = func
+
+    def series(self, name):
+        """Гистограммы одной метрики: [(метки, Histogram)]"""
+        with self._lock:
+            return [(dict(labels), h.snapshot()) for (key, labels), h in self.histograms.items() if key == name]
+
+    def totals(self, name):
+        """Значения одного счётчика: [(метки, значение)]"""
+        with self._lock:
+            return [(dict(labels), value) for (key, labels), value in self.counters.items() if key == name]
+
+    def read_gauges(self):
+        values = {}
+        for name, func in self.gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+        return values
+
+    @staticmethod
+    def _order(item):
+        (name, labels), _ = item
+        return name, repr(labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        items = [*labels, *extra]
+        if not items:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in items)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+    def render(self):
+        """Текстовый формат Prometheus 0.0.4"""
+        with self._lock:
+            counters = sorted(self.counters.items(), key=self._order)
+            histograms = sorted(((key, h.snapshot()) for key, h in self.histograms.items()), key=self._order)
+        lines = []
+
+        def header(name, kind):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        last = None
+        for (name, labels), value in counters:
+            if name != last:
+                header(name, "counter")
+                last = name
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            if name != last:
+                header(name, "histogram")
+                last = name
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, "+Inf"), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for name, value in sorted(self.read_gauges().items()):
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def _serve(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while await asyncio.wait_for(reader.readline(), 5) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host, port):
+        """GET /metrics на host:port в текущем event loop"""
+        self._server = await asyncio.start_server(self._serve, host, port)
+        logger.info(f"Metrics on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics = Metrics()
+metrics.describe("support_handler_seconds", "Handler latency by handler and branch")
+metrics.describe("support_handler_errors_total", "Handler invocations that raised")
+metrics.describe("support_slow_handlers_total", "Handler invocations slower than SUPPORT_SLOW_HANDLER_MS")
+metrics.describe("support_handler_api_calls_total", "Bot API requests made by handlers")
+metrics.describe("support_bot_api_calls_total", "Bot API requests by method")
+metrics.describe("support_bot_api_seconds", "Bot API request latency by method")
+metrics.describe("support_bot_api_errors_total", "Failed Bot API requests by method and error")
+metrics.describe("support_rate_limit_wait_seconds", "Time spent waiting for rate limiter tokens")
+metrics.describe("support_db_save_seconds", "Blocking part of a DB save")
+metrics.describe("support_db_written_bytes_total", "Bytes written by the DB")
+metrics.describe("support_log_dropped_total", "Log events dropped because the log queue was full")
+
+
+class HandlerCall:
+    """Текущий вызов хендлера: ветка и сделанные запросы к Bot API"""
+    __slots__ = ("handler", "branch", "api_calls")
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.branch = "other"
+        self.api_calls = Counter()
+
+
+# Вызов хендлера текущего апдейта; задачи, порождённые хендлером (fan_out), видят тот же объект
+current_call = contextvars.ContextVar("current_call", default=None)
+
+
+def branch(name):
+    """Помечает, по какой ветке пошёл текущий хендлер"""
+    call = current_call.get()
+    if call is not None:
+        call.branch = name
+
+
+def timed(handler_name):
+    """Хендлер с замером времени, ошибок и запросов к Bot API по веткам"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update, context, *args, **kwargs):
+            call = HandlerCall(handler_name)
+            token = current_call.set(call)
+            started = time.perf_counter()
+            try:
+                return await func(update, context, *args, **kwargs)
+            except Exception:
+                metrics.inc("support_handler_errors_total", handler=handler_name, branch=call.branch)
+                raise
+            finally:
+                current_call.reset(token)
+                elapsed = time.perf_counter() - started
+                metrics.observe("support_handler_seconds", elapsed, handler=handler_name, branch=call.branch)
+                if elapsed * 1000 > SLOW_HANDLER_MS:
+                    calls = ", ".join(f"{method}×{count}" for method, count in call.api_calls.items()) or "none"
+                    logger.warning(f"Slow handler {handler_name}/{call.branch}: {elapsed * 1000:.0f} ms, "
+                                   f"API calls: {calls}")
+                    metrics.inc("support_slow_handlers_total", handler=handler_name, branch=call.branch)
+                    profiler.record_slow(call, elapsed)
+                metrics.inc("support_handler_api_calls_total", sum(call.api_calls.values()),
+                            handler=handler_name, branch=call.branch)
+        return wrapper
+    return decorator
+
+
+# --- ПРОФИЛИРОВАНИЕ ---
+class SamplingProfiler:
+    """Сэмплирующий профайлер хендлеров в event loop, включается из /admin на несколько минут"""
+    MAX_SLOW = 100  # медленных вызовов в отчёте
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def active(self):
+        return self._thread is not None
+
+    def start(self, targets):
+        """Запуск из event loop: его поток и будет профилироваться"""
+        self.targets = {getattr(func, "__wrapped__", func).__code__ for func in targets}
+        self.loop_thread = threading.get_ident()
+        self.stacks = Counter()  # стек от хендлера до листа -> выборок
+        self.ticks = 0
+        self.slow = deque(maxlen=self.MAX_SLOW)
+        self.started = time.monotonic()
+        self.sampler_cpu = 0.0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.ticks += 1
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                if frame.f_code in self.targets:
+                    self.stacks[tuple(reversed(stack))] += 1
+                    break
+                frame = frame.f_back
+        self.sampler_cpu = time.thread_time()
+
+    def record_slow(self, call, elapsed):
+        if self.active:
+            self.slow.append((time.time(), call.handler, call.branch, elapsed, dict(call.api_calls)))
+
+    def stop(self):
+        """Останавливает сэмплер и возвращает текстовый отчёт"""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return self.report(time.monotonic() - self.started)
+
+    @staticmethod
+    def _where(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def report(self, elapsed):
+        samples = sum(self.stacks.values())
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for code in set(stack):
+                total[code] += count
+
+        lines = [
+            f"Профиль хендлеров: {', '.join(sorted(code.co_name for code in self.targets))}",
+            f"Окно: {elapsed:.0f} с, интервал {self.interval * 1000:.0f} мс, тиков: {self.ticks}",
+            f"Выборок в хендлерах: {samples} (≈ {samples / max(self.ticks, 1) * elapsed:.2f} с CPU event loop)",
+            f"Накладные расходы: CPU сэмплера {self.sampler_cpu * 1000:.0f} мс "
+            f"({self.sampler_cpu / elapsed * 100 if elapsed else 0:.2f} % окна)",
+            "",
+            f"Медленные вызовы (> {SLOW_HANDLER_MS} мс), последние {self.MAX_SLOW}:",
+        ]
+        for ts, handler, branch_name, seconds, api_calls in self.slow:
+            calls = ", ".join(f"{method}×{count}" for method, count in api_calls.items()) or "нет"
+            lines.append(f"  {datetime.fromtimestamp(ts):%H:%M:%S} {handler}/{branch_name}: "
+                         f"{seconds * 1000:.0f} мс, запросы к API: {calls}")
+        if not self.slow:
+            lines.append("  нет")
+
+        lines += ["", "Функции (своих выборок / всего выборок):"]
+        for code, count in own.most_common(30):
+            lines.append(f"  {count:6d} / {total[code]:6d}  {self._where(code)}")
+        lines += ["", "Свёрнутые стеки (flamegraph.pl, speedscope):"]
+        for stack, count in self.stacks.most_common():
+            lines.append(";".join(self._where(code) for code in stack) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+
+# Порядки каталога пользователей: i — по id, t — по числу обращений, n — по username
+USER_ORDERS = ("i", "t", "n")
+
+
 class SupportDB:
-    def __init__(self, filename):
+    def __init__(self, filename, flush_interval_ms=0, max_pending=1, journal=False, compact_every=10000):
         self.filename = filename
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max(1, max_pending)
+        # Журнальный режим: каждое изменение дописывается строкой в сегмент журнала,
+        # полный снимок пишется только при компактизации
+        self.journal = journal
+        self.compact_every = max(1, compact_every)
+        self.seq = 0  # номер последней применённой записи журнала
+        self.journal_records = 0  # записей журнала после последнего снимка
+        self._journal_file = None
+        self._stale_segments = False
+        # Пока снимок сериализуется в потоке, узлы, общие с ним, перед изменением копируются (copy-on-write);
+        # здесь id уже скопированных узлов, None — снимка в работе нет
+        self._owned = None
         self.data = self.load()
+        # Состояние отложенной записи
+        self.pending = 0  # изменений с последней успешной записи
+        self.dirty_since = None  # monotonic-время первого незаписанного изменения
+        self.last_flush_duration = 0.0
+        self.last_flush_bytes = 0
+        self._write_lock = threading.Lock()
+        self._closing = False
+        self._wakeup = None
+        self._flusher = None
+        if self.journal:
+            self._open_segment()
+        elif self._stale_segments:
+            # Журнал остался от журнального режима: сворачиваем его в обычный снимок
+            self._dump()
+            self._owned = None
 
     def load(self):
+        data = None
         if os.path.exists(self.filename):
             try:
                 with open(self.filename, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    # Инициализация ключей
-                    for key in ["tickets", "active_chats", "banned", "agents", "ban_reasons", "user_metadata",
-                                "complaints"]:
-                        if key not in data:
-                            data[key] = {} if key != "banned" else []
-                    return data
             except:
                 pass
-        return {"tickets": {}, "active_chats": {}, "banned": [], "agents": {}, "ban_reasons": {}, "user_metadata": {},
-                "complaints": {}}
-
+        if data is None:
+            data = {}
+        # Инициализация ключей
+        for key in ["tickets", "active_chats", "banned", "agents", "ban_reasons", "user_metadata",
+                    "complaints"]:
+            if key not in data:
+                data[key] = {} if key != "banned" else []
+        # Баны держим множеством: проверка O(1), на диск уходит прежним списком
+        data["banned"] = set(data["banned"])
+        self.seq = data.pop("_seq", 0)
+        self.data = data
+        self._replay()
+        self._build_indexes()
+        return data
+
+    def _build_indexes(self):
+        # thread_id -> (kind, uid) только для открытых обращений и жалоб; обращения важнее жалоб
+        self.threads = {}
+        # Счётчики, которые нельзя получить через len(): дальше обновляются в точках изменения
+        self.counters = {"tickets": 0, "open_tickets": 0, "open_complaints": 0}
+        for kind in ("complaints", "tickets"):
+            for uid, ticket in self.data[kind].items():
+                if ticket.get("status") == "open":
+                    self.threads[ticket.get("thread_id")] = (kind, uid)
+                    self.counters[f"open_{kind}"] += 1
+        self.counters["tickets"] = sum(info.get('ticket_count', 0) for info in self.data["user_metadata"].values())
+        # Отсортированные ключи каталога пользователей: страница — бинарный поиск курсора и срез
+        self.user_index = {"i": [], "t": [], "n": []}
+        for uid, info in self.data["user_metadata"].items():
+            for order in USER_ORDERS:
+                key = self._user_key(order, int(uid), info)
+                if key is not None:
+                    self.user_index[order].append(key)
+        for keys in self.user_index.values():
+            keys.sort()
+        # username (без учёта регистра) -> uid для поиска по @handle
+        self.usernames = {info["username"].lower(): uid
+                          for uid, info in self.data["user_metadata"].items() if info.get("username")}
+
+    @staticmethod
+    def _user_key(order, uid, info):
+        if order == "t":
+            return -info.get("ticket_count", 0), uid
+        if order == "n":
+            return (info["username"].lower(), uid) if info.get("username") else None
+        return uid,
+
+    def _reindex_user(self, order, uid, old, new):
+        """Переставляет пользователя в отсортированном индексе order после изменения old -> new"""
+        keys = self.user_index[order]
+        old_key = self._user_key(order, uid, old) if old is not None else None
+        new_key = self._user_key(order, uid, new)
+        if old_key == new_key:
+            return
+        if old_key is not None:
+            position = bisect.bisect_left(keys, old_key)
+            if position < len(keys) and keys[position] == old_key:
+                del keys[position]
+        if new_key is not None:
+            bisect.insort(keys, new_key)
+
+    # --- Журнал ---
+    def _segments(self):
+        """Сегменты журнала по возрастанию номера первой записи"""
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        prefix = os.path.basename(self.filename) + ".journal."
+        segments = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                segments.append((int(name[len(prefix):]), os.path.join(directory, name)))
+        return [path for _, path in sorted(segments)]
+
+    def _replay(self):
+        """Применяет поверх снимка записи журнала, которых в нём ещё нет"""
+        for path in self._segments():
+            self._stale_segments = True
+            with open(path, 'rb+') as f:
+                good = 0  # конец последней целой записи
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("torn line")
+                        record = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка при падении процесса — дальше записей нет. Отрезаем её:
+                        # новый процесс может дописывать в этот же сегмент, и запись склеилась бы с обрывком
+                        logger.warning(f"Truncating torn journal tail in {path} at byte {good}")
+                        f.truncate(good)
+                        break
+                    good += len(line)
+                    if record["s"] <= self.seq:
+                        continue
+                    self._apply(record)
+                    self.seq = record["s"]
+                    self.journal_records += 1
+
+    def _open_segment(self):
+        # Абсолютный путь: так же его возвращает _segments(), и компактизация узнаёт живой сегмент
+        path = f"{os.path.abspath(self.filename)}.journal.{self.seq + 1}"
+        self._journal_file = open(path, 'a', encoding='utf-8')
+
+    def _remove_segments(self, keep=None):
+        keep = keep and os.path.abspath(keep)
+        for path in self._segments():
+            if path != keep:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logger.warning(f"Could not remove journal segment {path}: {e}")
+
+    def _apply(self, record):
+        *parents, key = record["p"]
+        node = self.data
+        for part in parents:
+            node = self._own(node, part, dict)
+        op = record["op"]
+        if op == "set":
+            node[key] = record["v"]
+        elif op == "del":
+            node.pop(key, None)
+        elif op == "inc":
+            node[key] = node.get(key, 0) + record["v"]
+        elif op == "push":
+            items = self._own(node, key, list)
+            items.append(record["v"])
+            if record.get("n") and len(items) > record["n"]:
+                del items[:-record["n"]]
+        elif op == "add":
+            self._own(node, key, set).add(record["v"])
+        elif op == "discard" and key in node:
+            self._own(node, key, set).discard(record["v"])
+
+    def _own(self, node, key, factory):
+        """Дочерний узел для изменения; узел, общий со снимком в работе, сначала копируется"""
+        child = node.get(key)
+        if child is None:
+            child = node[key] = factory()
+        elif self._owned is None or id(child) in self._owned:
+            return child
+        else:
+            child = node[key] = copy.copy(child)
+        if self._owned is not None:
+            self._owned.add(id(child))
+        return child
+
+    def _freeze(self):
+        """Снимок для записи в потоке: дальше изменения копируют затронутые узлы и снимок не трогают"""
+        self._owned = set()
+        if self.journal:
+            # Вместе с номером последней вошедшей в снимок записи журнала
+            return {**self.data, "_seq": self.seq}
+        return dict(self.data)
+
+    def _mutate(self, op, path, value=None, limit=None):
+        """Единственная точка изменения данных: применяет операцию и дописывает её в журнал"""
+        self.seq += 1
+        record = {"s": self.seq, "op": op, "p": path, "v": value}
+        if limit:
+            record["n"] = limit
+        self._apply(record)
+        if self.journal:
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+            self._journal_file.write(line)
+            self._journal_file.flush()
+            self.journal_records += 1
+            metrics.inc("support_db_written_bytes_total", len(line.encode('utf-8')), kind="journal")
+
+    # --- Запись на диск ---
     def save(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        """Помечает базу изменённой; без флашера пишет на диск сразу"""
+        if self._flusher is None:
+            self._checkpoint()()
+            self._owned = None
+            return
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+        self.pending += 1
+        if self.pending >= self.max_pending:
+            self._wakeup.set()
+
+    def at_risk(self):
+        """Сколько изменений и секунд данных ещё не записано на диск"""
+        if self.dirty_since is None:
+            return 0, 0.0
+        return self.pending, time.monotonic() - self.dirty_since
+
+    def _serialize(self, snapshot):
+        if self.journal:
+            return json.dumps(snapshot, ensure_ascii=False, default=sorted).encode('utf-8')
+        return json.dumps(snapshot, ensure_ascii=False, indent=2, default=sorted).encode('utf-8')
+
+    def _write_snapshot(self, snapshot):
+        """Сериализация и атомарная запись: временный файл + fsync + rename"""
+        started = time.monotonic()
+        payload = self._serialize(snapshot)
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+        self.last_flush_duration = time.monotonic() - started
+        self.last_flush_bytes = len(payload)
+        metrics.observe("support_db_save_seconds", self.last_flush_duration, kind="snapshot")
+        metrics.inc("support_db_written_bytes_total", len(payload), kind="snapshot")
+
+    def _dump(self, snapshot=None):
+        with self._write_lock:
+            self._write_snapshot(self._freeze() if snapshot is None else snapshot)
+            if self._stale_segments:
+                self._remove_segments()
+                self._stale_segments = False
+
+    def _sync_journal(self):
+        started = time.monotonic()
+        os.fsync(self._journal_file.fileno())
+        self.last_flush_duration = time.monotonic() - started
+        metrics.observe("support_db_save_seconds", self.last_flush_duration, kind="journal")
+
+    def _compact(self, snapshot, segment):
+        with self._write_lock:
+            self._write_snapshot(snapshot)
+            # Все записи старых сегментов уже вошли в снимок
+            self._remove_segments(keep=segment)
+
+    def _checkpoint(self):
+        """Готовит запись в event loop и возвращает блокирующую часть, которую можно унести в поток"""
+        if not self.journal:
+            snapshot = self._freeze()
+            return lambda: self._dump(snapshot)
+        if self.journal_records < self.compact_every:
+            return self._sync_journal
+        # Снимок и граница журнала фиксируются атомарно относительно других корутин
+        self._sync_journal()
+        snapshot = self._freeze()
+        self._journal_file.close()
+        self._open_segment()
+        self.journal_records = 0
+        segment = self._journal_file.name
+        return lambda: self._compact(snapshot, segment)
+
+    async def flush(self):
+        """Записывает накопленные изменения на диск вне event loop"""
+        if not self.pending:
+            return
+        pending, dirty_since = self.pending, self.dirty_since
+        self.pending, self.dirty_since = 0, None
+        try:
+            # Изменения, сделанные во время записи, снова пометят базу и попадут в следующую
+            await asyncio.to_thread(self._checkpoint())
+        except Exception as e:
+            self.pending += pending
+            self.dirty_since = dirty_since if self.dirty_since is None else min(dirty_since, self.dirty_since)
+            logger.error(f"Failed to flush DB: {e}")
+        finally:
+            # Снимок записан, копировать узлы перед изменением больше не нужно
+            self._owned = None
+
+    async def _flush_loop(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
 
+    def start(self):
+        """Запускает фоновый флашер в текущем event loop"""
+        if self.flush_interval <= 0 or self._flusher is not None:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def close(self):
+        """Останавливает флашер и гарантированно дописывает хвост изменений"""
+        if self._flusher is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        if self.pending:
+            self._checkpoint()()
+            self._owned = None
+            self.pending, self.dirty_since = 0, None
+
+    # --- Пользователи ---
     def register_user(self, user):
         uid = str(user.id)
-        if uid not in self.data["user_metadata"]:
-            self.data["user_metadata"][uid] = {
-                "username": user.username,
-                "ticket_count": 0
-            }
+        meta = self.data["user_metadata"].get(uid)
+        old = dict(meta) if meta is not None else None
+        if meta is None:
+            self._mutate("set", ["user_metadata", uid], {"username": user.username, "ticket_count": 0})
+        elif meta.get("username") != user.username:
+            self._mutate("set", ["user_metadata", uid, "username"], user.username)
         else:
-            self.data["user_metadata"][uid]["username"] = user.username
+            return
+        for order in USER_ORDERS:
+            self._reindex_user(order, user.id, old, self.data["user_metadata"][uid])
+        if old and old.get("username") and self.usernames.get(old["username"].lower()) == uid:
+            del self.usernames[old["username"].lower()]
+        if user.username:
+            self.usernames[user.username.lower()] = uid
         self.save()
 
     def increment_ticket(self, user_id):
         uid = str(user_id)
         if uid in self.data["user_metadata"]:
-            self.data["user_metadata"][uid]["ticket_count"] += 1
+            old = dict(self.data["user_metadata"][uid])
+            self._mutate("inc", ["user_metadata", uid, "ticket_count"], 1)
+            self.counters["tickets"] += 1
+            self._reindex_user("t", int(uid), old, self.data["user_metadata"][uid])
             self.save()
 
     def get_all_user_ids(self):
         """Возвращает список всех user_id из базы"""
         return list(self.data["user_metadata"].keys())
 
+    def get_user(self, uid):
+        return self.data["user_metadata"].get(str(uid))
+
+    def get_username(self, uid, default="Неизвестно"):
+        return (self.get_user(uid) or {}).get("username", default)
+
+    def find_user_id(self, username):
+        """user_id по username без учёта регистра и ведущего @; None, если не найден"""
+        return self.usernames.get(username.lstrip("@").lower())
+
+    def count_users(self):
+        return len(self.data["user_metadata"])
+
+    def _cursor_key(self, order, cursor):
+        if order == "t":
+            count, uid = cursor.split(".")
+            return -int(count, 36), int(uid, 36)
+        uid = int(cursor, 36)
+        if order == "n":
+            return self._user_key("n", uid, self.get_user(uid) or {}) or ("", uid)
+        return uid,
+
+    def users_page(self, order="i", cursor=None, limit=20, prefix=None):
+        """Страница каталога по order (i, t, n; prefix для n): ([(uid, info)], курсор следующей или None)"""
+        keys = self.user_index[order]
+        prefix = prefix.lower() if order == "n" and prefix else None
+        if cursor:
+            start = bisect.bisect_right(keys, self._cursor_key(order, cursor))
+        elif prefix:
+            start = bisect.bisect_left(keys, (prefix,))
+        else:
+            start = 0
+        page = []
+        for key in keys[start:start + limit + 1]:
+            if prefix and not key[0].startswith(prefix):
+                break
+            page.append(key)
+        more = len(page) > limit
+        page = page[:limit]
+        items = [(str(key[-1]), self.data["user_metadata"][str(key[-1])]) for key in page]
+        if not more:
+            return items, None
+        last_uid, last_info = int(items[-1][0]), items[-1][1]
+        return items, user_cursor(order, last_uid, last_info)
+
+    # --- Обращения и жалобы ---
+    def get_ticket(self, uid, kind="tickets"):
+        return self.data[kind].get(str(uid))
+
+    def find_thread(self, thread_id):
+        """Открытое обращение или жалоба в теме thread_id: (kind, uid) или None"""
+        return self.threads.get(thread_id)
+
+    def is_active(self, uid):
+        return str(uid) in self.data["active_chats"]
+
+    def _is_open(self, uid, kind):
+        return (self.data[kind].get(uid) or {}).get("status") == "open"
+
+    def _unindex_thread(self, uid, kind):
+        ticket = self.data[kind].get(uid)
+        if ticket and self.threads.get(ticket.get("thread_id")) == (kind, uid):
+            del self.threads[ticket["thread_id"]]
+
+    def open_ticket(self, uid, thread_id, admin_msg_id, kind="tickets"):
+        """Создаёт обращение (kind="tickets") или жалобу (kind="complaints")"""
+        uid = str(uid)
+        if not self._is_open(uid, kind):
+            self.counters[f"open_{kind}"] += 1
+        self._unindex_thread(uid, kind)
+        self._mutate("set", [kind, uid], {"thread_id": thread_id, "status": "open", "admin_msg_id": admin_msg_id})
+        self.threads[thread_id] = (kind, uid)
+        self.save()
+
+    def close_ticket(self, uid, kind="tickets"):
+        uid = str(uid)
+        if self._is_open(uid, kind):
+            self.counters[f"open_{kind}"] -= 1
+        self._unindex_thread(uid, kind)
+        self._mutate("set", [kind, uid, "status"], "closed")
+        self._mutate("del", ["active_chats", uid])
+        self.save()
+
+    def take_chat(self, uid, agent_num):
+        self._mutate("set", ["active_chats", str(uid)], {"agent_num": agent_num})
+        self.save()
+
+    # --- Баны ---
+    def is_banned(self, uid):
+        return int(uid) in self.data["banned"]
+
+    def ban_user(self, uid, reason, agent_num):
+        uid = str(uid)
+        self._mutate("add", ["banned"], int(uid))
+        self._mutate("set", ["ban_reasons", uid], {"reason": reason, "agent_num": agent_num})
+        self.save()
+
+    def unban_user(self, uid):
+        uid = str(uid)
+        self._mutate("discard", ["banned"], int(uid))
+        self._mutate("del", ["ban_reasons", uid])
+        self.save()
+
+    # --- Агенты ---
+    def get_agent(self, agent_id):
+        return self.data["agents"].get(str(agent_id))
+
+    def is_agent(self, agent_id):
+        return str(agent_id) in self.data["agents"]
+
+    def list_agents(self):
+        return list(self.data["agents"].items())
+
+    def add_agent(self, agent_id):
+        """Добавляет агента и возвращает его номер"""
+        num = len(self.data["agents"]) + 1
+        self._mutate("set", ["agents", str(agent_id)], {"num": num, "replies": 0, "bans": 0})
+        self.save()
+        return num
+
+    def remove_agent(self, agent_id):
+        self._mutate("del", ["agents", str(agent_id)])
+        self.save()
+
+    def add_agent_stat(self, agent_id, field):
+        """Увеличивает счётчик агента: replies или bans"""
+        self._mutate("inc", ["agents", str(agent_id), field], 1)
+        self.save()
+
+    # --- Рассылки ---
     def add_broadcast_log(self, log_data):
         """Добавляет лог рассылки"""
-        if "broadcast_logs" not in self.data:
-            self.data["broadcast_logs"] = []
-        self.data["broadcast_logs"].append(log_data)
         # Храним только последние 50 логов
-        if len(self.data["broadcast_logs"]) > 50:
-            self.data["broadcast_logs"] = self.data["broadcast_logs"][-50:]
+        self._mutate("push", ["broadcast_logs"], log_data, limit=50)
         self.save()
 
     def get_broadcast_logs(self, limit=10):
@@ -81,143 +932,860 @@ class SupportDB:
             return []
         return list(reversed(self.data["broadcast_logs"][-limit:]))
 
+    def get_broadcast_job(self):
+        """Состояние фоновой рассылки (копия) или None"""
+        return copy.deepcopy(self.data.get("broadcast_job"))
 
-db = SupportDB(DB_FILE)
+    def save_broadcast_job(self, job):
+        self._mutate("set", ["broadcast_job"], copy.deepcopy(job))
+        self.save()
 
+    def clear_broadcast_job(self):
+        self._mutate("del", ["broadcast_job"])
+        self.save()
 
-# --- ФУНКЦИЯ ЛОГИРОВАНИЯ ---
-async def send_log(context: ContextTypes.DEFAULT_TYPE, log_type: str, data: dict):
+    def stats(self):
+        """Системные счётчики за O(1)"""
+        return {
+            "users": len(self.data["user_metadata"]),
+            "complaints": len(self.data["complaints"]),
+            "agents": len(self.data["agents"]),
+            "banned": len(self.data["banned"]),
+            **self.counters,
+        }
+
+
+class SQLiteSupportDB:
+    """Хранилище на SQLite (WAL) с интерфейсом SupportDB: каждое изменение — отдельная транзакция"""
+    KINDS = ("tickets", "complaints")
+    AGENT_STATS = ("replies", "bans")
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS user_metadata (
+            uid INTEGER PRIMARY KEY, username TEXT, ticket_count INTEGER NOT NULL DEFAULT 0);
+        CREATE INDEX IF NOT EXISTS user_metadata_tickets ON user_metadata (ticket_count DESC, uid);
+        CREATE INDEX IF NOT EXISTS user_metadata_username ON user_metadata (username COLLATE NOCASE, uid);
+        CREATE TABLE IF NOT EXISTS tickets (
+            uid INTEGER PRIMARY KEY, thread_id INTEGER, status TEXT NOT NULL, admin_msg_id INTEGER);
+        CREATE INDEX IF NOT EXISTS tickets_thread ON tickets (thread_id, status);
+        CREATE TABLE IF NOT EXISTS complaints (
+            uid INTEGER PRIMARY KEY, thread_id INTEGER, status TEXT NOT NULL, admin_msg_id INTEGER);
+        CREATE INDEX IF NOT EXISTS complaints_thread ON complaints (thread_id, status);
+        CREATE TABLE IF NOT EXISTS active_chats (uid INTEGER PRIMARY KEY, agent_num);
+        CREATE TABLE IF NOT EXISTS banned (uid INTEGER PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS agents (
+            uid INTEGER PRIMARY KEY, num INTEGER NOT NULL, replies INTEGER NOT NULL DEFAULT 0,
+            bans INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS ban_reasons (uid INTEGER PRIMARY KEY, reason TEXT, agent_num);
+        CREATE TABLE IF NOT EXISTS broadcast_logs (id INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS broadcast_job (id INTEGER PRIMARY KEY CHECK (id = 1), state TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
     """
-    Отправка логов в канал логов
 
-    log_type: ticket_created, ticket_taken, ticket_closed, ticket_closed_by_user, user_banned, user_unbanned,
-              agent_assigned, agent_removed, complaint_created, complaint_taken, complaint_closed,
-              complaint_closed_by_user, agent_message_sent, broadcast_sent
-    """
-    now = datetime.now().strftime("%d.%m.%Y %H:%M:%S")
+    # Счётчики для stats(): COUNT(*) в SQLite проходит весь индекс, поэтому значения хранятся
+    # в таблице counters и меняются в тех же транзакциях, что и данные
+    COUNTERS = {
+        "users": "SELECT COUNT(*) FROM user_metadata",
+        "tickets": "SELECT COALESCE(SUM(ticket_count), 0) FROM user_metadata",
+        "complaints": "SELECT COUNT(*) FROM complaints",
+        "agents": "SELECT COUNT(*) FROM agents",
+        "banned": "SELECT COUNT(*) FROM banned",
+        "open_tickets": "SELECT COUNT(*) FROM tickets WHERE status = 'open'",
+        "open_complaints": "SELECT COUNT(*) FROM complaints WHERE status = 'open'",
+    }
 
-    if log_type == "ticket_created":
-        text = (
-            f"📩 <b>СОЗДАНО ОБРАЩЕНИЕ</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def __init__(self, filename):
+        self.filename = filename
+        self.pending = 0
+        self._connect()
+        if self._one("SELECT COUNT(*) FROM counters")[0] != len(self.COUNTERS):
+            self._recount()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.filename)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def _one(self, sql, *args):
+        return self.conn.execute(sql, args).fetchone()
+
+    def _recount(self):
+        """Пересчитывает таблицу counters полным проходом (новая база или миграция)"""
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)",
+                                  [(name, self._one(sql)[0]) for name, sql in self.COUNTERS.items()])
+
+    def _bump(self, name, delta=1):
+        self.conn.execute("UPDATE counters SET value = value + ? WHERE name = ?", (delta, name))
+
+    def _kind(self, kind):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown ticket kind: {kind}")
+        return kind
+
+    # --- Жизненный цикл: каждое изменение уже закоммичено ---
+    def save(self):
+        pass
 
-    elif log_type == "ticket_taken":
-        # Формируем ссылку на тему
-        thread_link = f"https://t.me/c/{str(SUPPORT_CHAT_ID)[4:]}/{data['thread_id']}"
+    def at_risk(self):
+        return 0, 0.0
 
-        text = (
-            f"👁 <b>НА РАССМОТРЕНИИ</b>\n\n"
-            f"👨‍💻 <b>Агент:</b> #{data['agent_num']} | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code>\n"
-            f"🔗 <b>Обращение:</b> <a href='{thread_link}'>Перейти</a>\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def start(self):
+        # После close() соединение открывается заново: так бот переживает откат с webhook на polling
+        if self.conn is None:
+            self._connect()
 
-    elif log_type == "ticket_closed":
-        text = (
-            f"🔴 <b>ОБРАЩЕНИЕ ЗАКРЫТО</b>\n\n"
-            f"👨‍💻 <b>Закрыл:</b> #{data['agent_num']} | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code>\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    async def flush(self):
+        pass
 
-    elif log_type == "ticket_closed_by_user":
-        text = (
-            f"⚪️ <b>ОБРАЩЕНИЕ ЗАКРЫТО ПОЛЬЗОВАТЕЛЕМ</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    async def close(self):
+        self.conn.close()
+        self.conn = None
 
-    elif log_type == "user_banned":
-        text = (
-            f"🚫 <b>ПОЛЬЗОВАТЕЛЬ ЗАБЛОКИРОВАН</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"👨‍💻 <b>Агент:</b> #{data['agent_num']} | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"📝 <b>Причина:</b> {data['reason']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    # --- Пользователи ---
+    def register_user(self, user):
+        with self.conn:
+            if self.conn.execute("INSERT OR IGNORE INTO user_metadata (uid, username) VALUES (?, ?)",
+                                 (user.id, user.username)).rowcount:
+                self._bump("users")
+            else:
+                self.conn.execute("UPDATE user_metadata SET username = ? WHERE uid = ? AND username IS NOT ?",
+                                  (user.username, user.id, user.username))
 
-    elif log_type == "user_unbanned":
-        text = (
-            f"✅ <b>ПОЛЬЗОВАТЕЛЬ РАЗБЛОКИРОВАН</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"👨‍💻 <b>Агент:</b> #{data['agent_num']} | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def increment_ticket(self, user_id):
+        with self.conn:
+            if self.conn.execute("UPDATE user_metadata SET ticket_count = ticket_count + 1 WHERE uid = ?",
+                                 (int(user_id),)).rowcount:
+                self._bump("tickets")
 
-    elif log_type == "agent_assigned":
-        text = (
-            f"🎯 <b>АГЕНТ НАЗНАЧЕН</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"👨‍💻 <b>Присвоен номер:</b> #{data['agent_num']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def get_all_user_ids(self):
+        """Возвращает список всех user_id из базы"""
+        return [str(uid) for uid, in self.conn.execute("SELECT uid FROM user_metadata")]
+
+    def get_user(self, uid):
+        row = self._one("SELECT username, ticket_count FROM user_metadata WHERE uid = ?", int(uid))
+        return {"username": row[0], "ticket_count": row[1]} if row else None
+
+    def get_username(self, uid, default="Неизвестно"):
+        row = self._one("SELECT username FROM user_metadata WHERE uid = ?", int(uid))
+        return row[0] if row else default
+
+    def find_user_id(self, username):
+        row = self._one("SELECT uid FROM user_metadata WHERE username = ? COLLATE NOCASE", username.lstrip("@"))
+        return str(row[0]) if row else None
+
+    def count_users(self):
+        return self._one("SELECT value FROM counters WHERE name = 'users'")[0]
+
+    def users_page(self, order="i", cursor=None, limit=20, prefix=None):
+        """Страница каталога по order (i, t, n; prefix для n): ([(uid, info)], курсор следующей или None)"""
+        where, args = [], []
+        if order == "t":
+            sort = "ticket_count DESC, uid"
+            if cursor:
+                count, uid = (int(part, 36) for part in cursor.split("."))
+                where.append("(ticket_count < ? OR (ticket_count = ? AND uid > ?))")
+                args += [count, count, uid]
+        elif order == "n":
+            sort = "username COLLATE NOCASE, uid"
+            where.append("username IS NOT NULL")
+            if prefix:
+                # Юзернеймы Telegram — латиница, цифры и _, поэтому NOCASE-диапазон покрывает префикс
+                where.append("username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE")
+                args += [prefix, prefix + "\U0010ffff"]
+            if cursor:
+                uid = int(cursor, 36)
+                name = self.get_username(uid, default=None) or ""
+                where.append("(username > ? COLLATE NOCASE OR (username = ? COLLATE NOCASE AND uid > ?))")
+                args += [name, name, uid]
+        else:
+            sort = "uid"
+            if cursor:
+                where.append("uid > ?")
+                args.append(int(cursor, 36))
+        sql = "SELECT uid, username, ticket_count FROM user_metadata"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.conn.execute(f"{sql} ORDER BY {sort} LIMIT ?", (*args, limit + 1)).fetchall()
+        items = [(str(uid), {"username": username, "ticket_count": count}) for uid, username, count in rows[:limit]]
+        if len(rows) <= limit:
+            return items, None
+        return items, user_cursor(order, int(items[-1][0]), items[-1][1])
+
+    # --- Обращения и жалобы ---
+    def get_ticket(self, uid, kind="tickets"):
+        row = self._one(f"SELECT thread_id, status, admin_msg_id FROM {self._kind(kind)} WHERE uid = ?", int(uid))
+        return {"thread_id": row[0], "status": row[1], "admin_msg_id": row[2]} if row else None
+
+    def find_thread(self, thread_id):
+        """Открытое обращение или жалоба в теме thread_id: (kind, uid) или None"""
+        for kind in self.KINDS:
+            row = self._one(f"SELECT uid FROM {kind} WHERE thread_id = ? AND status = 'open' LIMIT 1", thread_id)
+            if row:
+                return kind, str(row[0])
+        return None
+
+    def is_active(self, uid):
+        return self._one("SELECT 1 FROM active_chats WHERE uid = ?", int(uid)) is not None
+
+    def open_ticket(self, uid, thread_id, admin_msg_id, kind="tickets"):
+        """Создаёт обращение (kind="tickets") или жалобу (kind="complaints")"""
+        with self.conn:
+            prior = self._one(f"SELECT status FROM {self._kind(kind)} WHERE uid = ?", int(uid))
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {kind} (uid, thread_id, status, admin_msg_id) VALUES (?, ?, 'open', ?)",
+                (int(uid), thread_id, admin_msg_id))
+            if prior is None and kind == "complaints":
+                self._bump("complaints")
+            if prior is None or prior[0] != "open":
+                self._bump(f"open_{kind}")
+
+    def close_ticket(self, uid, kind="tickets"):
+        with self.conn:
+            if self.conn.execute(f"UPDATE {self._kind(kind)} SET status = 'closed' WHERE uid = ? AND status = 'open'",
+                                 (int(uid),)).rowcount:
+                self._bump(f"open_{kind}", -1)
+            self.conn.execute("DELETE FROM active_chats WHERE uid = ?", (int(uid),))
+
+    def take_chat(self, uid, agent_num):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO active_chats (uid, agent_num) VALUES (?, ?)",
+                              (int(uid), agent_num))
+
+    # --- Баны ---
+    def is_banned(self, uid):
+        return self._one("SELECT 1 FROM banned WHERE uid = ?", int(uid)) is not None
+
+    def ban_user(self, uid, reason, agent_num):
+        with self.conn:
+            if self.conn.execute("INSERT OR IGNORE INTO banned (uid) VALUES (?)", (int(uid),)).rowcount:
+                self._bump("banned")
+            self.conn.execute("INSERT OR REPLACE INTO ban_reasons (uid, reason, agent_num) VALUES (?, ?, ?)",
+                              (int(uid), reason, agent_num))
+
+    def unban_user(self, uid):
+        with self.conn:
+            if self.conn.execute("DELETE FROM banned WHERE uid = ?", (int(uid),)).rowcount:
+                self._bump("banned", -1)
+            self.conn.execute("DELETE FROM ban_reasons WHERE uid = ?", (int(uid),))
+
+    # --- Агенты ---
+    def get_agent(self, agent_id):
+        row = self._one("SELECT num, replies, bans FROM agents WHERE uid = ?", int(agent_id))
+        return {"num": row[0], "replies": row[1], "bans": row[2]} if row else None
+
+    def is_agent(self, agent_id):
+        return self._one("SELECT 1 FROM agents WHERE uid = ?", int(agent_id)) is not None
+
+    def list_agents(self):
+        rows = self.conn.execute("SELECT uid, num, replies, bans FROM agents ORDER BY num")
+        return [(str(uid), {"num": num, "replies": replies, "bans": bans}) for uid, num, replies, bans in rows]
+
+    def add_agent(self, agent_id):
+        """Добавляет агента и возвращает его номер"""
+        with self.conn:
+            num = self._one("SELECT value FROM counters WHERE name = 'agents'")[0] + 1
+            if not self.is_agent(agent_id):
+                self._bump("agents")
+            self.conn.execute("INSERT OR REPLACE INTO agents (uid, num) VALUES (?, ?)", (int(agent_id), num))
+        return num
+
+    def remove_agent(self, agent_id):
+        with self.conn:
+            if self.conn.execute("DELETE FROM agents WHERE uid = ?", (int(agent_id),)).rowcount:
+                self._bump("agents", -1)
+
+    def add_agent_stat(self, agent_id, field):
+        """Увеличивает счётчик агента: replies или bans"""
+        if field not in self.AGENT_STATS:
+            raise ValueError(f"Unknown agent stat: {field}")
+        with self.conn:
+            self.conn.execute(f"UPDATE agents SET {field} = {field} + 1 WHERE uid = ?", (int(agent_id),))
+
+    # --- Рассылки ---
+    def add_broadcast_log(self, log_data):
+        """Добавляет лог рассылки"""
+        with self.conn:
+            self.conn.execute("INSERT INTO broadcast_logs (entry) VALUES (?)",
+                              (json.dumps(log_data, ensure_ascii=False),))
+            # Храним только последние 50 логов
+            self.conn.execute("DELETE FROM broadcast_logs WHERE id <= (SELECT MAX(id) FROM broadcast_logs) - 50")
 
-    elif log_type == "agent_removed":
-        text = (
-            f"❌ <b>АГЕНТ СНЯТ</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"👨‍💻 <b>Снят номер:</b> #{data['agent_num']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def get_broadcast_logs(self, limit=10):
+        """Возвращает последние логи рассылок"""
+        rows = self.conn.execute("SELECT entry FROM broadcast_logs ORDER BY id DESC LIMIT ?", (limit,))
+        return [json.loads(entry) for entry, in rows]
+
+    def get_broadcast_job(self):
+        """Состояние фоновой рассылки или None"""
+        row = self._one("SELECT state FROM broadcast_job WHERE id = 1")
+        return json.loads(row[0]) if row else None
+
+    def save_broadcast_job(self, job):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO broadcast_job (id, state) VALUES (1, ?)",
+                              (json.dumps(job, ensure_ascii=False),))
+
+    def clear_broadcast_job(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM broadcast_job")
+
+    def stats(self):
+        """Системные счётчики за O(1)"""
+        return dict(self.conn.execute("SELECT name, value FROM counters"))
+
+    # --- Миграция ---
+    def import_data(self, data):
+        """Переносит словарь в формате support_db.json (повторный запуск перезаписывает те же строки)"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO user_metadata (uid, username, ticket_count) VALUES (?, ?, ?)",
+                ((int(uid), info.get("username"), info.get("ticket_count", 0))
+                 for uid, info in data.get("user_metadata", {}).items()))
+            for kind in self.KINDS:
+                self.conn.executemany(
+                    f"INSERT OR REPLACE INTO {kind} (uid, thread_id, status, admin_msg_id) VALUES (?, ?, ?, ?)",
+                    ((int(uid), t.get("thread_id"), t.get("status", "open"), t.get("admin_msg_id"))
+                     for uid, t in data.get(kind, {}).items()))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO active_chats (uid, agent_num) VALUES (?, ?)",
+                ((int(uid), chat.get("agent_num")) for uid, chat in data.get("active_chats", {}).items()))
+            self.conn.executemany("INSERT OR IGNORE INTO banned (uid) VALUES (?)",
+                                  ((int(uid),) for uid in data.get("banned", [])))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO agents (uid, num, replies, bans) VALUES (?, ?, ?, ?)",
+                ((int(aid), a["num"], a.get("replies", 0), a.get("bans", 0))
+                 for aid, a in data.get("agents", {}).items()))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ban_reasons (uid, reason, agent_num) VALUES (?, ?, ?)",
+                ((int(uid), r.get("reason"), r.get("agent_num")) for uid, r in data.get("ban_reasons", {}).items()))
+            self.conn.execute("DELETE FROM broadcast_logs")
+            self.conn.executemany("INSERT INTO broadcast_logs (entry) VALUES (?)",
+                                  ((json.dumps(log, ensure_ascii=False),) for log in data.get("broadcast_logs", [])))
+            # Незаконченная рассылка продолжится уже из SQLite
+            self.conn.execute("DELETE FROM broadcast_job")
+            if data.get("broadcast_job"):
+                self.conn.execute("INSERT INTO broadcast_job (id, state) VALUES (1, ?)",
+                                  (json.dumps(data["broadcast_job"], ensure_ascii=False),))
+        self._recount()
+
+
+def user_cursor(order, uid, info):
+    """Компактный курсор каталога пользователей для callback_data"""
+    if order == "t":
+        return f"{b36(info.get('ticket_count', 0))}.{b36(uid)}"
+    return b36(uid)
+
+
+def migrate_json_to_sqlite(json_file, sqlite_file):
+    """Одноразовый перенос support_db.json (вместе с журналом) в SQLite"""
+    source = SupportDB(json_file)
+    target = SQLiteSupportDB(sqlite_file)
+    target.import_data(source.data)
+    logger.info(f"Migrated {source.count_users()} users from {json_file} to {sqlite_file}")
+    target.conn.close()
+
+
+def open_db():
+    if DB_BACKEND == "sqlite":
+        return SQLiteSupportDB(DB_SQLITE_FILE)
+    return SupportDB(DB_FILE, DB_FLUSH_INTERVAL_MS, DB_FLUSH_MAX_PENDING, DB_JOURNAL, DB_JOURNAL_COMPACT_EVERY)
+
+
+db = open_db()
+
+
+# --- ЖУРНАЛ СОБЫТИЙ ---
+class EventStore:
+    """Журнал событий send_log в JSONL с ротацией; после start() запись и ротация идут в потоке"""
+
+    def __init__(self, filename, max_bytes, backups, compress=False):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._file = None
+        self._lock = threading.Lock()
+        self._buffer = []  # строки, ещё не переданные фоновой записи
+        self._closing = False
+        self._wakeup = None
+        self._task = None
+
+    def _backup_name(self, n):
+        return f"{self.filename}.{n}" + (".gz" if self.compress else "")
+
+    def start(self):
+        """Запускает фоновую запись в текущем event loop"""
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def append(self, log_type, data):
+        record = {"ts": round(time.time(), 3), "type": log_type, "data": data}
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + "\n"
+        if self._task is None:
+            self._write([line])
+            return
+        self._buffer.append(line)
+        self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # События, пришедшие во время записи, заберёт следующий проход
+            while self._buffer:
+                lines, self._buffer = self._buffer, []
+                await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines):
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.filename, 'a', encoding='utf-8')
+                self._file.writelines(lines)
+                self._file.flush()
+                if self._file.tell() >= self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                logger.error(f"Failed to write {len(lines)} events: {e}")
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        oldest = self._backup_name(self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._backup_name(n)):
+                os.replace(self._backup_name(n), self._backup_name(n + 1))
+        if self.compress:
+            with open(self.filename, 'rb') as src, gzip.open(self._backup_name(1), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.filename)
+        else:
+            os.replace(self.filename, self._backup_name(1))
+
+    async def close(self):
+        """Дописывает буфер и закрывает файл"""
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _files(self):
+        """Файлы от старых к новым"""
+        files = [self._backup_name(n) for n in range(self.backups, 0, -1)] + [self.filename]
+        return [path for path in files if os.path.exists(path)]
+
+    def _open(self, path):
+        # Бинарный режим: json.loads понимает bytes, а по несжатому файлу можно искать по смещениям
+        return gzip.open(path, 'rb') if path.endswith(".gz") else open(path, 'rb')
+
+    def _first_ts(self, path):
+        with self._open(path) as f:
+            line = f.readline()
+        try:
+            return json.loads(line)["ts"]
+        except (ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def _seek(f, since):
+        """Ставит несжатый файл на строку, с которой могут начинаться записи не раньше since"""
+        f.seek(0, os.SEEK_END)
+        low, high = 0, f.tell()
+        while high - low > 4096:
+            middle = (low + high) // 2
+            f.seek(middle)
+            f.readline()  # дочитываем до начала следующей строки
+            line = f.readline()
+            try:
+                ts = json.loads(line)["ts"]
+            except (ValueError, KeyError):
+                high = middle
+                continue
+            if ts < since:
+                low = middle
+            else:
+                high = middle
+        f.seek(low)
+        if low:
+            f.readline()
+
+    def read(self, since=None, until=None, types=None):
+        """Потоково отдаёт записи с since <= ts < until (unix-время), опционально только типов types"""
+        files = self._files()
+        starts = [self._first_ts(path) for path in files]
+        for i, path in enumerate(files):
+            # Файл целиком раньше интервала, если следующий начинается не позже since
+            if since is not None and i + 1 < len(files) and starts[i + 1] is not None and starts[i + 1] <= since:
+                continue
+            if until is not None and starts[i] is not None and starts[i] >= until:
+                return
+            with self._open(path) as f:
+                if since is not None and not path.endswith(".gz"):
+                    self._seek(f, since)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and record["ts"] < since:
+                        continue
+                    if until is not None and record["ts"] >= until:
+                        return
+                    if types is None or record["type"] in types:
+                        yield record
+
+    def summarize(self, since=None, until=None):
+        """Количество событий каждого типа за интервал"""
+        return Counter(record["type"] for record in self.read(since, until))
+
+
+event_store = EventStore(EVENTS_FILE, EVENTS_MAX_BYTES, EVENTS_BACKUPS, EVENTS_COMPRESS) if EVENTS_FILE else None
+
+
+class ActivityCounter:
+    """Скользящие счётчики событий send_log за час, сутки и неделю в корзинах по BUCKET секунд"""
+    BUCKET = 300
+    WINDOWS = {"hour": 3600, "day": 86400, "week": 7 * 86400}
+
+    def __init__(self):
+        self.buckets = {}  # log_type -> deque([начало корзины, количество])
+
+    def add(self, log_type, ts=None):
+        ts = time.time() if ts is None else ts
+        start = ts - ts % self.BUCKET
+        buckets = self.buckets.setdefault(log_type, deque())
+        # События приходят по времени; запоздавшее (перевод часов) учитываем в последней корзине
+        if buckets and buckets[-1][0] >= start:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([start, 1])
+        horizon = ts - self.WINDOWS["week"] - self.BUCKET
+        while buckets and buckets[0][0] < horizon:
+            buckets.popleft()
 
-    elif log_type == "complaint_created":
-        text = (
-            f"⚠️ <b>СОЗДАНА ЖАЛОБА НА АГЕНТА</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+    def count(self, log_type, window):
+        cutoff = time.time() - self.WINDOWS[window]
+        total = 0
+        for start, count in reversed(self.buckets.get(log_type, ())):
+            if start + self.BUCKET <= cutoff:
+                break
+            total += count
+        return total
 
-    elif log_type == "complaint_taken":
-        # Формируем ссылку на тему
-        thread_link = f"https://t.me/c/{str(SUPPORT_CHAT_ID)[4:]}/{data['thread_id']}"
+    def restore(self, store):
+        """Восстанавливает счётчики после перезапуска по журналу событий за последнюю неделю"""
+        self.buckets = {}
+        for record in store.read(since=time.time() - self.WINDOWS["week"]):
+            self.add(record["type"], record["ts"])
 
-        text = (
-            f"👁 <b>ЖАЛОБА НА РАССМОТРЕНИИ</b>\n\n"
-            f"👨‍💻 <b>Принял:</b> Owner | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code>\n"
-            f"🔗 <b>Жалоба:</b> <a href='{thread_link}'>Перейти</a>\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
 
-    elif log_type == "complaint_closed":
-        text = (
-            f"🔴 <b>ЖАЛОБА ЗАКРЫТА</b>\n\n"
-            f"👨‍💻 <b>Закрыл:</b> Owner | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code>\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+activity = ActivityCounter()
 
-    elif log_type == "complaint_closed_by_user":
-        text = (
-            f"⚪️ <b>ЖАЛОБА ЗАКРЫТА ПОЛЬЗОВАТЕЛЕМ</b>\n\n"
-            f"👤 <b>Пользователь:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
 
-    elif log_type == "agent_message_sent":
-        text = (
-            f"📤 <b>СООБЩЕНИЕ ОТ АГЕНТА</b>\n\n"
-            f"👨‍💻 <b>Агент:</b> #{data['agent_num']} | @{data['agent_username']} | <code>{data['agent_id']}</code>\n"
-            f"👤 <b>Получатель:</b> <code>{data['user_id']}</code> | @{data['username']}\n"
-            f"💬 <b>Сообщение:</b> {data['message'][:100]}{'...' if len(data['message']) > 100 else ''}\n"
-            f"🕐 <b>Время:</b> {now}"
-        )
+# --- ФУНКЦИЯ ЛОГИРОВАНИЯ ---
+THREAD_LINK_PREFIX = f"https://t.me/c/{str(SUPPORT_CHAT_ID)[4:]}/"
+
+
+class LogTemplate:
+    """Заранее разобранный шаблон лога; required — ключи data, без которых событие не отрисовать"""
+    DERIVED = {"time": None, "thread_link": "thread_id", "message_short": "message"}
+    # Поля с текстом от пользователей: экранируются при отрисовке, иначе Telegram отвергнет HTML сообщения
+    ESCAPED = frozenset({"reason", "message", "username", "agent_username", "sender_username"})
+
+    def __init__(self, text):
+        fields = set()
+        for _, name, _, _ in string.Formatter().parse(text):
+            if name is None:
+                continue
+            if not name.isidentifier():
+                raise ValueError(f"Bad log template field: {name!r}")
+            fields.add(name)
+        self.format = text.format_map
+        self.thread_link = "thread_link" in fields
+        self.message_short = "message_short" in fields
+        self.escaped = fields & self.ESCAPED
+        self.required = frozenset(self.DERIVED.get(name, name) for name in fields) - {None}
+
+
+LOG_TEMPLATES = {}
+
+
+def register_log_template(log_type, text):
+    LOG_TEMPLATES[log_type] = LogTemplate(text)
+
+
+def _shorten_html(text, limit=100):
+    """Первые limit символов экранированного текста с многоточием; сущность вроде &amp; не разрывается"""
+    if len(text) <= limit:
+        return text
+    cut = text[:limit]
+    amp = cut.rfind("&")
+    if amp != -1 and ";" not in cut[amp:]:
+        cut = cut[:amp]
+    return f"{cut}..."
+
+
+@functools.lru_cache(maxsize=128)
+def _log_time(second):
+    return datetime.fromtimestamp(second).strftime("%d.%m.%Y %H:%M:%S")
+
+
+def render_log(log_type, data, ts=None):
+    """Текст лога по шаблону log_type; None, если шаблона нет или в data не хватает полей"""
+    template = LOG_TEMPLATES.get(log_type)
+    if template is None:
+        return None
+    missing = template.required - data.keys()
+    if missing:
+        logger.warning(f"Log {log_type} is missing fields: {', '.join(sorted(missing))}")
+        return None
+    values = dict(data, time=_log_time(int(time.time() if ts is None else ts)))
+    for name in template.escaped:
+        values[name] = html.escape(str(data[name]))
+    if template.thread_link:
+        values["thread_link"] = f"{THREAD_LINK_PREFIX}{data['thread_id']}"
+    if template.message_short:
+        # Сначала экранирование, потом обрезка: так в лимит 100 символов входит то, что уйдёт в Telegram
+        values["message_short"] = _shorten_html(html.escape(data["message"]))
+    return template.format(values)
+
+
+def render_logs(events):
+    """Тексты для пачки событий (log_type, data, ts) — очередь логов, выгрузки журнала; нераспознанные пропускаются"""
+    texts = []
+    for log_type, data, ts in events:
+        text = render_log(log_type, data, ts)
+        if text is not None:
+            texts.append(text)
+    return texts
+
+
+register_log_template("ticket_created", (
+    "📩 <b>СОЗДАНО ОБРАЩЕНИЕ</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("ticket_taken", (
+    "👁 <b>НА РАССМОТРЕНИИ</b>\n\n"
+    "👨‍💻 <b>Агент:</b> #{agent_num} | @{agent_username} | <code>{agent_id}</code>\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code>\n"
+    "🔗 <b>Обращение:</b> <a href='{thread_link}'>Перейти</a>\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("ticket_closed", (
+    "🔴 <b>ОБРАЩЕНИЕ ЗАКРЫТО</b>\n\n"
+    "👨‍💻 <b>Закрыл:</b> #{agent_num} | @{agent_username} | <code>{agent_id}</code>\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code>\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("ticket_closed_by_user", (
+    "⚪️ <b>ОБРАЩЕНИЕ ЗАКРЫТО ПОЛЬЗОВАТЕЛЕМ</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("user_banned", (
+    "🚫 <b>ПОЛЬЗОВАТЕЛЬ ЗАБЛОКИРОВАН</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "👨‍💻 <b>Агент:</b> #{agent_num} | @{agent_username} | <code>{agent_id}</code>\n"
+    "📝 <b>Причина:</b> {reason}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("user_unbanned", (
+    "✅ <b>ПОЛЬЗОВАТЕЛЬ РАЗБЛОКИРОВАН</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "👨‍💻 <b>Агент:</b> #{agent_num} | @{agent_username} | <code>{agent_id}</code>\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("agent_assigned", (
+    "🎯 <b>АГЕНТ НАЗНАЧЕН</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "👨‍💻 <b>Присвоен номер:</b> #{agent_num}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("agent_removed", (
+    "❌ <b>АГЕНТ СНЯТ</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "👨‍💻 <b>Снят номер:</b> #{agent_num}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("complaint_created", (
+    "⚠️ <b>СОЗДАНА ЖАЛОБА НА АГЕНТА</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("complaint_taken", (
+    "👁 <b>ЖАЛОБА НА РАССМОТРЕНИИ</b>\n\n"
+    "👨‍💻 <b>Принял:</b> Owner | @{agent_username} | <code>{agent_id}</code>\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code>\n"
+    "🔗 <b>Жалоба:</b> <a href='{thread_link}'>Перейти</a>\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("complaint_closed", (
+    "🔴 <b>ЖАЛОБА ЗАКРЫТА</b>\n\n"
+    "👨‍💻 <b>Закрыл:</b> Owner | @{agent_username} | <code>{agent_id}</code>\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code>\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("complaint_closed_by_user", (
+    "⚪️ <b>ЖАЛОБА ЗАКРЫТА ПОЛЬЗОВАТЕЛЕМ</b>\n\n"
+    "👤 <b>Пользователь:</b> <code>{user_id}</code> | @{username}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("agent_message_sent", (
+    "📤 <b>СООБЩЕНИЕ ОТ АГЕНТА</b>\n\n"
+    "👨‍💻 <b>Агент:</b> #{agent_num} | @{agent_username} | <code>{agent_id}</code>\n"
+    "👤 <b>Получатель:</b> <code>{user_id}</code> | @{username}\n"
+    "💬 <b>Сообщение:</b> {message_short}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+register_log_template("broadcast_sent", (
+    "📣 <b>МАССОВАЯ РАССЫЛКА</b>\n\n"
+    "👨‍💻 <b>Отправитель:</b> Owner | @{sender_username} | <code>{sender_id}</code>\n"
+    "👥 <b>Получателей:</b> {total_users}\n"
+    "✅ <b>Доставлено:</b> {success_count}\n"
+    "❌ <b>Ошибок:</b> {fail_count}\n"
+    "💬 <b>Сообщение:</b> {message_short}\n"
+    "🕐 <b>Время:</b> {time}"
+))
+
+
+class LogSink:
+    """Очередь логов для LOGS_THREAD_ID: события за window секунд уходят одним сообщением"""
+    SEPARATOR = "\n\n"
+
+    def __init__(self, window, max_size=LOG_QUEUE_MAX):
+        self.window = window
+        self.queue = asyncio.Queue(max_size)
+        self.bot = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self, bot):
+        self.bot = bot
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, log_type, data, ts=None):
+        self._put((log_type, data, time.time() if ts is None else ts))
+
+    def _put(self, event):
+        # Канал логов отстаёт (у него низший приоритет): вытесняем самое старое событие, а не копим без конца
+        if self.queue.full():
+            self.queue.get_nowait()
+            metrics.inc("support_log_dropped_total")
+        self.queue.put_nowait(event)
+
+    async def close(self):
+        """Дописывает всё, что уже в очереди, и останавливает отправку"""
+        if self._task is None:
+            return
+        self._put(None)
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        closing = False
+        while not closing:
+            event = await self.queue.get()
+            if event is None:
+                break
+            events = [event]
+            deadline = time.monotonic() + self.window
+            # Добираем события из окна
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    closing = True
+                    break
+                events.append(event)
+            for batch in self.pack(render_logs(events)):
+                await self._send_batch(batch)
+
+    def pack(self, texts):
+        """Делит тексты на пачки целых событий; пачка через SEPARATOR не длиннее MessageLimit.MAX_TEXT_LENGTH"""
+        batches = []
+        size = 0
+        for text in texts:
+            if batches and size + len(self.SEPARATOR) + len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+                batches[-1].append(text)
+                size += len(self.SEPARATOR) + len(text)
+            else:
+                # Событие длиннее лимита уходит отдельно и целиком: обрезка могла бы разорвать HTML-тег
+                batches.append([text])
+                size = len(text)
+        return batches
+
+    async def _send_batch(self, texts):
+        try:
+            await self._send(self.SEPARATOR.join(texts))
+        except BadRequest as e:
+            if len(texts) == 1:
+                logger.error(f"Failed to send log: {e}")
+                return
+            # Пачку отверг один плохой текст (разметка, длина): шлём по одному, чтобы потерялся только он
+            logger.warning(f"Log batch of {len(texts)} rejected, sending one by one: {e}")
+            for text in texts:
+                try:
+                    await self._send(text)
+                except Exception as e:
+                    logger.error(f"Failed to send log: {e}")
+        except Exception as e:
+            logger.error(f"Failed to send log: {e}")
 
-    elif log_type == "broadcast_sent":
-        text = (
-            f"📣 <b>МАССОВАЯ РАССЫЛКА</b>\n\n"
-            f"👨‍💻 <b>Отправитель:</b> Owner | @{data['sender_username']} | <code>{data['sender_id']}</code>\n"
-            f"👥 <b>Получателей:</b> {data['total_users']}\n"
-            f"✅ <b>Доставлено:</b> {data['success_count']}\n"
-            f"❌ <b>Ошибок:</b> {data['fail_count']}\n"
-            f"💬 <b>Сообщение:</b> {data['message'][:100]}{'...' if len(data['message']) > 100 else ''}\n"
-            f"🕐 <b>Время:</b> {now}"
+    async def _send(self, text):
+        # Flood control и сетевые сбои повторяет SupportRateLimiter; логи уступают очередь всем остальным
+        await self.bot.send_message(
+            chat_id=SUPPORT_CHAT_ID,
+            message_thread_id=LOGS_THREAD_ID,
+            text=text,
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+            rate_limit_args={"priority": PRIORITY_LOG}
         )
 
-    else:
+
+log_sink = LogSink(LOG_BATCH_WINDOW)
+
+
+async def send_log(context: ContextTypes.DEFAULT_TYPE, log_type: str, data: dict):
+    """
+    Отправка логов в канал логов
+
+    log_type — ключ LOG_TEMPLATES: ticket_created, ticket_taken, ticket_closed, ticket_closed_by_user,
+              user_banned, user_unbanned, agent_assigned, agent_removed, complaint_created, complaint_taken,
+              complaint_closed, complaint_closed_by_user, agent_message_sent, broadcast_sent
+    """
+    activity.add(log_type)
+    if event_store:
+        event_store.append(log_type, data)
+
+    if log_type not in LOG_TEMPLATES:
+        return
+
+    if log_sink.running:
+        log_sink.put(log_type, data)
+        return
+
+    text = render_log(log_type, data)
+    if text is None:
         return
 
     try:
@@ -232,61 +1800,762 @@ async def send_log(context: ContextTypes.DEFAULT_TYPE, log_type: str, data: dict
         logger.error(f"Failed to send log: {e}")
 
 
+# --- РАССЫЛКА ---
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, запас не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов, например после RetryAfter от Telegram"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def retry_after_seconds(error: RetryAfter):
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+def classify_send_error(error):
+    """Причина недоставки: blocked, bad_request, timeout, network или error"""
+    if isinstance(error, Forbidden):
+        return "blocked"
+    # Запрос мог дойти: повтор рискует дублем, поэтому таймаут не повторяется
+    if isinstance(error, TimedOut):
+        return "timeout"
+    # BadRequest наследуется от NetworkError, поэтому проверяется раньше
+    if isinstance(error, BadRequest):
+        return "bad_request"
+    if isinstance(error, NetworkError):
+        return "network"
+    return "error"
+
+
+class BroadcastResult:
+    def __init__(self):
+        self.success_count = 0
+        self.fail_count = 0
+        self.errors = Counter()  # причина -> количество
+
+
+async def send_broadcast_message(bot, bucket, chat_id, text):
+    """Отправляет одно сообщение рассылки с повторами; возвращает None или причину недоставки"""
+    reason = "error"
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            # Повторы и паузы рассылка ведёт сама, у общего ограничителя она в конце очереди
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML",
+                                   rate_limit_args={"priority": PRIORITY_BULK, "max_retries": 0})
+            return None
+        except RetryAfter as e:
+            # Флуд-контроль общий для бота: тормозим всех отправителей, а не только этот
+            bucket.pause(retry_after_seconds(e))
+            reason = "flood"
+        except Exception as e:
+            reason = classify_send_error(e)
+            if reason != "network":
+                logger.warning(f"Failed to send broadcast to {chat_id}: {e}")
+                return reason
+            await asyncio.sleep(2 ** attempt)
+    logger.warning(f"Failed to send broadcast to {chat_id}: gave up after {BROADCAST_MAX_RETRIES} retries ({reason})")
+    return reason
+
+
+async def run_broadcast(bot, user_ids, text, bucket=None, concurrency=None):
+    """Рассылает text по user_ids: не больше concurrency отправок сразу, темп задаёт bucket"""
+    bucket = bucket or TokenBucket(BROADCAST_RATE)
+    result = BroadcastResult()
+    recipients = iter(user_ids)
+
+    async def worker():
+        # Общий итератор: каждый получатель достаётся ровно одному воркеру
+        for user_id in recipients:
+            reason = await send_broadcast_message(bot, bucket, int(user_id), text)
+            if reason is None:
+                result.success_count += 1
+            else:
+                result.fail_count += 1
+                result.errors[reason] += 1
+
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency or BROADCAST_CONCURRENCY))))
+    return result
+
+
+# Фоновая рассылка: состояние (курсор по user_id, счётчики, пауза/отмена) хранится в БД,
+# поэтому после перезапуска задача продолжается с последней сохранённой порции
+BROADCAST_JOB_NAME = "broadcast"
+broadcast_running = False
+
+
+def broadcast_status_text(job, header):
+    errors = job.get("errors", {})
+    return (
+        f"{header}\n\n"
+        f"👥 Всего пользователей: {job['total']}\n"
+        f"📤 Обработано: {job['success'] + job['failed']}\n"
+        f"✅ Доставлено: {job['success']}\n"
+        f"❌ Ошибок: {job['failed']}"
+        + (f" ({', '.join(f'{k}: {v}' for k, v in sorted(errors.items()))})" if errors else "")
+    )
+
+
+def schedule_broadcast(job_queue):
+    """Запускает задачу рассылки, если она ещё не выполняется и не запланирована"""
+    if not broadcast_running and not job_queue.get_jobs_by_name(BROADCAST_JOB_NAME):
+        job_queue.run_once(broadcast_job, when=0, name=BROADCAST_JOB_NAME)
+
+
+async def update_broadcast_status(bot, job, header, reply_markup=None):
+    try:
+        await bot.edit_message_text(broadcast_status_text(job, header), chat_id=job["chat_id"],
+                                    message_id=job["message_id"], parse_mode="HTML", reply_markup=reply_markup)
+    except Exception as e:
+        logger.info(f"Could not update broadcast status: {e}")
+
+
+async def finish_broadcast(context: ContextTypes.DEFAULT_TYPE, job, cancelled=False):
+    header = "⛔ <b>Рассылка отменена</b>" if cancelled else "✅ <b>Рассылка завершена!</b>"
+    await update_broadcast_status(context.bot, job, header)
+
+    await send_log(context, "broadcast_sent", {
+        "sender_id": str(OWNER_ID),
+        "sender_username": job["sender_username"],
+        "total_users": job["total"],
+        "success_count": job["success"],
+        "fail_count": job["failed"],
+        "message": job["message"]
+    })
+
+    # Сохраняем лог рассылки в БД
+    db.add_broadcast_log({
+        "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
+        "sender_id": str(OWNER_ID),
+        "sender_username": job["sender_username"],
+        "total_users": job["total"],
+        "success": job["success"],
+        "failed": job["failed"],
+        "message": job["message"][:100] + "..." if len(job["message"]) > 100 else job["message"]
+    })
+    db.clear_broadcast_job()
+
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    """Задача JobQueue: рассылка порциями по BROADCAST_CHUNK, курсор сохраняется после каждой порции"""
+    global broadcast_running
+    job = db.get_broadcast_job()
+    if not job or job["state"] != "running":
+        return
+    broadcast_running = True
+    try:
+        recipients = sorted(int(uid) for uid in db.get_all_user_ids())
+        position = bisect.bisect_right(recipients, job["cursor"]) if job["cursor"] is not None else 0
+        bucket = TokenBucket(BROADCAST_RATE)
+        last_status = time.monotonic()
+
+        while position < len(recipients):
+            chunk = recipients[position:position + BROADCAST_CHUNK]
+            result = await run_broadcast(context.bot, chunk, job["text"], bucket)
+            position += len(chunk)
+            job["cursor"] = chunk[-1]
+            job["success"] += result.success_count
+            job["failed"] += result.fail_count
+            for reason, count in result.errors.items():
+                job["errors"][reason] = job["errors"].get(reason, 0) + count
+
+            # Кнопки паузы и отмены меняют состояние в БД, пока порция отправляется
+            current = db.get_broadcast_job()
+            job["state"] = current["state"] if current else "cancelled"
+            db.save_broadcast_job(job)
+            if job["state"] != "running":
+                break
+            # Application.stop() ждёт завершения задач: останавливаемся, курсор уже сохранён
+            if not context.application.running:
+                return
+
+            if time.monotonic() - last_status >= BROADCAST_STATUS_INTERVAL:
+                last_status = time.monotonic()
+                await update_broadcast_status(context.bot, job, "📣 <b>Идёт рассылка...</b>",
+                                              get_broadcast_kb("running"))
+
+        if job["state"] == "paused":
+            await update_broadcast_status(context.bot, job, "⏸ <b>Рассылка на паузе</b>", get_broadcast_kb("paused"))
+        else:
+            await finish_broadcast(context, job, cancelled=job["state"] == "cancelled")
+    finally:
+        broadcast_running = False
+
+
+# --- ОГРАНИЧЕНИЕ ЗАПРОСОВ ---
+# Приоритеты исходящих запросов: меньше — раньше
+PRIORITY_USER, PRIORITY_STAFF, PRIORITY_BULK, PRIORITY_LOG = range(4)
+PRIORITY_NAMES = ("user", "staff", "bulk", "log")
+
+
+class PriorityTokenBucket(TokenBucket):
+    """TokenBucket, где ожидающие получают токены по приоритету, а при равном приоритете — по очереди"""
+
+    def __init__(self, rate, capacity=None):
+        super().__init__(rate, capacity)
+        self._waiters = []  # куча (приоритет, номер, future)
+        self._seq = 0
+        self._timer = None
+
+    @property
+    def idle(self):
+        """Никто не ждёт и запас полон — ведро можно выбросить"""
+        self._refill()
+        return not self._waiters and self.tokens >= self.capacity
+
+    async def acquire(self, priority=PRIORITY_USER):
+        self._refill()
+        if not self._waiters and self.tokens >= 1 and time.monotonic() >= self.paused_until:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        self._schedule(0)
+        # Отменённый future просто пропускается при раздаче
+        await future
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            if delay > 0:
+                return
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._grant)
+
+    def _grant(self):
+        self._timer = None
+        self._refill()
+        now = time.monotonic()
+        while self._waiters:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.paused_until or self.tokens < 1:
+                self._schedule(max(self.paused_until - now, (1 - self.tokens) / self.rate))
+                return
+            self.tokens -= 1
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+
+class SupportRateLimiter(BaseRateLimiter):
+    """Ограничитель исходящих запросов: ведро чата и общее ведро, очередь к ним по приоритету"""
+    LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+    NOT_IDEMPOTENT_PREFIXES = ("send", "copy", "forward")
+    MAX_IDLE_BUCKETS = 10000
+
+    def __init__(self, rate, private_rate, group_per_minute, max_retries, support_chat_rate=None):
+        self.max_retries = max_retries
+        self.private_rate = private_rate
+        self.group_per_minute = group_per_minute
+        self.support_chat_rate = support_chat_rate
+        self.bucket = PriorityTokenBucket(rate)
+        self.chats = {}  # chat_id -> PriorityTokenBucket
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.MAX_IDLE_BUCKETS:
+                self.chats = {key: value for key, value in self.chats.items() if not value.idle}
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = PriorityTokenBucket(self.private_rate)
+            elif chat_id == SUPPORT_CHAT_ID and self.support_chat_rate:
+                # Как у групп: запас на минуту вперёд, дальше ровный темп; приоритеты делят его внутри чата
+                bucket = PriorityTokenBucket(self.support_chat_rate, self.support_chat_rate * 60)
+            else:
+                # Группы: group_per_minute сообщений в минуту, можно все сразу
+                bucket = PriorityTokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    def priority(data):
+        chat_id = data.get("chat_id")
+        if chat_id == SUPPORT_CHAT_ID:
+            return PRIORITY_LOG if data.get("message_thread_id") == LOGS_THREAD_ID else PRIORITY_STAFF
+        return PRIORITY_USER
+
+    def waiting(self):
+        """Сколько запросов сейчас ждёт токена"""
+        return len(self.bucket._waiters) + sum(len(bucket._waiters) for bucket in list(self.chats.values()))
+
+    @staticmethod
+    async def _call(callback, args, kwargs, endpoint):
+        # Каждая попытка — отдельный HTTP-запрос: считаем их все, с повторами
+        call = current_call.get()
+        if call is not None:
+            call.api_calls[endpoint] += 1
+        metrics.inc("support_bot_api_calls_total", method=endpoint)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("support_bot_api_errors_total", method=endpoint, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("support_bot_api_seconds", time.perf_counter() - started, method=endpoint)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        options = rate_limit_args or {}
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await self._call(callback, args, kwargs, endpoint)
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        priority = options.get("priority", self.priority(dict(data, chat_id=chat_id)))
+        max_retries = options.get("max_retries", self.max_retries)
+        chat_bucket = self.chat_bucket(chat_id) if endpoint.startswith(self.LIMITED_PREFIXES) else None
+        # TimedOut у отправки не повторяем: сообщение могло уйти, повтор дал бы дубль.
+        # rate_limit_args={"max_retries": 0} оставляет повторы вызывающему
+        retry_timeouts = not endpoint.startswith(self.NOT_IDEMPOTENT_PREFIXES)
+
+        for attempt in range(max_retries + 1):
+            started = time.perf_counter()
+            if chat_bucket is not None:
+                await chat_bucket.acquire(priority)
+            await self.bucket.acquire(priority)
+            metrics.observe("support_rate_limit_wait_seconds", time.perf_counter() - started,
+                            priority=PRIORITY_NAMES[priority])
+            try:
+                return await self._call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                logger.info(f"{endpoint} to {chat_id}: flood control, retry in {retry_after_seconds(e)} s")
+                (chat_bucket or self.bucket).pause(retry_after_seconds(e))
+            except BadRequest:
+                raise
+            except NetworkError as e:
+                if attempt == max_retries or isinstance(e, TimedOut) and not retry_timeouts:
+                    raise
+                logger.info(f"{endpoint} to {chat_id}: {e}, retry {attempt + 1}/{max_retries}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+
+# --- CALLBACK_DATA ---
+# Формат: "<версия>:<код действия>:<аргументы>", user_id — в base36. Старый формат ("take_123", "adm_stats")
+# ещё встречается на кнопках в отправленных сообщениях и переводится в новый в unpack_callback.
+CALLBACK_VERSION = "1"
+LEGACY_CALLBACKS = {
+    "create_complaint": ("cc",), "user_close_self": ("uct",), "user_close_complaint": ("ucc",),
+    "agent_ban_by_id": ("ab",), "agent_unban_by_id": ("au",), "agent_view_tickets": ("av",),
+    "agent_send_msg": ("am",), "adm_users_list": ("ul",), "adm_ud_search": ("us",),
+    "adm_request": ("ar",), "adm_remove": ("ad",), "adm_list": ("al",), "adm_stats": ("st",),
+    "adm_broadcast": ("bc",), "adm_bc_status": ("bs",), "adm_bc_pause": ("bp",), "adm_bc_resume": ("br",),
+    "adm_bc_cancel": ("bx",), "adm_broadcast_logs": ("bl",), "adm_send_msg": ("sm",),
+}
+LEGACY_USER_ACTIONS = {"take": "tk", "close": "cl", "ban": "bn", "unban": "ub"}
+
+# Уровни доступа к кнопкам
+ACCESS_USER, ACCESS_STAFF, ACCESS_OWNER = range(3)
+# код действия -> (обработчик, уровень доступа, текст отказа)
+CALLBACK_HANDLERS = {}
+
+
+def callback(code, access=ACCESS_USER, denied="Доступ запрещен."):
+    """Регистрирует обработчик кнопки: handler(update, context, *аргументы из callback_data)"""
+    def register(handler):
+        CALLBACK_HANDLERS[code] = (handler, access, denied)
+        return handler
+    return register
+
+
+def pack_callback(code, *args):
+    """callback_data для кнопки; не длиннее лимита Telegram в 64 байта"""
+    data = ":".join((CALLBACK_VERSION, code) + tuple(str(arg) for arg in args))
+    if len(data.encode()) > InlineKeyboardButtonLimit.MAX_CALLBACK_DATA:
+        raise ValueError(f"callback_data too long: {data}")
+    return data
+
+
+def unpack_callback(data):
+    """(код действия, аргументы) из callback_data; код None, если формат не распознан"""
+    fields = data.split(":")
+    if fields[0] == CALLBACK_VERSION and len(fields) > 1:
+        return fields[1], fields[2:]
+    if data in LEGACY_CALLBACKS:
+        code, *args = LEGACY_CALLBACKS[data]
+        return code, args
+    if fields[0] == "adm_ud":
+        return "ud", fields[1:]
+    parts = data.split("_")
+    if data.startswith("take_complaint_") and parts[2].isdigit():
+        return "tc", [b36(int(parts[2]))]
+    if parts[0] in LEGACY_USER_ACTIONS and len(parts) > 1 and parts[1].isdigit():
+        return LEGACY_USER_ACTIONS[parts[0]], [b36(int(parts[1]))] + parts[2:]
+    return None, []
+
+
+# --- ОЖИДАНИЕ ВВОДА ---
+# Состояние пользователя — одно поле user_data["state"] и аргументы user_data["state_data"] для обработчика
+# из INPUT_HANDLERS. Брошенный запрос сбрасывается задачей JobQueue через PROMPT_TIMEOUT.
+INPUT_HANDLERS = {}
+
+
+def prompt(state, access=ACCESS_STAFF):
+    """Регистрирует обработчик ожидаемого ввода: handler(update, context, **state_data)"""
+    def register(handler):
+        INPUT_HANDLERS[state] = (handler, access)
+        return handler
+    return register
+
+
+def access_level(user_id):
+    if user_id == OWNER_ID:
+        return ACCESS_OWNER
+    return ACCESS_STAFF if db.is_agent(str(user_id)) else ACCESS_USER
+
+
+def set_state(update, context, state, **data):
+    """Ждём от пользователя ввода для state; таймер сброса перезапускается"""
+    user_id = update.effective_user.id
+    context.user_data["state"] = state
+    context.user_data["state_data"] = data
+    for job in context.job_queue.get_jobs_by_name(f"prompt_{user_id}"):
+        job.schedule_removal()
+    context.job_queue.run_once(expire_state, PROMPT_TIMEOUT, name=f"prompt_{user_id}", user_id=user_id)
+
+
+def clear_state(update, context):
+    """Снимает состояние; возвращает (state, state_data) или (None, {})"""
+    for job in context.job_queue.get_jobs_by_name(f"prompt_{update.effective_user.id}"):
+        job.schedule_removal()
+    return context.user_data.pop("state", None), context.user_data.pop("state_data", {})
+
+
+async def expire_state(context: ContextTypes.DEFAULT_TYPE):
+    state = context.user_data.pop("state", None)
+    context.user_data.pop("state_data", None)
+    if state:
+        logger.info(f"Prompt {state} for user {context.job.user_id} expired")
+
+
+# --- ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ---
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда лок больше никто не ждёт"""
+
+    def __init__(self):
+        self._locks = {}  # ключ -> [лок, сколько задач держат или ждут]
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных ключей идут параллельно, одного ключа (тема или пользователь) — по очереди"""
+
+    def __init__(self, max_concurrent_updates):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        # Общий семафор PTB захватывается до do_process_update: с настоящим лимитом очередь апдейтов одного
+        # ключа занимала бы все слоты. Поэтому он безлимитный, а свой слот берётся уже под локом ключа
+        super().__init__(sys.maxsize)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        self.running = 0
+        self.locks = KeyedLocks()
+
+    @property
+    def current_concurrent_updates(self):
+        return self.running
+
+    @staticmethod
+    def update_key(update):
+        if not isinstance(update, Update):
+            return None
+        message = update.effective_message
+        if message and update.effective_chat and update.effective_chat.id == SUPPORT_CHAT_ID \
+                and message.message_thread_id and not update.callback_query:
+            return "thread", message.message_thread_id
+        return ("user", update.effective_user.id) if update.effective_user else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.update_key(update)
+        async with contextlib.nullcontext() if key is None else self.locks.hold(key):
+            async with self.slots:
+                self.running += 1
+                try:
+                    await coroutine
+                finally:
+                    self.running -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# Проверка «нет открытого обращения» и создание темы — под локом (вид, user_id)
+ticket_locks = KeyedLocks()
+
+
+# --- ПЕРЕСЫЛКА ---
+class MediaGroupBuffer:
+    """Собирает части альбома и пересылает их одним copy_messages после MEDIA_GROUP_WINDOW тишины"""
+
+    def __init__(self, window):
+        self.window = window
+        self.groups = {}  # (чат-источник, media_group_id) -> части и получатель
+        self.tasks = set()
+
+    def add(self, bot, message, chat_id, thread_id=None, on_done=None):
+        key = (message.chat_id, message.media_group_id)
+        group = self.groups.get(key)
+        if group is None:
+            group = self.groups[key] = {"ids": [], "chat_id": chat_id, "thread_id": thread_id, "on_done": on_done}
+            task = asyncio.get_running_loop().create_task(self._flush(bot, key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        group["ids"].append(message.message_id)
+        group["last"] = time.monotonic()
+
+    async def _flush(self, bot, key):
+        group = self.groups[key]
+        while (delay := group["last"] + self.window - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        del self.groups[key]
+        try:
+            await bot.copy_messages(chat_id=group["chat_id"], from_chat_id=key[0], message_ids=sorted(group["ids"]),
+                                    message_thread_id=group["thread_id"])
+        except Exception as e:
+            if group["on_done"]:
+                group["on_done"](e)
+                return
+            # Как ошибка хендлера с одиночным сообщением: задача унаследовала вызов хендлера первой части
+            logger.error(f"Failed to relay media group to {group['chat_id']}: {e}")
+            call = current_call.get()
+            if call is not None:
+                metrics.inc("support_handler_errors_total", handler=call.handler, branch=call.branch)
+        else:
+            if group["on_done"]:
+                group["on_done"](None)
+
+    async def close(self):
+        """Дожидается отправки уже собранных альбомов"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW)
+
+
+async def relay_message(bot, message, chat_id, thread_id=None, on_done=None):
+    """Копия сообщения в chat_id; части альбома копятся в media_groups и уходят вместе"""
+    # С on_done исход (None или ошибка) сообщается ему, для альбома — один раз после отправки всех частей
+    if message.media_group_id:
+        media_groups.add(bot, message, chat_id, thread_id, on_done)
+        return
+    try:
+        await bot.copy_message(chat_id=chat_id, from_chat_id=message.chat_id, message_id=message.message_id,
+                               message_thread_id=thread_id)
+    except Exception as e:
+        if on_done is None:
+            raise
+        on_done(e)
+    else:
+        if on_done:
+            on_done(None)
+
+
 # --- КЛАВИАТУРЫ ---
 def get_admin_kb(uid, is_closed=False, is_complaint=False):
     uid_str = str(uid)
+    # Состояние входит в ключ кэша: после взятия, бана или разбана берётся другая разметка
+    is_active = not is_closed and db.is_active(uid_str)
+    return _admin_kb(uid_str, is_closed, is_complaint, is_active, db.is_banned(uid_str))
+
+
+@functools.lru_cache(maxsize=ADMIN_KB_CACHE_SIZE)
+def _admin_kb(uid, is_closed, is_complaint, is_active, is_banned):
+    uid_code = b36(int(uid))
     buttons = []
     if not is_closed:
-        is_active = uid_str in db.data.get("active_chats", {})
         # Для жалоб только owner может взять
         if not is_active and not is_complaint:
-            buttons.append([InlineKeyboardButton("👨‍💻 Рассмотреть", callback_data=f"take_{uid}")])
+            buttons.append([InlineKeyboardButton("👨‍💻 Рассмотреть", callback_data=pack_callback("tk", uid_code))])
         elif not is_active and is_complaint:
-            buttons.append([InlineKeyboardButton("👨‍💻 Рассмотреть (Owner)", callback_data=f"take_complaint_{uid}")])
-        buttons.append([InlineKeyboardButton("✅ Закрыть", callback_data=f"close_{uid}_{1 if is_complaint else 0}")])
+            buttons.append([InlineKeyboardButton("👨‍💻 Рассмотреть (Owner)", callback_data=pack_callback("tc", uid_code))])
+        buttons.append([InlineKeyboardButton("✅ Закрыть", callback_data=pack_callback("cl", uid_code, int(is_complaint)))])
 
-    is_banned = int(uid) in db.data.get("banned", [])
     ban_btn_text = "🔑 Разблокировать" if is_banned else "🔑 Заблокировать"
-    ban_callback = f"unban_{uid}" if is_banned else f"ban_{uid}"
+    ban_callback = pack_callback("ub" if is_banned else "bn", uid_code)
     buttons.append([InlineKeyboardButton(ban_btn_text, callback_data=ban_callback)])
     return InlineKeyboardMarkup(buttons)
 
 
+# Неизменяемые клавиатуры собираются один раз
+@functools.lru_cache(maxsize=None)
 def get_owner_kb():
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("👥 Все пользователи", callback_data="adm_users_list")],
-        [InlineKeyboardButton("🛠 Добавить агента", callback_data="adm_request")],
-        [InlineKeyboardButton("🗑 Удалить агента", callback_data="adm_remove")],
-        [InlineKeyboardButton("🎧 Список агентов", callback_data="adm_list")],
-        [InlineKeyboardButton("📊 Статистика", callback_data="adm_stats")],
-        [InlineKeyboardButton("📣 Рассылка", callback_data="adm_broadcast")],
-        [InlineKeyboardButton("📜 Логи рассылок", callback_data="adm_broadcast_logs")],
-        [InlineKeyboardButton("✉️ Написать пользователю", callback_data="adm_send_msg")]
+        [InlineKeyboardButton("👥 Все пользователи", callback_data=pack_callback("ul"))],
+        [InlineKeyboardButton("🛠 Добавить агента", callback_data=pack_callback("ar"))],
+        [InlineKeyboardButton("🗑 Удалить агента", callback_data=pack_callback("ad"))],
+        [InlineKeyboardButton("🎧 Список агентов", callback_data=pack_callback("al"))],
+        [InlineKeyboardButton("📊 Статистика", callback_data=pack_callback("st"))],
+        [InlineKeyboardButton("📈 Метрики", callback_data=pack_callback("mt"))],
+        [InlineKeyboardButton("🔬 Профилирование", callback_data=pack_callback("pf"))],
+        [InlineKeyboardButton("📣 Рассылка", callback_data=pack_callback("bc"))],
+        [InlineKeyboardButton("⏯ Текущая рассылка", callback_data=pack_callback("bs"))],
+        [InlineKeyboardButton("📜 Логи рассылок", callback_data=pack_callback("bl"))],
+        [InlineKeyboardButton("✉️ Написать пользователю", callback_data=pack_callback("sm"))]
     ])
 
 
+def render_users_page(order="i", cursor=None, prefix=None):
+    """Текст и клавиатура страницы каталога пользователей"""
+    items, next_cursor = db.users_page(order, cursor, USERS_PAGE_SIZE, prefix)
+    titles = {"i": "по ID", "t": "по числу обращений", "n": "по username"}
+    res = f"👥 <b>Пользователи {titles[order]}</b>"
+    if prefix:
+        res += f" (поиск: @{prefix})"
+    res += f"\nВсего: {db.count_users()}\n\n"
+    if not items:
+        res += "Никого не найдено."
+    for uid, info in items:
+        status = "🔴 (BANNED)" if db.is_banned(uid) else ""
+        res += f"• <code>{uid}</code> | @{info.get('username')} | Обращений: {info.get('ticket_count')} {status}\n"
+
+    prefix = prefix or ""
+    buttons = [
+        [InlineKeyboardButton("🔢 По ID", callback_data=pack_callback("ud", "i", "", "")),
+         InlineKeyboardButton("📩 По обращениям", callback_data=pack_callback("ud", "t", "", "")),
+         InlineKeyboardButton("🔤 По username", callback_data=pack_callback("ud", "n", "", ""))],
+        [InlineKeyboardButton("🔎 Поиск по username", callback_data=pack_callback("us"))]
+    ]
+    nav = []
+    if cursor:
+        nav.append(InlineKeyboardButton("⏮ В начало", callback_data=pack_callback("ud", order, "", prefix)))
+    if next_cursor:
+        nav.append(InlineKeyboardButton("Далее ▶️", callback_data=pack_callback("ud", order, next_cursor, prefix)))
+    if nav:
+        buttons.append(nav)
+    return res, InlineKeyboardMarkup(buttons)
+
+
+@functools.lru_cache(maxsize=None)
+def get_profile_kb(active):
+    if active:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить и прислать отчёт",
+                                                           callback_data=pack_callback("ps"))]])
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"▶️ {minutes} мин", callback_data=pack_callback("pr", minutes)) for minutes in (1, 5, 15)
+    ]])
+
+
+@functools.lru_cache(maxsize=None)
+def get_broadcast_kb(state):
+    first = InlineKeyboardButton("⏸ Пауза", callback_data=pack_callback("bp")) if state == "running" \
+        else InlineKeyboardButton("▶️ Продолжить", callback_data=pack_callback("br"))
+    return InlineKeyboardMarkup([[first, InlineKeyboardButton("⛔ Отменить", callback_data=pack_callback("bx"))]])
+
+
+@functools.lru_cache(maxsize=None)
 def get_user_close_kb(is_complaint=False):
     text = "✅ Закрыть жалобу" if is_complaint else "✅ Закрыть обращение"
-    callback = "user_close_complaint" if is_complaint else "user_close_self"
+    callback = pack_callback("ucc" if is_complaint else "uct")
     return InlineKeyboardMarkup([[InlineKeyboardButton(text, callback_data=callback)]])
 
 
+@functools.lru_cache(maxsize=None)
 def get_agent_panel_kb():
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🚫 Заблокировать по ID", callback_data="agent_ban_by_id")],
-        [InlineKeyboardButton("✅ Разблокировать по ID", callback_data="agent_unban_by_id")],
-        [InlineKeyboardButton("📋 Обращения пользователя", callback_data="agent_view_tickets")],
-        [InlineKeyboardButton("✉️ Написать пользователю", callback_data="agent_send_msg")]
+        [InlineKeyboardButton("🚫 Заблокировать по ID", callback_data=pack_callback("ab"))],
+        [InlineKeyboardButton("✅ Разблокировать по ID", callback_data=pack_callback("au"))],
+        [InlineKeyboardButton("📋 Обращения пользователя", callback_data=pack_callback("av"))],
+        [InlineKeyboardButton("✉️ Написать пользователю", callback_data=pack_callback("am"))]
     ])
 
 
+@functools.lru_cache(maxsize=None)
 def get_start_kb():
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("⚠️ Жалоба на агента", callback_data="create_complaint")]
+        [InlineKeyboardButton("⚠️ Жалоба на агента", callback_data=pack_callback("cc"))]
     ])
 
 
 # --- ХЕНДЛЕРЫ ---
+async def fan_out(*calls):
+    """Выполняет вызовы Bot API одновременно; список корутин в calls — цепочка, идущая по порядку"""
+    async def run(chain):
+        steps = list(chain) if isinstance(chain, (list, tuple)) else [chain]
+        for i, step in enumerate(steps):
+            try:
+                await step
+            except Exception as e:
+                # Ошибка не мешает другим цепочкам, но остаток своей не выполняется
+                logger.warning(f"Side effect {step.__qualname__} failed: {e}")
+                for rest in steps[i + 1:]:
+                    rest.close()
+                return
+
+    await asyncio.gather(*(run(chain) for chain in calls))
+
+
+async def notify_user(context: ContextTypes.DEFAULT_TYPE, uid, text, what):
+    """Уведомление пользователя; если бот заблокирован — только запись в лог"""
+    try:
+        await context.bot.send_message(int(uid), text)
+    except Exception as e:
+        logger.info(f"Could not notify user {uid} of {what}: {e}")
+
+
+def resolve_user_id(text):
+    """ID пользователя из ввода: число или @username из базы; None, если не найден"""
+    text = text.strip()
+    if text.isdigit():
+        return text
+    return db.find_user_id(text) if text else None
+
+
+@timed("start")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type != ChatType.PRIVATE: return
     user = update.effective_user
@@ -297,877 +2566,1051 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@timed("admin")
 async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin с кнопками управления"""
     if update.effective_user.id != OWNER_ID: return
     await update.message.reply_text("🛠 <b>Панель управления</b>", parse_mode="HTML", reply_markup=get_owner_kb())
 
 
+@timed("panel")
 async def panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Панель агента"""
     if update.effective_chat.id != SUPPORT_CHAT_ID: return
     user_id = str(update.effective_user.id)
-    if user_id in db.data.get("agents", {}) or update.effective_user.id == OWNER_ID:
+    if db.is_agent(user_id) or update.effective_user.id == OWNER_ID:
         await update.message.reply_text("<b>Панель агента</b>", parse_mode="HTML", reply_markup=get_agent_panel_kb())
 
 
+@timed("handle_msg")
 async def handle_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
     uid_str = str(user.id)
 
     # Проверка бана
-    if chat.type == ChatType.PRIVATE and user.id in db.data.get("banned", []):
+    if chat.type == ChatType.PRIVATE and db.is_banned(user.id):
+        branch("banned")
         await update.message.reply_text("🔑 Вы заблокированы в поддержке.")
         return
 
     # --- Обработка сообщений в чате поддержки ---
     if chat.id == SUPPORT_CHAT_ID:
         agent_id = str(update.effective_user.id)
-        is_agent = agent_id in db.data.get("agents", {})
-        is_owner = update.effective_user.id == OWNER_ID
-
-        # Обработка рассылки
-        if is_owner and context.user_data.get('waiting_broadcast'):
-            broadcast_text = update.message.text
-            all_users = db.get_all_user_ids()
-            total_users = len(all_users)
-
-            if total_users == 0:
-                await update.message.reply_text("❌ В базе нет пользователей для рассылки.")
-                context.user_data.pop('waiting_broadcast', None)
-                return
+        is_agent = db.is_agent(agent_id)
+
+        # Ожидаемый ввод: одна проверка состояния, обычные ответы агентов идут сразу в маршрутизацию
+        entry = INPUT_HANDLERS.get(context.user_data.get("state"))
+        if entry and update.message.text and access_level(user.id) >= entry[1]:
+            state, data = clear_state(update, context)
+            branch(f"input:{state}")
+            await entry[0](update, context, **data)
+            return
 
-            status_msg = await update.message.reply_text(
-                f"📣 Начинаю массовую рассылку...\n"
-                f"👥 Всего пользователей: {total_users}\n\n"
-                f"Пожалуйста, подождите..."
-            )
+        # Если сообщение в теме обращения - пересылаем пользователю
+        branch("support_chat")
+        thread_id = update.message.message_thread_id
+        if thread_id:
+            found = db.find_thread(thread_id)
+            target_uid = found[1] if found else None
+
+            if target_uid:
+                branch("relay_to_user")
 
-            success_count = 0
-            fail_count = 0
-            message_to_send = f"📣 <b>Сообщение от администрации:</b>\n\n{broadcast_text}"
+                def relayed(error):
+                    # Альбом считается одним ответом агента
+                    if error is not None:
+                        logger.error(f"Failed to forward message to {target_uid}: {error}")
+                    elif is_agent:
+                        db.add_agent_stat(agent_id, "replies")
 
-            for user_id in all_users:
-                try:
-                    await context.bot.send_message(
-                        chat_id=int(user_id),
-                        text=message_to_send,
-                        parse_mode="HTML"
+                await relay_message(context.bot, update.message, int(target_uid), on_done=relayed)
+
+    # Создание обращения или пересылка сообщения
+    elif chat.type == ChatType.PRIVATE:
+        # Если пользователь в режиме жалобы
+        if context.user_data.get("state") == "complaint":
+            branch("complaint_relay")
+            # Сообщение уходит в жалобу при любом исходе: и в новую, и в уже открытую
+            clear_state(update, context)
+            async with ticket_locks.hold(("complaints", uid_str)):
+                complaint = db.get_ticket(uid_str, kind="complaints")
+                if not complaint or complaint.get("status") == "closed":
+                    branch("complaint_new")
+                    topic_name = (f"[Agent] {user.id} | @{user.username}" if user.username
+                                  else f"[Agent] {user.id} | {user.first_name}")
+                    topic = await context.bot.create_forum_topic(chat_id=SUPPORT_CHAT_ID, name=topic_name)
+
+                    sent_msg = await context.bot.send_message(
+                        SUPPORT_CHAT_ID,
+                        message_thread_id=topic.message_thread_id,
+                        text=f"⚠️ <b>Новая жалоба на агента</b>\nID: <code>{user.id}</code>\nЮзер: @{user.username}",
+                        parse_mode="HTML",
+                        reply_markup=get_admin_kb(uid_str, is_complaint=True)
                     )
-                    success_count += 1
-                except Exception as e:
-                    fail_count += 1
-                    logger.warning(f"Failed to send broadcast to {user_id}: {e}")
-
-            await status_msg.edit_text(
-                f"✅ <b>Рассылка завершена!</b>\n\n"
-                f"👥 Всего пользователей: {total_users}\n"
-                f"✅ Доставлено: {success_count}\n"
-                f"❌ Ошибок: {fail_count}",
-                parse_mode="HTML"
-            )
 
-            sender_username = db.data.get("user_metadata", {}).get(str(OWNER_ID), {}).get("username", "Неизвестно")
-            await send_log(context, "broadcast_sent", {
-                "sender_id": str(OWNER_ID),
-                "sender_username": sender_username,
-                "total_users": total_users,
-                "success_count": success_count,
-                "fail_count": fail_count,
-                "message": broadcast_text
-            })
+                    db.open_ticket(uid_str, topic.message_thread_id, sent_msg.message_id, kind="complaints")
+                    await update.message.reply_text("✅ Ваша жалоба создана.",
+                                                    reply_markup=get_user_close_kb(is_complaint=True))
 
-            # Сохраняем лог рассылки в БД
-            db.add_broadcast_log({
-                "timestamp": datetime.now().strftime("%d.%m.%Y %H:%M:%S"),
-                "sender_id": str(OWNER_ID),
-                "sender_username": sender_username,
-                "total_users": total_users,
-                "success": success_count,
-                "failed": fail_count,
-                "message": broadcast_text[:100] + "..." if len(broadcast_text) > 100 else broadcast_text
-            })
+                    # Лог создания жалобы
+                    await send_log(context, "complaint_created", {
+                        "user_id": user.id,
+                        "username": user.username or "Неизвестно"
+                    })
 
-            context.user_data.pop('waiting_broadcast', None)
-            return
+            await relay_message(context.bot, update.message, SUPPORT_CHAT_ID,
+                                db.get_ticket(uid_str, kind="complaints")["thread_id"])
+        else:
+            # Обычное обращение
+            branch("ticket_relay")
+            async with ticket_locks.hold(("tickets", uid_str)):
+                ticket = db.get_ticket(uid_str)
+                if not ticket or ticket.get("status") == "closed":
+                    branch("ticket_new")
+                    db.increment_ticket(user.id)
+                    topic_name = f"{user.id} | @{user.username}" if user.username else f"{user.id} | {user.first_name}"
+                    topic = await context.bot.create_forum_topic(chat_id=SUPPORT_CHAT_ID, name=topic_name)
+
+                    sent_msg = await context.bot.send_message(
+                        SUPPORT_CHAT_ID,
+                        message_thread_id=topic.message_thread_id,
+                        text=f"🆕 <b>Новое обращение</b>\nID: <code>{user.id}</code>\nЮзер: @{user.username}",
+                        parse_mode="HTML",
+                        reply_markup=get_admin_kb(uid_str)
+                    )
 
-        # Обработка ввода ID для отправки сообщения (Owner)
-        if is_owner and context.user_data.get('waiting_msg_id'):
-            target_user_id = update.message.text.strip()
-            if target_user_id.isdigit():
-                context.user_data['msg_target_user'] = target_user_id
-                context.user_data['waiting_msg_text'] = True
-                context.user_data.pop('waiting_msg_id', None)
-                await update.message.reply_text("✉️ Теперь введите текст сообщения:")
-            else:
-                await update.message.reply_text("❌ ID должен быть числом. Попробуйте снова:")
-            return
+                    db.open_ticket(uid_str, topic.message_thread_id, sent_msg.message_id)
+                    await update.message.reply_text("✅ Ваше обращение создано.", reply_markup=get_user_close_kb())
 
-        # Обработка отправки сообщения пользователю (Owner)
-        if is_owner and context.user_data.get('waiting_msg_text'):
-            target_user_id = context.user_data.get('msg_target_user')
-            message_text = update.message.text
+                    # Лог создания тикета
+                    await send_log(context, "ticket_created", {
+                        "user_id": user.id,
+                        "username": user.username or "Неизвестно"
+                    })
 
-            full_message = f"💬 <b>Сообщение от Owner:</b>\n\n{message_text}"
+            await relay_message(context.bot, update.message, SUPPORT_CHAT_ID, db.get_ticket(uid_str)["thread_id"])
 
-            try:
-                await context.bot.send_message(
-                    chat_id=int(target_user_id),
-                    text=full_message,
-                    parse_mode="HTML"
-                )
 
-                await update.message.reply_text(
-                    f"✅ Сообщение успешно отправлено пользователю {target_user_id}"
-                )
+# --- Ожидаемый ввод в чате поддержки; состояние уже снято, повторный запрос ставит его заново ---
+@prompt("broadcast", ACCESS_OWNER)
+async def input_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    broadcast_text = update.message.text
+    all_users = db.get_all_user_ids()
+    total_users = len(all_users)
 
-                sender_username = db.data.get("user_metadata", {}).get(str(OWNER_ID), {}).get("username", "Неизвестно")
-                target_username = db.data.get("user_metadata", {}).get(target_user_id, {}).get("username", "Неизвестно")
+    if total_users == 0:
+        await update.message.reply_text("❌ В базе нет пользователей для рассылки.")
+        return
 
-                await send_log(context, "agent_message_sent", {
-                    "agent_id": str(OWNER_ID),
-                    "agent_num": "Owner",
-                    "agent_username": sender_username,
-                    "user_id": target_user_id,
-                    "username": target_username,
-                    "message": message_text
-                })
+    if db.get_broadcast_job():
+        await update.message.reply_text("⚠️ Уже есть незавершённая рассылка. Дождитесь её или отмените.")
+        return
 
-            except Exception as e:
-                logger.error(f"Failed to send message to user {target_user_id}: {e}")
-                await update.message.reply_text(
-                    f"❌ Не удалось отправить сообщение пользователю {target_user_id}"
-                )
+    status_msg = await update.message.reply_text(
+        f"📣 Начинаю массовую рассылку...\n"
+        f"👥 Всего пользователей: {total_users}\n\n"
+        f"Рассылка идёт в фоне, прогресс будет обновляться здесь.",
+        reply_markup=get_broadcast_kb("running")
+    )
 
-            context.user_data.pop('waiting_msg_text', None)
-            context.user_data.pop('msg_target_user', None)
-            return
+    db.save_broadcast_job({
+        "state": "running",
+        "text": f"📣 <b>Сообщение от администрации:</b>\n\n{broadcast_text}",
+        "message": broadcast_text,
+        "sender_username": db.get_username(str(OWNER_ID)),
+        "total": total_users,
+        "cursor": None,
+        "success": 0,
+        "failed": 0,
+        "errors": {},
+        "chat_id": status_msg.chat_id,
+        "message_id": status_msg.message_id
+    })
+    schedule_broadcast(context.job_queue)
+
+
+# Поиск в каталоге пользователей по началу username (Owner)
+@prompt("user_search", ACCESS_OWNER)
+async def input_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Оставляем только символы, допустимые в username: они же безопасны для HTML и callback_data
+    prefix = re.sub(r"[^A-Za-z0-9_]", "", update.message.text)[:32]
+    if not prefix:
+        set_state(update, context, "user_search")
+        await update.message.reply_text("❌ Введите хотя бы один символ username. Попробуйте снова:")
+        return
+    res, markup = render_users_page("n", prefix=prefix)
+    await update.message.reply_text(res, parse_mode="HTML", reply_markup=markup)
 
-        # Обработка ввода ID для отправки сообщения (Agent)
-        if is_agent and context.user_data.get('waiting_agent_msg_id'):
-            target_user_id = update.message.text.strip()
-            if target_user_id.isdigit():
-                context.user_data['agent_msg_target_user'] = target_user_id
-                context.user_data['waiting_agent_msg_text'] = True
-                context.user_data.pop('waiting_agent_msg_id', None)
-                await update.message.reply_text("✉️ Теперь введите текст сообщения:")
-            else:
-                await update.message.reply_text("❌ ID должен быть числом. Попробуйте снова:")
-            return
 
-        # Обработка отправки сообщения пользователю (Agent)
-        if is_agent and context.user_data.get('waiting_agent_msg_text'):
-            target_user_id = context.user_data.get('agent_msg_target_user')
-            message_text = update.message.text
-            agent_num = db.data["agents"][agent_id]["num"]
+# Ввод получателя сообщения (Owner и агенты)
+@prompt("msg_target", ACCESS_STAFF)
+async def input_msg_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    target_user_id = resolve_user_id(update.message.text)
+    if target_user_id:
+        set_state(update, context, "msg_text", target=target_user_id)
+        await update.message.reply_text("✉️ Теперь введите текст сообщения:")
+    else:
+        set_state(update, context, "msg_target")
+        await update.message.reply_text("❌ Пользователь не найден. Введите ID или @username:")
 
-            full_message = f"💬 <b>Сообщение от агента #{agent_num}:</b>\n\n{message_text}"
 
-            try:
-                await context.bot.send_message(
-                    chat_id=int(target_user_id),
-                    text=full_message,
-                    parse_mode="HTML"
-                )
+# Отправка сообщения пользователю от Owner или агента
+@prompt("msg_text", ACCESS_STAFF)
+async def input_msg_text(update: Update, context: ContextTypes.DEFAULT_TYPE, target):
+    agent_id = str(update.effective_user.id)
+    message_text = update.message.text
 
-                await update.message.reply_text(
-                    f"✅ Сообщение успешно отправлено пользователю {target_user_id}\n"
-                    f"От: Агент #{agent_num}"
-                )
+    if update.effective_user.id == OWNER_ID:
+        agent_id, agent_num = str(OWNER_ID), "Owner"
+        full_message = f"💬 <b>Сообщение от Owner:</b>\n\n{message_text}"
+        done_text = f"✅ Сообщение успешно отправлено пользователю {target}"
+    else:
+        agent_num = db.get_agent(agent_id)["num"]
+        full_message = f"💬 <b>Сообщение от агента #{agent_num}:</b>\n\n{message_text}"
+        done_text = f"✅ Сообщение успешно отправлено пользователю {target}\nОт: Агент #{agent_num}"
 
-                agent_username = db.data.get("user_metadata", {}).get(agent_id, {}).get("username", "Неизвестно")
-                target_username = db.data.get("user_metadata", {}).get(target_user_id, {}).get("username", "Неизвестно")
+    try:
+        await context.bot.send_message(
+            chat_id=int(target),
+            text=full_message,
+            parse_mode="HTML"
+        )
 
-                await send_log(context, "agent_message_sent", {
-                    "agent_id": agent_id,
-                    "agent_num": agent_num,
-                    "agent_username": agent_username,
-                    "user_id": target_user_id,
-                    "username": target_username,
-                    "message": message_text
-                })
+        await update.message.reply_text(done_text)
 
-            except Exception as e:
-                logger.error(f"Failed to send message to user {target_user_id}: {e}")
-                await update.message.reply_text(
-                    f"❌ Не удалось отправить сообщение пользователю {target_user_id}"
-                )
+        agent_username = db.get_username(agent_id)
+        target_username = db.get_username(target)
 
-            context.user_data.pop('waiting_agent_msg_text', None)
-            context.user_data.pop('agent_msg_target_user', None)
-            return
+        await send_log(context, "agent_message_sent", {
+            "agent_id": agent_id,
+            "agent_num": agent_num,
+            "agent_username": agent_username,
+            "user_id": target,
+            "username": target_username,
+            "message": message_text
+        })
 
-        # Добавление агента владельцем
-        if is_owner and context.user_data.get('waiting_agent'):
-            agent_id_to_add = update.message.text.strip()
-            if agent_id_to_add.isdigit():
-                num = len(db.data["agents"]) + 1
-                db.data["agents"][agent_id_to_add] = {"num": num, "replies": 0, "bans": 0}
-                db.save()
+    except Exception as e:
+        logger.error(f"Failed to send message to user {target}: {e}")
+        await update.message.reply_text(
+            f"❌ Не удалось отправить сообщение пользователю {target}"
+        )
 
-                # Регистрируем пользователя, чтобы получить его username
-                try:
-                    target_user = await context.bot.get_chat(int(agent_id_to_add))
-                    db.register_user(target_user)
-                    username = target_user.username or "Неизвестно"
-                except Exception as e:
-                    username = "Неизвестно"
-                    logger.warning(f"Could not fetch user {agent_id_to_add}: {e}")
 
-                await update.message.reply_text(f"✅ Агент #{num} добавлен.")
+# Добавление агента владельцем
+@prompt("add_agent", ACCESS_OWNER)
+async def input_add_agent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    agent_id_to_add = resolve_user_id(update.message.text)
+    if not agent_id_to_add:
+        set_state(update, context, "add_agent")
+        await update.message.reply_text("❌ Пользователь не найден. Введите ID или @username:")
+        return
 
-                # Лог добавления агента
-                await send_log(context, "agent_assigned", {
-                    "user_id": agent_id_to_add,
-                    "username": username,
-                    "agent_num": num
-                })
+    num = db.add_agent(agent_id_to_add)
 
-                context.user_data.pop('waiting_agent', None)
-            else:
-                await update.message.reply_text("❌ ID должен быть числом.")
-            return
+    # Регистрируем пользователя, чтобы получить его username
+    try:
+        target_user = await context.bot.get_chat(int(agent_id_to_add))
+        db.register_user(target_user)
+        username = target_user.username or "Неизвестно"
+    except Exception as e:
+        username = "Неизвестно"
+        logger.warning(f"Could not fetch user {agent_id_to_add}: {e}")
+
+    await update.message.reply_text(f"✅ Агент #{num} добавлен.")
+
+    # Лог добавления агента
+    await send_log(context, "agent_assigned", {
+        "user_id": agent_id_to_add,
+        "username": username,
+        "agent_num": num
+    })
+
+
+# Удаление агента
+@prompt("remove_agent", ACCESS_OWNER)
+async def input_remove_agent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    agent_id_to_remove = resolve_user_id(update.message.text)
+    agent = db.get_agent(agent_id_to_remove) if agent_id_to_remove else None
+    if not agent:
+        set_state(update, context, "remove_agent")
+        await update.message.reply_text("❌ Пользователь не является агентом.")
+        return
 
-        # Удаление агента
-        if is_owner and context.user_data.get('waiting_remove_agent'):
-            agent_id_to_remove = update.message.text.strip()
-            if agent_id_to_remove in db.data["agents"]:
-                agent_num = db.data["agents"][agent_id_to_remove]["num"]
-                username = db.data.get("user_metadata", {}).get(agent_id_to_remove, {}).get("username", "Неизвестно")
-
-                db.data["agents"].pop(agent_id_to_remove)
-                db.save()
-                await update.message.reply_text(f"✅ Агент #{agent_num} удалён.")
-
-                # Лог удаления агента
-                await send_log(context, "agent_removed", {
-                    "user_id": agent_id_to_remove,
-                    "username": username,
-                    "agent_num": agent_num
-                })
+    agent_num = agent["num"]
+    username = db.get_username(agent_id_to_remove)
 
-                context.user_data.pop('waiting_remove_agent', None)
-            else:
-                await update.message.reply_text("❌ Пользователь не является агентом.")
-            return
+    db.remove_agent(agent_id_to_remove)
+    await update.message.reply_text(f"✅ Агент #{agent_num} удалён.")
 
-        # Разбан по ID
-        if context.user_data.get('waiting_unban_id'):
-            target_uid = update.message.text.strip()
-            if not target_uid.isdigit():
-                await update.message.reply_text("❌ ID должен быть числом.")
-                return
+    # Лог удаления агента
+    await send_log(context, "agent_removed", {
+        "user_id": agent_id_to_remove,
+        "username": username,
+        "agent_num": agent_num
+    })
 
-            if int(target_uid) not in db.data["banned"]:
-                await update.message.reply_text("⚠️ Пользователь не заблокирован.")
-                return
 
-            # Разбан пользователя
-            db.data["banned"].remove(int(target_uid))
-            db.data["ban_reasons"].pop(target_uid, None)
-            db.save()
+# Бан по ID или @username: дальше обычный ввод причины
+@prompt("ban_target", ACCESS_STAFF)
+async def input_ban_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    target_uid = resolve_user_id(update.message.text)
+    if not target_uid:
+        set_state(update, context, "ban_target")
+        await update.message.reply_text("❌ Пользователь не найден. Введите ID или @username:")
+        return
+
+    if db.is_banned(target_uid):
+        await update.message.reply_text("⚠️ Пользователь уже заблокирован.")
+        return
+
+    set_state(update, context, "ban_reason", target=target_uid)
+    await update.message.reply_text("📝 Введите причину бана:")
+
+
+# Ввод причины бана; msg_id — сообщение с кнопкой, если бан был через неё
+@prompt("ban_reason", ACCESS_STAFF)
+async def input_ban_reason(update: Update, context: ContextTypes.DEFAULT_TYPE, target, msg_id=None):
+    reason = update.message.text.strip()
+    target_uid = target
+    agent_id = str(update.effective_user.id)
+    is_agent = db.is_agent(agent_id)
 
-            # Определяем агента
-            agent_db_id = agent_id if is_agent else str(OWNER_ID)
-            agent_num = db.data["agents"][agent_id]["num"] if is_agent else "Owner"
-            agent_display_name = f"Агент #{agent_num}" if is_agent else "Owner"
-            agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
+    # Определяем агента
+    agent_db_id = agent_id if is_agent else str(OWNER_ID)
+    agent_num = db.get_agent(agent_id)["num"] if is_agent else "Owner"
+    agent_display_name = f"Агент #{agent_num}" if is_agent else "Owner"
+    agent_username = db.get_username(agent_db_id)
 
-            # Получаем username разблокированного пользователя
-            username = db.data.get("user_metadata", {}).get(target_uid, {}).get("username", "Неизвестно")
+    # Получаем username забаненного пользователя
+    username = db.get_username(target_uid)
 
-            # Уведомление пользователя о разбане
+    # Бан пользователя
+    db.ban_user(target_uid, reason, agent_num)
+
+    # Увеличиваем счетчик банов агента
+    if is_agent:
+        db.add_agent_stat(agent_id, "bans")
+
+    # Уведомление пользователя
+    try:
+        await context.bot.send_message(
+            int(target_uid),
+            f"🔑 Вы заблокированы агентом #{agent_num}.\n📝 Причина: {reason}"
+        )
+    except Exception as e:
+        logger.info(f"Could not notify user {target_uid} of ban: {e}")
+
+    await update.message.reply_text(f"🔑 Пользователь {target_uid} заблокирован {agent_display_name}.")
+
+    # Лог бана
+    await send_log(context, "user_banned", {
+        "user_id": target_uid,
+        "username": username,
+        "agent_num": agent_num,
+        "agent_username": agent_username,
+        "agent_id": agent_db_id,
+        "reason": reason
+    })
+
+    # Обновить клавиатуру в тикете, если бан был через кнопку
+    if msg_id:
+        ticket = db.get_ticket(target_uid)
+        if ticket and ticket.get("admin_msg_id"):
             try:
-                await context.bot.send_message(
-                    int(target_uid),
-                    f"✅ Вы были разблокированы агентом #{agent_num}.\nТеперь вы можете снова обращаться в поддержку."
+                await context.bot.edit_message_reply_markup(
+                    SUPPORT_CHAT_ID, ticket["admin_msg_id"], reply_markup=get_admin_kb(target_uid)
                 )
             except Exception as e:
-                logger.info(f"Could not notify user {target_uid} of unban: {e}")
+                logger.error(f"Failed to update ban button for {target_uid}: {e}")
 
-            await update.message.reply_text(f"✅ Пользователь {target_uid} разблокирован {agent_display_name}.")
 
-            # Лог разбана
-            await send_log(context, "user_unbanned", {
-                "user_id": target_uid,
-                "username": username,
-                "agent_num": agent_num,
-                "agent_username": agent_username,
-                "agent_id": agent_db_id
-            })
+# Разбан по ID
+@prompt("unban_target", ACCESS_STAFF)
+async def input_unban_target(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    target_uid = resolve_user_id(update.message.text)
+    if not target_uid:
+        set_state(update, context, "unban_target")
+        await update.message.reply_text("❌ Пользователь не найден. Введите ID или @username:")
+        return
 
-            context.user_data.pop('waiting_unban_id', None)
+    if not db.is_banned(target_uid):
+        await update.message.reply_text("⚠️ Пользователь не заблокирован.")
+        return
 
-            # Обновить клавиатуру в тикете
-            ticket = db.data.get("tickets", {}).get(target_uid)
-            if ticket and ticket.get("admin_msg_id"):
-                try:
-                    await context.bot.edit_message_reply_markup(
-                        SUPPORT_CHAT_ID, ticket["admin_msg_id"], reply_markup=get_admin_kb(target_uid)
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to update unban button for {target_uid}: {e}")
-            return
+    # Разбан пользователя
+    db.unban_user(target_uid)
 
-        # Ввод причины бана
-        if context.user_data.get('waiting_ban_reason'):
-            reason = update.message.text.strip()
-            target_uid = context.user_data.get('ban_target')
+    # Определяем агента
+    agent_id = str(update.effective_user.id)
+    is_agent = db.is_agent(agent_id)
+    agent_db_id = agent_id if is_agent else str(OWNER_ID)
+    agent_num = db.get_agent(agent_id)["num"] if is_agent else "Owner"
+    agent_display_name = f"Агент #{agent_num}" if is_agent else "Owner"
+    agent_username = db.get_username(agent_db_id)
 
-            # Определяем агента
-            agent_db_id = agent_id if is_agent else str(OWNER_ID)
-            agent_num = db.data["agents"][agent_id]["num"] if is_agent else "Owner"
-            agent_display_name = f"Агент #{agent_num}" if is_agent else "Owner"
-            agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
+    # Получаем username разблокированного пользователя
+    username = db.get_username(target_uid)
 
-            # Получаем username забаненного пользователя
-            username = db.data.get("user_metadata", {}).get(target_uid, {}).get("username", "Неизвестно")
+    # Уведомление пользователя о разбане
+    try:
+        await context.bot.send_message(
+            int(target_uid),
+            f"✅ Вы были разблокированы агентом #{agent_num}.\nТеперь вы можете снова обращаться в поддержку."
+        )
+    except Exception as e:
+        logger.info(f"Could not notify user {target_uid} of unban: {e}")
+
+    await update.message.reply_text(f"✅ Пользователь {target_uid} разблокирован {agent_display_name}.")
+
+    # Лог разбана
+    await send_log(context, "user_unbanned", {
+        "user_id": target_uid,
+        "username": username,
+        "agent_num": agent_num,
+        "agent_username": agent_username,
+        "agent_id": agent_db_id
+    })
+
+    # Обновить клавиатуру в тикете
+    ticket = db.get_ticket(target_uid)
+    if ticket and ticket.get("admin_msg_id"):
+        try:
+            await context.bot.edit_message_reply_markup(
+                SUPPORT_CHAT_ID, ticket["admin_msg_id"], reply_markup=get_admin_kb(target_uid)
+            )
+        except Exception as e:
+            logger.error(f"Failed to update unban button for {target_uid}: {e}")
 
-            # Бан пользователя
-            db.data["banned"].append(int(target_uid))
-            db.data["ban_reasons"][str(target_uid)] = {"reason": reason, "agent_num": agent_num}
 
-            # Увеличиваем счетчик банов агента
-            if is_agent:
-                db.data["agents"][agent_id]["bans"] += 1
+# Просмотр тикетов пользователя
+@prompt("view_tickets", ACCESS_STAFF)
+async def input_view_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    target_uid = resolve_user_id(update.message.text)
+    if not target_uid:
+        set_state(update, context, "view_tickets")
+        await update.message.reply_text("❌ Пользователь не найден. Введите ID или @username:")
+        return
 
-            db.save()
+    user_data = db.get_user(target_uid)
+    if not user_data:
+        await update.message.reply_text("⚠️ Пользователь не найден.")
+        return
 
-            # Уведомление пользователя
-            try:
-                await context.bot.send_message(
-                    int(target_uid),
-                    f"🔑 Вы заблокированы агентом #{agent_num}.\n📝 Причина: {reason}"
-                )
-            except Exception as e:
-                logger.info(f"Could not notify user {target_uid} of ban: {e}")
+    ticket_count = user_data.get('ticket_count', 0)
+    username = user_data.get('username', 'Неизвестно')
+    is_banned = db.is_banned(target_uid)
+    status = "🔴 BANNED" if is_banned else "✅ Active"
+
+    result = (
+        f"📋 <b>Информация о пользователе</b>\n\n"
+        f"ID: <code>{target_uid}</code>\n"
+        f"Username: @{username}\n"
+        f"Статус: {status}\n"
+        f"Всего обращений: {ticket_count}"
+    )
+    await update.message.reply_text(result, parse_mode="HTML")
 
-            await update.message.reply_text(f"🔑 Пользователь {target_uid} заблокирован {agent_display_name}.")
 
-            # Лог бана
-            await send_log(context, "user_banned", {
-                "user_id": target_uid,
-                "username": username,
-                "agent_num": agent_num,
-                "agent_username": agent_username,
-                "agent_id": agent_db_id,
-                "reason": reason
+@timed("button_handler")
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    code, args = unpack_callback(query.data)
+    entry = CALLBACK_HANDLERS.get(code)
+    branch(code if entry else "stale")
+    if entry is None:
+        await query.answer("Кнопка устарела.", show_alert=True)
+        return
+
+    # Права проверяются один раз по уровню, объявленному при регистрации
+    handler, access, denied = entry
+    if access > ACCESS_USER and access_level(query.from_user.id) < access:
+        await query.answer(denied, show_alert=True)
+        return
+
+    await query.answer()
+    await handler(update, context, *args)
+
+
+# --- Кнопки пользователя ---
+@callback("cc")
+async def cb_create_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "complaint")
+    await update.callback_query.edit_message_text("⚠️ Опишите вашу жалобу на агента.")
+
+
+@callback("uct")
+async def cb_user_close_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid_str = str(query.from_user.id)
+    ticket = db.get_ticket(uid_str)
+    if ticket and ticket["status"] == "open":
+        db.close_ticket(uid_str)
+
+        username = db.get_username(uid_str)
+
+        calls = [
+            query.edit_message_text("🔴 Вы закрыли обращение."),
+            # Сообщение в тему — до её закрытия
+            [context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=ticket["thread_id"],
+                                      text="⚪️ Пользователь закрыл обращение."),
+             context.bot.close_forum_topic(SUPPORT_CHAT_ID, ticket["thread_id"])],
+            # Лог закрытия обращения пользователем
+            send_log(context, "ticket_closed_by_user", {
+                "user_id": uid_str,
+                "username": username
             })
+        ]
+        if ticket.get("admin_msg_id"):
+            calls.append(context.bot.edit_message_reply_markup(SUPPORT_CHAT_ID, ticket["admin_msg_id"],
+                                                               reply_markup=get_admin_kb(uid_str, True)))
+        await fan_out(*calls)
 
-            context.user_data.pop('waiting_ban_reason', None)
-            context.user_data.pop('ban_target', None)
 
-            # Обновить клавиатуру в тикете, если бан был через кнопку
-            if context.user_data.pop('ban_msg_id', None):
-                ticket = db.data.get("tickets", {}).get(target_uid)
-                if ticket and ticket.get("admin_msg_id"):
-                    try:
-                        await context.bot.edit_message_reply_markup(
-                            SUPPORT_CHAT_ID, ticket["admin_msg_id"], reply_markup=get_admin_kb(target_uid)
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to update ban button for {target_uid}: {e}")
-            return
+@callback("ucc")
+async def cb_user_close_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid_str = str(query.from_user.id)
+    complaint = db.get_ticket(uid_str, kind="complaints")
+    if complaint and complaint["status"] == "open":
+        db.close_ticket(uid_str, kind="complaints")
+
+        username = db.get_username(uid_str)
+
+        calls = [
+            query.edit_message_text("🔴 Вы закрыли жалобу."),
+            [context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=complaint["thread_id"],
+                                      text="⚪️ Пользователь закрыл жалобу."),
+             context.bot.close_forum_topic(SUPPORT_CHAT_ID, complaint["thread_id"])],
+            # Лог закрытия жалобы пользователем
+            send_log(context, "complaint_closed_by_user", {
+                "user_id": uid_str,
+                "username": username
+            })
+        ]
+        if complaint.get("admin_msg_id"):
+            calls.append(context.bot.edit_message_reply_markup(SUPPORT_CHAT_ID, complaint["admin_msg_id"],
+                                                               reply_markup=get_admin_kb(uid_str, True,
+                                                                                         is_complaint=True)))
+        await fan_out(*calls)
 
-        # Просмотр тикетов пользователя
-        if context.user_data.get('waiting_view_tickets_id'):
-            target_uid = update.message.text.strip()
-            if not target_uid.isdigit():
-                await update.message.reply_text("❌ ID должен быть числом.")
-                return
 
-            user_data = db.data.get("user_metadata", {}).get(target_uid)
-            if not user_data:
-                await update.message.reply_text("⚠️ Пользователь не найден.")
-                return
+# --- Панель агента ---
+@callback("ab", ACCESS_STAFF)
+async def cb_agent_ban_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "ban_target")
+    await update.callback_query.edit_message_text("Введите ID или @username пользователя для блокировки:")
 
-            ticket_count = user_data.get('ticket_count', 0)
-            username = user_data.get('username', 'Неизвестно')
-            is_banned = int(target_uid) in db.data["banned"]
-            status = "🔴 BANNED" if is_banned else "✅ Active"
-
-            result = (
-                f"📋 <b>Информация о пользователе</b>\n\n"
-                f"ID: <code>{target_uid}</code>\n"
-                f"Username: @{username}\n"
-                f"Статус: {status}\n"
-                f"Всего обращений: {ticket_count}"
-            )
-            await update.message.reply_text(result, parse_mode="HTML")
-            context.user_data.pop('waiting_view_tickets_id', None)
-            return
 
-        # Если сообщение в теме обращения - пересылаем пользователю
-        thread_id = update.message.message_thread_id
-        if thread_id:
-            target_uid = None
-            for uid, ticket in db.data.get("tickets", {}).items():
-                if ticket.get("thread_id") == thread_id and ticket.get("status") == "open":
-                    target_uid = uid
-                    break
+@callback("au", ACCESS_STAFF)
+async def cb_agent_unban_by_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "unban_target")
+    await update.callback_query.edit_message_text("Введите ID или @username пользователя для разблокировки:")
 
-            if not target_uid:
-                for uid, complaint in db.data.get("complaints", {}).items():
-                    if complaint.get("thread_id") == thread_id and complaint.get("status") == "open":
-                        target_uid = uid
-                        break
 
-            if target_uid:
-                try:
-                    await context.bot.copy_message(chat_id=int(target_uid), from_chat_id=SUPPORT_CHAT_ID,
-                                                   message_id=update.message.id)
-                    if is_agent:
-                        db.data["agents"][agent_id]["replies"] += 1
-                        db.save()
-                except Exception as e:
-                    logger.error(f"Failed to forward message to {target_uid}: {e}")
+@callback("av", ACCESS_STAFF)
+async def cb_agent_view_tickets(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "view_tickets")
+    await update.callback_query.edit_message_text("Введите ID или @username пользователя для просмотра его обращений:")
 
-    # Создание обращения или пересылка сообщения
-    elif chat.type == ChatType.PRIVATE:
-        # Если пользователь в режиме жалобы
-        if context.user_data.get('complaint_mode'):
-            if uid_str not in db.data["complaints"] or db.data["complaints"][uid_str].get("status") == "closed":
-                topic_name = f"[Agent] {user.id} | @{user.username}" if user.username else f"[Agent] {user.id} | {user.first_name}"
-                topic = await context.bot.create_forum_topic(chat_id=SUPPORT_CHAT_ID, name=topic_name)
-
-                sent_msg = await context.bot.send_message(
-                    SUPPORT_CHAT_ID,
-                    message_thread_id=topic.message_thread_id,
-                    text=f"⚠️ <b>Новая жалоба на агента</b>\nID: <code>{user.id}</code>\nЮзер: @{user.username}",
-                    parse_mode="HTML",
-                    reply_markup=get_admin_kb(uid_str, is_complaint=True)
-                )
 
-                db.data["complaints"][uid_str] = {
-                    "thread_id": topic.message_thread_id,
-                    "status": "open",
-                    "admin_msg_id": sent_msg.message_id
-                }
-                db.save()
-                await update.message.reply_text("✅ Ваша жалоба создана.",
-                                                reply_markup=get_user_close_kb(is_complaint=True))
-
-                # Лог создания жалобы
-                await send_log(context, "complaint_created", {
-                    "user_id": user.id,
-                    "username": user.username or "Неизвестно"
-                })
+@callback("am", ACCESS_STAFF)
+async def cb_agent_send_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "msg_target")
+    await update.callback_query.edit_message_text("✉️ Введите ID или @username пользователя для отправки сообщения:")
 
-                context.user_data['complaint_mode'] = False
 
-            await context.bot.copy_message(
-                chat_id=SUPPORT_CHAT_ID,
-                message_thread_id=db.data["complaints"][uid_str]["thread_id"],
-                from_chat_id=user.id,
-                message_id=update.message.id
-            )
-        else:
-            # Обычное обращение
-            if uid_str not in db.data["tickets"] or db.data["tickets"][uid_str].get("status") == "closed":
-                db.increment_ticket(user.id)
-                topic_name = f"{user.id} | @{user.username}" if user.username else f"{user.id} | {user.first_name}"
-                topic = await context.bot.create_forum_topic(chat_id=SUPPORT_CHAT_ID, name=topic_name)
-
-                sent_msg = await context.bot.send_message(
-                    SUPPORT_CHAT_ID,
-                    message_thread_id=topic.message_thread_id,
-                    text=f"🆕 <b>Новое обращение</b>\nID: <code>{user.id}</code>\nЮзер: @{user.username}",
-                    parse_mode="HTML",
-                    reply_markup=get_admin_kb(uid_str)
-                )
+# --- Панель владельца ---
+@callback("bc", ACCESS_OWNER)
+async def cb_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "broadcast")
+    await update.callback_query.message.reply_text("📣 Введите текст для массовой рассылки всем пользователям:")
 
-                db.data["tickets"][uid_str] = {
-                    "thread_id": topic.message_thread_id,
-                    "status": "open",
-                    "admin_msg_id": sent_msg.message_id
-                }
-                db.save()
-                await update.message.reply_text("✅ Ваше обращение создано.", reply_markup=get_user_close_kb())
-
-                # Лог создания тикета
-                await send_log(context, "ticket_created", {
-                    "user_id": user.id,
-                    "username": user.username or "Неизвестно"
-                })
 
-            await context.bot.copy_message(
-                chat_id=SUPPORT_CHAT_ID,
-                message_thread_id=db.data["tickets"][uid_str]["thread_id"],
-                from_chat_id=user.id,
-                message_id=update.message.id
-            )
+async def current_broadcast_job(query):
+    """Сохранённая задача рассылки или None с ответом владельцу"""
+    job = db.get_broadcast_job()
+    if not job:
+        await query.message.reply_text("📣 Активной рассылки нет.")
+    return job
 
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    user_id = query.from_user.id
-    uid_str = str(user_id)
-    data = query.data
-    await query.answer()
+@callback("bp", ACCESS_OWNER)
+async def cb_broadcast_pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job = await current_broadcast_job(update.callback_query)
+    if job and job["state"] == "running":
+        # Задача остановится после текущей порции и сама обновит статус
+        job["state"] = "paused"
+        db.save_broadcast_job(job)
+        if not broadcast_running:
+            await update_broadcast_status(context.bot, job, "⏸ <b>Рассылка на паузе</b>", get_broadcast_kb("paused"))
+
+
+@callback("br", ACCESS_OWNER)
+async def cb_broadcast_resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job = await current_broadcast_job(update.callback_query)
+    if job and job["state"] == "paused":
+        job["state"] = "running"
+        db.save_broadcast_job(job)
+        schedule_broadcast(context.job_queue)
+        await update_broadcast_status(context.bot, job, "📣 <b>Идёт рассылка...</b>", get_broadcast_kb("running"))
+
 
-    # Создание жалобы
-    if data == "create_complaint":
-        context.user_data['complaint_mode'] = True
-        await query.edit_message_text("⚠️ Опишите вашу жалобу на агента.")
+@callback("bx", ACCESS_OWNER)
+async def cb_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    job = await current_broadcast_job(update.callback_query)
+    if not job:
         return
+    if broadcast_running:
+        job["state"] = "cancelled"
+        db.save_broadcast_job(job)
+    else:
+        await finish_broadcast(context, job, cancelled=True)
 
-    # Закрытие пользователем обращения
-    if data == "user_close_self":
-        ticket = db.data["tickets"].get(uid_str)
-        if ticket and ticket["status"] == "open":
-            db.data["tickets"][uid_str]["status"] = "closed"
-            db.data["active_chats"].pop(uid_str, None)
-            db.save()
 
-            username = db.data.get("user_metadata", {}).get(uid_str, {}).get("username", "Неизвестно")
+@callback("bs", ACCESS_OWNER)
+async def cb_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    job = await current_broadcast_job(query)
+    if job:
+        header = "⏸ <b>Рассылка на паузе</b>" if job["state"] == "paused" else "📣 <b>Идёт рассылка...</b>"
+        await query.message.reply_text(broadcast_status_text(job, header), parse_mode="HTML",
+                                       reply_markup=get_broadcast_kb(job["state"]))
 
-            await query.edit_message_text("🔴 Вы закрыли обращение.")
-            await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=ticket["thread_id"],
-                                           text="⚪️ Пользователь закрыл обращение.")
-            await context.bot.close_forum_topic(SUPPORT_CHAT_ID, ticket["thread_id"])
 
-            # Лог закрытия обращения пользователем
-            await send_log(context, "ticket_closed_by_user", {
-                "user_id": uid_str,
-                "username": username
-            })
+@callback("ul", ACCESS_OWNER)
+async def cb_users_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    res, markup = render_users_page()
+    await update.callback_query.message.reply_text(res, parse_mode="HTML", reply_markup=markup)
 
-            if ticket.get("admin_msg_id"):
-                try:
-                    await context.bot.edit_message_reply_markup(SUPPORT_CHAT_ID, ticket["admin_msg_id"],
-                                                                reply_markup=get_admin_kb(uid_str, True))
-                except:
-                    pass
-        return
 
-    # Закрытие пользователем жалобы
-    if data == "user_close_complaint":
-        complaint = db.data["complaints"].get(uid_str)
-        if complaint and complaint["status"] == "open":
-            db.data["complaints"][uid_str]["status"] = "closed"
-            db.data["active_chats"].pop(uid_str, None)
-            db.save()
+# Каталог пользователей: аргументы — порядок, курсор и префикс username
+@callback("ud", ACCESS_OWNER)
+async def cb_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE, order, cursor="", prefix=""):
+    if order in USER_ORDERS:
+        res, markup = render_users_page(order, cursor or None, prefix or None)
+        await update.callback_query.edit_message_text(res, parse_mode="HTML", reply_markup=markup)
 
-            username = db.data.get("user_metadata", {}).get(uid_str, {}).get("username", "Неизвестно")
 
-            await query.edit_message_text("🔴 Вы закрыли жалобу.")
-            await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=complaint["thread_id"],
-                                           text="⚪️ Пользователь закрыл жалобу.")
-            await context.bot.close_forum_topic(SUPPORT_CHAT_ID, complaint["thread_id"])
+@callback("us", ACCESS_OWNER)
+async def cb_users_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "user_search")
+    await update.callback_query.message.reply_text("🔎 Введите начало username (можно с @):")
 
-            # Лог закрытия жалобы пользователем
-            await send_log(context, "complaint_closed_by_user", {
-                "user_id": uid_str,
-                "username": username
-            })
 
-            if complaint.get("admin_msg_id"):
-                try:
-                    await context.bot.edit_message_reply_markup(SUPPORT_CHAT_ID, complaint["admin_msg_id"],
-                                                                reply_markup=get_admin_kb(uid_str, True,
-                                                                                          is_complaint=True))
-                except:
-                    pass
-        return
+@callback("sm", ACCESS_OWNER)
+async def cb_send_msg(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "msg_target")
+    await update.callback_query.message.reply_text("✉️ Введите ID или @username пользователя для отправки сообщения:")
 
-    # Функции панели агента
-    if data.startswith("agent_"):
-        if uid_str not in db.data.get("agents", {}) and user_id != OWNER_ID:
-            await query.answer("Доступ запрещен.", show_alert=True)
-            return
 
-        if data == "agent_ban_by_id":
-            context.user_data['waiting_ban_id'] = True
-            await query.edit_message_text("Введите ID пользователя для блокировки:")
-        elif data == "agent_unban_by_id":
-            context.user_data['waiting_unban_id'] = True
-            await query.edit_message_text("Введите ID пользователя для разблокировки:")
-        elif data == "agent_view_tickets":
-            context.user_data['waiting_view_tickets_id'] = True
-            await query.edit_message_text("Введите ID пользователя для просмотра его обращений:")
-        elif data == "agent_send_msg":
-            context.user_data['waiting_agent_msg_id'] = True
-            await query.edit_message_text("✉️ Введите ID пользователя для отправки сообщения:")
-        return
+@callback("ar", ACCESS_OWNER)
+async def cb_add_agent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "add_agent")
+    await update.callback_query.message.reply_text("Введите ID или @username агента:")
 
-    # Админские функции
-    if data.startswith("adm_"):
-        if user_id != OWNER_ID: return
 
-        if data == "adm_broadcast":
-            context.user_data['waiting_broadcast'] = True
-            await query.message.reply_text("📣 Введите текст для массовой рассылки всем пользователям:")
-            return
+@callback("ad", ACCESS_OWNER)
+async def cb_remove_agent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(update, context, "remove_agent")
+    await update.callback_query.message.reply_text("Введите ID или @username агента для удаления:")
 
-        if data == "adm_send_msg":
-            context.user_data['waiting_msg_id'] = True
-            await query.message.reply_text("✉️ Введите ID пользователя для отправки сообщения:")
-            return
 
-        if data == "adm_users_list":
-            users = db.data.get("user_metadata", {})
-            res = "👥 <b>Список пользователей:</b>\n\n"
-            for uid, info in list(users.items())[:50]:  # Ограничение 50 для читаемости
-                status = "🔴 (BANNED)" if int(uid) in db.data["banned"] else ""
-                res += f"• <code>{uid}</code> | @{info.get('username')} | Обращений: {info.get('ticket_count')} {status}\n"
-            if len(users) > 50:
-                res += f"\n... и ещё {len(users) - 50} пользователей"
-            await query.message.reply_text(res, parse_mode="HTML")
-        elif data == "adm_request":
-            context.user_data['waiting_agent'] = True
-            await query.message.reply_text("Введите ID агента:")
-        elif data == "adm_remove":
-            context.user_data['waiting_remove_agent'] = True
-            await query.message.reply_text("Введите ID агента для удаления:")
-        elif data == "adm_list":
-            agents = db.data.get("agents", {})
-            if not agents:
-                await query.message.reply_text("📋 Список агентов пуст.")
-            else:
-                res = "🎧 <b>Список агентов:</b>\n\n"
-                for aid, info in agents.items():
-                    username = db.data.get("user_metadata", {}).get(aid, {}).get("username", "Неизвестно")
-                    res += f"• Агент #{info['num']} | <code>{aid}</code> | @{username}\n"
-                    res += f"  └ Ответов: {info.get('replies', 0)} | Банов: {info.get('bans', 0)}\n\n"
-                await query.message.reply_text(res, parse_mode="HTML")
-        elif data == "adm_stats":
-            total_tickets = sum(info.get('ticket_count', 0) for info in db.data.get("user_metadata", {}).values())
-            total_users = len(db.data.get("user_metadata", {}))
-            total_banned = len(db.data.get("banned", []))
-            total_agents = len(db.data.get("agents", {}))
-            total_complaints = len([c for c in db.data.get("complaints", {}).values()])
-
-            res = (
-                f"📊 <b>Статистика системы:</b>\n\n"
-                f"👥 Пользователей: {total_users}\n"
-                f"📩 Обращений создано: {total_tickets}\n"
-                f"⚠️ Жалоб создано: {total_complaints}\n"
-                f"👨‍💻 Агентов: {total_agents}\n"
-                f"🚫 Заблокировано: {total_banned}"
-            )
-            await query.message.reply_text(res, parse_mode="HTML")
-        elif data == "adm_broadcast_logs":
-            logs = db.get_broadcast_logs(10)
-            if not logs:
-                await query.message.reply_text("📜 Логов рассылок пока нет.")
-            else:
-                res = "📜 <b>Последние 10 рассылок:</b>\n\n"
-                for i, log in enumerate(logs, 1):
-                    res += (
-                        f"{i}. <b>{log['timestamp']}</b>\n"
-                        f"   От: @{log['sender_username']} (<code>{log['sender_id']}</code>)\n"
-                        f"   👥 Всего: {log['total_users']} | ✅ {log['success']} | ❌ {log['failed']}\n"
-                        f"   💬 {log['message']}\n\n"
-                    )
-                await query.message.reply_text(res, parse_mode="HTML")
+@callback("al", ACCESS_OWNER)
+async def cb_list_agents(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    agents = db.list_agents()
+    if not agents:
+        await query.message.reply_text("📋 Список агентов пуст.")
+    else:
+        res = "🎧 <b>Список агентов:</b>\n\n"
+        for aid, info in agents:
+            username = db.get_username(aid)
+            res += f"• Агент #{info['num']} | <code>{aid}</code> | @{username}\n"
+            res += f"  └ Ответов: {info.get('replies', 0)} | Банов: {info.get('bans', 0)}\n\n"
+        await query.message.reply_text(res, parse_mode="HTML")
+
+
+@callback("st", ACCESS_OWNER)
+async def cb_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = db.stats()
+
+    def windows(log_type):
+        return " / ".join(str(activity.count(log_type, w)) for w in ActivityCounter.WINDOWS)
+
+    res = (
+        f"📊 <b>Статистика системы:</b>\n\n"
+        f"👥 Пользователей: {stats['users']}\n"
+        f"📩 Обращений создано: {stats['tickets']}\n"
+        f"⚠️ Жалоб создано: {stats['complaints']}\n"
+        f"👨‍💻 Агентов: {stats['agents']}\n"
+        f"🚫 Заблокировано: {stats['banned']}\n\n"
+        f"🟢 Открыто обращений: {stats['open_tickets']}\n"
+        f"🟠 Открыто жалоб: {stats['open_complaints']}\n\n"
+        f"<b>За час / сутки / неделю:</b>\n"
+        f"📩 Обращений: {windows('ticket_created')}\n"
+        f"🔴 Закрыто: {windows('ticket_closed')}\n"
+        f"⚠️ Жалоб: {windows('complaint_created')}\n"
+        f"🚫 Банов: {windows('user_banned')}"
+    )
+    await update.callback_query.message.reply_text(res, parse_mode="HTML")
+
+
+@callback("mt", ACCESS_OWNER)
+async def cb_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    def ms(seconds):
+        return f"{seconds * 1000:.0f} мс"
+
+    # Самые затратные по суммарному времени ветки, методы Bot API — по числу запросов
+    handlers = sorted(metrics.series("support_handler_seconds"), key=lambda item: -item[1].sum)[:10]
+    api_calls = {labels["handler"] + "/" + labels["branch"]: value
+                 for labels, value in metrics.totals("support_handler_api_calls_total")}
+    errors = Counter()
+    for labels, value in metrics.totals("support_bot_api_errors_total"):
+        errors[labels["method"]] += value
+    methods = sorted(metrics.series("support_bot_api_seconds"), key=lambda item: -item[1].count)[:10]
+    saves = metrics.series("support_db_save_seconds")
+    written = sum(value for _, value in metrics.totals("support_db_written_bytes_total"))
+
+    res = "📈 <b>Метрики с запуска</b>\n\n<b>Хендлеры</b> (вызовов · среднее · p95 · запросов к API):\n"
+    for labels, h in handlers:
+        name = labels["handler"] + "/" + labels["branch"]
+        res += (f"<code>{name}</code>: {h.count} · {ms(h.sum / h.count)} · {ms(h.quantile(0.95))} · "
+                f"{api_calls.get(name, 0) / h.count:.1f}\n")
+    res += "\n<b>Bot API</b> (запросов · среднее · ошибок):\n"
+    for labels, h in methods:
+        res += f"<code>{labels['method']}</code>: {h.count} · {ms(h.sum / h.count)} · {errors[labels['method']]}\n"
+    res += "\n<b>Запись базы</b>:\n"
+    for labels, h in saves:
+        res += f"{labels['kind']}: {h.count} · среднее {ms(h.sum / h.count)} · макс. {ms(h.max)}\n"
+    res += f"Записано: {written / 1024 / 1024:.1f} МБ\n\n<b>Очереди</b>:\n"
+    res += "".join(f"<code>{name}</code>: {value}\n" for name, value in sorted(metrics.read_gauges().items()))
+    await update.callback_query.message.reply_text(res, parse_mode="HTML")
+
+
+@callback("pf", ACCESS_OWNER)
+async def cb_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = ("🔬 Профилирование идёт, отчёт придёт документом в чат поддержки." if profiler.active else
+            f"🔬 Профилирование handle_msg и button_handler: выборка стека раз в {PROFILE_INTERVAL_MS} мс.\n"
+            f"Вызовы дольше {SLOW_HANDLER_MS} мс попадут в отчёт вместе с запросами к API.")
+    await update.callback_query.message.reply_text(text, reply_markup=get_profile_kb(profiler.active))
+
+
+@callback("pr", ACCESS_OWNER)
+async def cb_profile_run(update: Update, context: ContextTypes.DEFAULT_TYPE, minutes):
+    query = update.callback_query
+    if profiler.active:
+        await query.message.reply_text("⚠️ Профилирование уже идёт.", reply_markup=get_profile_kb(True))
         return
+    profiler.start([handle_msg, button_handler])
+    context.job_queue.run_once(profile_job, int(minutes) * 60, name="profile")
+    await query.edit_message_text(f"🔬 Профилирование на {minutes} мин запущено.", reply_markup=get_profile_kb(True))
+
 
-    # Проверка, что пользователь - агент или владелец
-    if uid_str not in db.data.get("agents", {}) and user_id != OWNER_ID:
-        await query.answer("Доступ запрещен.", show_alert=True)
+@callback("ps", ACCESS_OWNER)
+async def cb_profile_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    for job in context.job_queue.get_jobs_by_name("profile"):
+        job.schedule_removal()
+    if not profiler.active:
+        await update.callback_query.edit_message_text("🔬 Профилирование не запущено.")
         return
+    await update.callback_query.edit_message_text("🔬 Профилирование остановлено, отправляю отчёт.")
+    await send_profile(context.bot)
 
-    # Действия агентов
-    if data.startswith("take_complaint_"):
-        # Только owner может взять жалобу
-        if user_id != OWNER_ID:
-            await query.answer("Только Owner может взять жалобу!", show_alert=True)
-            return
 
-        target_uid = data.split("_")[2]
-        db.data["active_chats"][target_uid] = {"agent_num": "Owner"}
-        db.save()
+async def profile_job(context: ContextTypes.DEFAULT_TYPE):
+    if profiler.active:
+        await send_profile(context.bot)
 
-        complaint = db.data["complaints"].get(target_uid)
-        thread_id = complaint.get("thread_id") if complaint else None
 
-        await query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, is_complaint=True))
-        await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
-                                       text=f"👨‍💻 Owner взял жалобу на рассмотрение.")
+async def send_profile(bot):
+    report = profiler.stop()
+    try:
+        await bot.send_document(SUPPORT_CHAT_ID, document=report.encode("utf-8"),
+                                filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt",
+                                caption="🔬 Профиль хендлеров")
+    except Exception as e:
+        logger.error(f"Failed to send profile: {e}")
 
-        # Уведомление пользователя
-        try:
-            await context.bot.send_message(
-                int(target_uid),
-                f"👁 Ваша жалоба взята на рассмотрение."
+
+@callback("bl", ACCESS_OWNER)
+async def cb_broadcast_logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    logs = db.get_broadcast_logs(10)
+    if not logs:
+        await query.message.reply_text("📜 Логов рассылок пока нет.")
+    else:
+        res = "📜 <b>Последние 10 рассылок:</b>\n\n"
+        for i, log in enumerate(logs, 1):
+            res += (
+                f"{i}. <b>{log['timestamp']}</b>\n"
+                f"   От: @{log['sender_username']} (<code>{log['sender_id']}</code>)\n"
+                f"   👥 Всего: {log['total_users']} | ✅ {log['success']} | ❌ {log['failed']}\n"
+                f"   💬 {log['message']}\n\n"
             )
-        except Exception as e:
-            logger.info(f"Could not notify user {target_uid} of complaint taken: {e}")
+        await query.message.reply_text(res, parse_mode="HTML")
 
-        # Получаем информацию об owner для логов
-        agent_username = db.data.get("user_metadata", {}).get(str(OWNER_ID), {}).get("username", "Неизвестно")
 
+# --- Действия агентов в теме обращения; user_id в аргументах — base36 ---
+@callback("tc", ACCESS_OWNER, denied="Только Owner может взять жалобу!")
+async def cb_take_complaint(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    query = update.callback_query
+    target_uid = str(int(uid, 36))
+    db.take_chat(target_uid, "Owner")
+
+    complaint = db.get_ticket(target_uid, kind="complaints")
+    thread_id = complaint.get("thread_id") if complaint else None
+
+    # Получаем информацию об owner для логов
+    agent_username = db.get_username(str(OWNER_ID))
+
+    await fan_out(
+        query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, is_complaint=True)),
+        context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
+                                 text=f"👨‍💻 Owner взял жалобу на рассмотрение."),
+        notify_user(context, target_uid, f"👁 Ваша жалоба взята на рассмотрение.", "complaint taken"),
         # Лог взятия жалобы
-        await send_log(context, "complaint_taken", {
+        send_log(context, "complaint_taken", {
             "user_id": target_uid,
             "agent_username": agent_username,
             "agent_id": str(OWNER_ID),
             "thread_id": thread_id
         })
-        return
-
-    # Парсим обычные действия
-    parts = data.split("_")
-    action = parts[0]
-
-    if action == "close":
-        target_uid = parts[1]
-        is_complaint = parts[2] == "1" if len(parts) > 2 else False
-
-        agent_num = db.data["agents"][uid_str]["num"] if uid_str in db.data["agents"] else "Owner"
-
-        if is_complaint:
-            # Закрытие жалобы
-            complaint = db.data["complaints"].get(target_uid)
-            if complaint:
-                db.data["complaints"][target_uid]["status"] = "closed"
-                db.data["active_chats"].pop(target_uid, None)
-                db.save()
-                await query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, True, is_complaint=True))
-                await context.bot.close_forum_topic(SUPPORT_CHAT_ID, complaint["thread_id"])
-                await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=complaint["thread_id"],
-                                               text=f"🔴 Owner закрыл жалобу.")
-
-                # Уведомление пользователя
-                try:
-                    await context.bot.send_message(
-                        int(target_uid),
-                        f"🔴 Ваша жалоба была закрыта."
-                    )
-                except Exception as e:
-                    logger.info(f"Could not notify user {target_uid} of complaint closure: {e}")
+    )
 
-                # Получаем информацию об owner для логов
-                agent_db_id = str(OWNER_ID)
-                agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
 
+@callback("cl", ACCESS_STAFF)
+async def cb_close(update: Update, context: ContextTypes.DEFAULT_TYPE, uid, complaint_flag="0"):
+    query = update.callback_query
+    uid_str = str(query.from_user.id)
+    target_uid = str(int(uid, 36))
+    is_complaint = complaint_flag == "1"
+
+    agent_num = db.get_agent(uid_str)["num"] if db.is_agent(uid_str) else "Owner"
+
+    if is_complaint:
+        # Закрытие жалобы
+        complaint = db.get_ticket(target_uid, kind="complaints")
+        if complaint:
+            db.close_ticket(target_uid, kind="complaints")
+
+            # Получаем информацию об owner для логов
+            agent_db_id = str(OWNER_ID)
+            agent_username = db.get_username(agent_db_id)
+
+            await fan_out(
+                query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, True, is_complaint=True)),
+                # Сообщение в тему — до её закрытия
+                [context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=complaint["thread_id"],
+                                          text=f"🔴 Owner закрыл жалобу."),
+                 context.bot.close_forum_topic(SUPPORT_CHAT_ID, complaint["thread_id"])],
+                notify_user(context, target_uid, f"🔴 Ваша жалоба была закрыта.", "complaint closure"),
                 # Лог закрытия жалобы
-                await send_log(context, "complaint_closed", {
+                send_log(context, "complaint_closed", {
                     "user_id": target_uid,
                     "agent_username": agent_username,
                     "agent_id": agent_db_id
                 })
-        else:
-            # Закрытие обычного обращения
-            ticket = db.data["tickets"].get(target_uid)
-            if ticket:
-                db.data["tickets"][target_uid]["status"] = "closed"
-                db.data["active_chats"].pop(target_uid, None)
-                db.save()
-                await query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, True))
-                await context.bot.close_forum_topic(SUPPORT_CHAT_ID, ticket["thread_id"])
-                await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=ticket["thread_id"],
-                                               text=f"🔴 Агент #{agent_num} закрыл обращение.")
-
-                # Уведомление пользователя о закрытии обращения
-                try:
-                    await context.bot.send_message(
-                        int(target_uid),
-                        f"🔴 Ваше обращение было закрыто агентом #{agent_num}."
-                    )
-                except Exception as e:
-                    logger.info(f"Could not notify user {target_uid} of ticket closure: {e}")
-
-                # Получаем информацию об агенте для логов
-                agent_db_id = uid_str if uid_str in db.data["agents"] else str(OWNER_ID)
-                agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
+            )
+    else:
+        # Закрытие обычного обращения
+        ticket = db.get_ticket(target_uid)
+        if ticket:
+            db.close_ticket(target_uid)
 
+            # Получаем информацию об агенте для логов
+            agent_db_id = uid_str if db.is_agent(uid_str) else str(OWNER_ID)
+            agent_username = db.get_username(agent_db_id)
+
+            await fan_out(
+                query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid, True)),
+                [context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=ticket["thread_id"],
+                                          text=f"🔴 Агент #{agent_num} закрыл обращение."),
+                 context.bot.close_forum_topic(SUPPORT_CHAT_ID, ticket["thread_id"])],
+                notify_user(context, target_uid, f"🔴 Ваше обращение было закрыто агентом #{agent_num}.",
+                            "ticket closure"),
                 # Лог закрытия тикета
-                await send_log(context, "ticket_closed", {
+                send_log(context, "ticket_closed", {
                     "user_id": target_uid,
                     "agent_num": agent_num,
                     "agent_username": agent_username,
                     "agent_id": agent_db_id
                 })
-        return
+            )
 
-    target_uid = parts[1]
-    agent_num = db.data["agents"][uid_str]["num"] if uid_str in db.data["agents"] else "Owner"
 
-    if action == "take":
-        db.data["active_chats"][target_uid] = {"agent_num": agent_num}
-        db.save()
+@callback("tk", ACCESS_STAFF)
+async def cb_take(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    query = update.callback_query
+    uid_str = str(query.from_user.id)
+    target_uid = str(int(uid, 36))
+    agent_num = db.get_agent(uid_str)["num"] if db.is_agent(uid_str) else "Owner"
 
-        ticket = db.data["tickets"].get(target_uid)
-        thread_id = ticket.get("thread_id") if ticket else None
+    db.take_chat(target_uid, agent_num)
 
-        await query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid))
-        await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
-                                       text=f"👨‍💻 Агент #{agent_num} взял обращение.")
+    ticket = db.get_ticket(target_uid)
+    thread_id = ticket.get("thread_id") if ticket else None
 
-        # Уведомление пользователя о взятии обращения
-        try:
-            await context.bot.send_message(
-                int(target_uid),
-                f"👁 Ваше обращение взято на рассмотрение агентом #{agent_num}."
-            )
-        except Exception as e:
-            logger.info(f"Could not notify user {target_uid} of ticket taken: {e}")
-
-        # Получаем информацию об агенте для логов
-        agent_db_id = uid_str if uid_str in db.data["agents"] else str(OWNER_ID)
-        agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
+    # Получаем информацию об агенте для логов
+    agent_db_id = uid_str if db.is_agent(uid_str) else str(OWNER_ID)
+    agent_username = db.get_username(agent_db_id)
 
+    await fan_out(
+        query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid)),
+        context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
+                                 text=f"👨‍💻 Агент #{agent_num} взял обращение."),
+        notify_user(context, target_uid, f"👁 Ваше обращение взято на рассмотрение агентом #{agent_num}.",
+                    "ticket taken"),
         # Лог взятия тикета
-        await send_log(context, "ticket_taken", {
+        send_log(context, "ticket_taken", {
             "user_id": target_uid,
             "agent_num": agent_num,
             "agent_username": agent_username,
             "agent_id": agent_db_id,
             "thread_id": thread_id
         })
+    )
 
-    elif action == "ban":
-        context.user_data.update(
-            {'waiting_ban_reason': True, 'ban_target': target_uid, 'ban_msg_id': query.message.message_id})
-        await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
-                                       text="📝 Введите причину бана:")
-    elif action == "unban":
-        if int(target_uid) in db.data["banned"]:
-            db.data["banned"].remove(int(target_uid))
-            db.data["ban_reasons"].pop(target_uid, None)
-            db.save()
 
-            # Получаем username разблокированного пользователя
-            username = db.data.get("user_metadata", {}).get(target_uid, {}).get("username", "Неизвестно")
+@callback("bn", ACCESS_STAFF)
+async def cb_ban(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    query = update.callback_query
+    set_state(update, context, "ban_reason", target=str(int(uid, 36)), msg_id=query.message.message_id)
+    await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
+                                   text="📝 Введите причину бана:")
 
-            # Получаем информацию об агенте для логов
-            agent_db_id = uid_str if uid_str in db.data["agents"] else str(OWNER_ID)
-            agent_username = db.data.get("user_metadata", {}).get(agent_db_id, {}).get("username", "Неизвестно")
 
-            await query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid))
-            await context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
-                                           text=f"✅ Пользователь разблокирован агентом #{agent_num}.")
+@callback("ub", ACCESS_STAFF)
+async def cb_unban(update: Update, context: ContextTypes.DEFAULT_TYPE, uid):
+    query = update.callback_query
+    uid_str = str(query.from_user.id)
+    target_uid = str(int(uid, 36))
+    agent_num = db.get_agent(uid_str)["num"] if db.is_agent(uid_str) else "Owner"
 
-            # Уведомление пользователя о разбане
-            try:
-                await context.bot.send_message(
-                    int(target_uid),
-                    f"✅ Вы были разблокированы агентом #{agent_num}.\nТеперь вы можете снова обращаться в поддержку."
-                )
-            except Exception as e:
-                logger.info(f"Could not notify user {target_uid} of unban: {e}")
+    if db.is_banned(target_uid):
+        db.unban_user(target_uid)
 
+        # Получаем username разблокированного пользователя
+        username = db.get_username(target_uid)
+
+        # Получаем информацию об агенте для логов
+        agent_db_id = uid_str if db.is_agent(uid_str) else str(OWNER_ID)
+        agent_username = db.get_username(agent_db_id)
+
+        await fan_out(
+            query.message.edit_reply_markup(reply_markup=get_admin_kb(target_uid)),
+            context.bot.send_message(SUPPORT_CHAT_ID, message_thread_id=query.message.message_thread_id,
+                                     text=f"✅ Пользователь разблокирован агентом #{agent_num}."),
+            notify_user(context, target_uid,
+                        f"✅ Вы были разблокированы агентом #{agent_num}.\nТеперь вы можете снова обращаться в поддержку.",
+                        "unban"),
             # Лог разбана
-            await send_log(context, "user_unbanned", {
+            send_log(context, "user_unbanned", {
                 "user_id": target_uid,
                 "username": username,
                 "agent_num": agent_num,
                 "agent_username": agent_username,
                 "agent_id": agent_db_id
             })
+        )
 
 
-def main():
-    app = Application.builder().token(TOKEN).build()
+def register_gauges(app: Application):
+    metrics.gauge("support_update_queue_size", "Updates received but not yet dispatched", app.update_queue.qsize)
+    metrics.gauge("support_updates_in_flight", "Updates being processed",
+                  lambda: app.update_processor.current_concurrent_updates)
+    metrics.gauge("support_log_queue_size", "Log events waiting for LogSink", log_sink.queue.qsize)
+    metrics.gauge("support_db_pending_changes", "DB changes not yet written to disk", lambda: db.at_risk()[0])
+    metrics.gauge("support_ticket_locks", "Users with ticket creation in progress", lambda: len(ticket_locks))
+    metrics.gauge("support_media_groups_pending", "Albums being collected", lambda: len(media_groups.groups))
+    if isinstance(app.bot.rate_limiter, SupportRateLimiter):
+        metrics.gauge("support_rate_limit_waiting", "Requests waiting for a rate limiter token",
+                      app.bot.rate_limiter.waiting)
+
+
+async def on_startup(app: Application):
+    db.start()
+    register_gauges(app)
+    if METRICS_PORT:
+        await metrics.start_server(METRICS_LISTEN, METRICS_PORT)
+    if event_store:
+        await asyncio.to_thread(activity.restore, event_store)
+        event_store.start()
+    log_sink.start(app.bot)
+    # Продолжаем рассылку, прерванную перезапуском
+    job = db.get_broadcast_job()
+    if job and job["state"] == "running":
+        schedule_broadcast(app.job_queue)
+
+
+async def on_stop(app: Application):
+    # Бот ещё доступен: дописываем альбомы и очередь логов до закрытия соединений
+    await media_groups.close()
+    await log_sink.close()
+    if profiler.active:
+        await send_profile(app.bot)
+
+
+async def on_shutdown(app: Application):
+    # Если запуск сорвался после on_startup (webhook не поднялся), on_stop не вызывается: гасим очередь логов здесь
+    await log_sink.close()
+    await metrics.close()
+    await db.close()
+    if event_store:
+        await event_store.close()
+
+
+def add_handlers(app: Application):
     app.add_handler(CommandHandler("admin", admin_command))
     app.add_handler(CommandHandler("panel", panel_command, filters=filters.Chat(chat_id=SUPPORT_CHAT_ID)))
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_msg))
+
+
+def main():
+    # Без секрета апдейты на публичный адрес может прислать кто угодно
+    if WEBHOOK_URL and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET or ""):
+        logger.error("SUPPORT_WEBHOOK_SECRET (1-256 characters A-Z, a-z, 0-9, _ and -) is required with "
+                     "SUPPORT_WEBHOOK_URL")
+        sys.exit(1)
+    builder = (
+        Application.builder().token(TOKEN)
+        .concurrent_updates(KeyedUpdateProcessor(CONCURRENT_UPDATES))
+        .rate_limiter(SupportRateLimiter(RATE_LIMIT_GLOBAL, RATE_LIMIT_PRIVATE, RATE_LIMIT_GROUP_PER_MINUTE,
+                                         RATE_LIMIT_MAX_RETRIES, RATE_LIMIT_SUPPORT_CHAT))
+        .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    )
+    if BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    app = builder.build()
+    add_handlers(app)
+
+    if WEBHOOK_URL and importlib.util.find_spec("tornado"):
+        try:
+            # Loop не закрываем: при ошибке запуска на нём же поднимется polling
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                close_loop=False
+            )
+            return
+        except Exception as e:
+            logger.error(f"Webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT} for {WEBHOOK_URL} failed to start, "
+                         f"falling back to polling: {e!r}")
+    elif WEBHOOK_URL:
+        logger.warning("python-telegram-bot[webhooks] is not installed, falling back to polling")
+    # run_polling сам снимает webhook, оставшийся от прошлого запуска
     app.run_polling()
 
 
 if __name__ == '__main__':
-    main()
+    # python support.py migrate — перенос support_db.json в SQLite
+    if sys.argv[1:2] == ["migrate"]:
+        migrate_json_to_sqlite(DB_FILE, DB_SQLITE_FILE)
+    else:
+        main()
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# support.py читает конфигурацию и открывает базу при импорте: даём ему окружение и пустой рабочий каталог
+os.environ.setdefault("SUPPORT_BOT_TOKEN", "123456:test")
+os.environ.setdefault("SUPPORT_CHAT_ID", "-1001234567890")
+os.environ.setdefault("OWNER_ID", "1")
+os.environ["SUPPORT_EVENTS_FILE"] = ""
+os.environ["SUPPORT_DB_BACKEND"] = "json"
+os.environ["DB_JOURNAL"] = "0"
+for name in ("RATE_LIMIT_GROUP_PER_MINUTE", "RATE_LIMIT_SUPPORT_CHAT"):
+    os.environ.pop(name, None)
+os.chdir(tempfile.mkdtemp(prefix="support-tests-"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
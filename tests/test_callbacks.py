@@ -0,0 +1,44 @@
+import pytest
+
+import support
+
+
+def test_pack_unpack_roundtrip():
+    uid = 8_123_456_789
+    data = support.pack_callback("cl", support.b36(uid), 1)
+    assert data == f"1:cl:{support.b36(uid)}:1"
+    code, args = support.unpack_callback(data)
+    assert code == "cl"
+    assert args == [support.b36(uid), "1"]
+    assert int(args[0], 36) == uid
+
+
+def test_pack_without_args():
+    assert support.unpack_callback(support.pack_callback("st")) == ("st", [])
+
+
+def test_pack_rejects_data_over_telegram_limit():
+    with pytest.raises(ValueError):
+        support.pack_callback("ud", "x" * 64)
+
+
+@pytest.mark.parametrize("legacy, expected", [
+    ("adm_stats", ("st", [])),
+    ("create_complaint", ("cc", [])),
+    ("take_123", ("tk", [support.b36(123)])),
+    ("close_123_1", ("cl", [support.b36(123), "1"])),
+    ("take_complaint_77", ("tc", [support.b36(77)])),
+    ("adm_ud:5:i", ("ud", ["5", "i"])),
+])
+def test_legacy_callbacks(legacy, expected):
+    assert support.unpack_callback(legacy) == expected
+
+
+@pytest.mark.parametrize("data", ["", "garbage", "take_abc", "2:tk:1"])
+def test_unknown_format(data):
+    assert support.unpack_callback(data) == (None, [])
+
+
+def test_every_legacy_code_has_a_handler():
+    codes = {code for code, *_ in support.LEGACY_CALLBACKS.values()} | set(support.LEGACY_USER_ACTIONS.values())
+    assert codes | {"tc", "ud"} <= set(support.CALLBACK_HANDLERS)
@@ -0,0 +1,62 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+
+import support
+
+
+class FakeBot:
+    """Запоминает запросы хендлера к Bot API"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def create_forum_topic(self, chat_id, name):
+        self.calls.append("create_forum_topic")
+        return SimpleNamespace(message_thread_id=100)
+
+    async def send_message(self, chat_id, text=None, **kwargs):
+        self.calls.append("send_message")
+        return SimpleNamespace(message_id=101)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, message_thread_id=None):
+        self.calls.append(("copy_message", message_thread_id))
+
+
+class FakeJobQueue:
+    def get_jobs_by_name(self, name):
+        return []
+
+    def run_once(self, *args, **kwargs):
+        pass
+
+
+def private_update(bot, user_id, message_id):
+    user = User(id=user_id, first_name="u", is_bot=False, username="complainer")
+    message = Message(message_id=message_id, date=datetime.now(), chat=Chat(id=user_id, type=Chat.PRIVATE),
+                      from_user=user, text="жалоба")
+    message.set_bot(bot)
+    return Update(update_id=message_id, message=message)
+
+
+def test_complaint_state_cleared_when_complaint_already_open(monkeypatch):
+    monkeypatch.setattr(support, "db", support.SupportDB("complaints_db.json", flush_interval_ms=0))
+    bot = FakeBot()
+    context = SimpleNamespace(bot=bot, user_data={}, job_queue=FakeJobQueue())
+    uid = 777
+
+    async def scenario():
+        # Первая жалоба создаёт тему, вторая при открытой жалобе только пересылается
+        for message_id in (1, 2):
+            support.set_state(private_update(bot, uid, message_id), context, "complaint")
+            await support.handle_msg(private_update(bot, uid, message_id), context)
+            assert "state" not in context.user_data
+        assert bot.calls.count("create_forum_topic") == 1
+        # Следующее сообщение — обычное обращение, а не продолжение жалобы
+        await support.handle_msg(private_update(bot, uid, 3), context)
+        assert support.db.get_ticket(str(uid)) is not None
+
+    asyncio.run(scenario())
+    assert ("copy_message", 100) in bot.calls
@@ -0,0 +1,99 @@
+import asyncio
+import json
+
+from telegram import User
+
+import support
+
+
+def user(uid, username=None):
+    return User(id=uid, first_name="u", is_bot=False, username=username)
+
+
+def test_snapshot_is_isolated_from_later_changes(tmp_path):
+    path = str(tmp_path / "support_db.json")
+
+    async def scenario():
+        db = support.SupportDB(path, flush_interval_ms=60000, max_pending=1000)
+        db.start()
+        db.register_user(user(1, "one"))
+        db.ban_user(2, "спам", 1)
+        # Снимок фиксируется в event loop, а пишется в потоке уже после новых изменений
+        snapshot = db._freeze()
+        db.register_user(user(3, "three"))
+        db.increment_ticket(1)
+        db.ban_user(4, "флуд", 1)
+        await asyncio.to_thread(db._dump, snapshot)
+        db._owned = None
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        assert set(saved["user_metadata"]) == {"1"}
+        assert saved["user_metadata"]["1"]["ticket_count"] == 0
+        assert sorted(saved["banned"]) == [2]
+        assert db.data["user_metadata"]["1"]["ticket_count"] == 1
+        assert 4 in db.data["banned"]
+        await db.close()
+
+    asyncio.run(scenario())
+    reopened = support.SupportDB(path, flush_interval_ms=0)
+    assert len(reopened.data["user_metadata"]) == 2
+    assert 4 in reopened.data["banned"]
+
+
+def fill_directory(db):
+    for uid in (5, 3, 9, 1, 7, 2):
+        db.register_user(user(uid, {5: "Alpha", 3: "alpine", 9: "alps", 1: "beta"}.get(uid)))
+    for uid in (7, 7, 3, 9, 7, 2):
+        db.increment_ticket(uid)
+    # Смена и удаление username переставляют пользователя в индексе n
+    db.register_user(user(2, "Aleph"))
+    db.register_user(user(1, None))
+
+
+def test_user_index_stays_sorted(tmp_path):
+    db = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill_directory(db)
+    index = {order: list(keys) for order, keys in db.user_index.items()}
+    # Точечные перестановки дают то же, что построение индексов с нуля
+    db._build_indexes()
+    assert index == db.user_index
+    assert [key[-1] for key in index["t"]] == [7, 2, 3, 9, 1, 5]
+    assert [key[-1] for key in index["n"]] == [2, 5, 3, 9]
+
+
+def test_cursor_round_trip(tmp_path):
+    db = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill_directory(db)
+    for number in (0, 35, 36, 10 ** 12):
+        assert int(support.b36(number), 36) == number
+    for order in support.USER_ORDERS:
+        for uid_text, info in db.data["user_metadata"].items():
+            uid = int(uid_text)
+            key = db._user_key(order, uid, info)
+            if key is not None:
+                assert db._cursor_key(order, support.user_cursor(order, uid, info)) == key
+
+
+def test_users_page_prefix(tmp_path):
+    db = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill_directory(db)
+    items, cursor = db.users_page("n", prefix="ALP")
+    assert [uid for uid, _ in items] == ["5", "3", "9"] and cursor is None
+    items, cursor = db.users_page("n", limit=2, prefix="alp")
+    assert [uid for uid, _ in items] == ["5", "3"]
+    assert [uid for uid, _ in db.users_page("n", cursor, limit=2, prefix="alp")[0]] == ["9"]
+    assert db.users_page("n", prefix="z") == ([], None)
+
+
+def test_users_page_last_page_boundary(tmp_path):
+    db = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill_directory(db)
+    # Шесть пользователей ровно на две страницы: у второй курсора нет
+    items, cursor = db.users_page("i", limit=3)
+    assert [uid for uid, _ in items] == ["1", "2", "3"] and cursor is not None
+    items, cursor = db.users_page("i", cursor, limit=3)
+    assert [uid for uid, _ in items] == ["5", "7", "9"] and cursor is None
+    assert db.users_page("i", limit=6)[1] is None
+    items, cursor = db.users_page("t", limit=5)
+    assert cursor is not None
+    assert db.users_page("t", cursor, limit=5) == ([("5", db.get_user(5))], None)
@@ -0,0 +1,42 @@
+import asyncio
+import os
+import threading
+
+import support
+
+
+def test_background_writer_rotates_off_the_loop(tmp_path, monkeypatch):
+    path = str(tmp_path / "events.jsonl")
+    store = support.EventStore(path, max_bytes=2000, backups=3, compress=True)
+    rotated_in = []
+    rotate = store._rotate
+
+    def tracked_rotate():
+        rotated_in.append(threading.current_thread() is threading.main_thread())
+        rotate()
+
+    monkeypatch.setattr(store, "_rotate", tracked_rotate)
+
+    async def scenario():
+        store.start()
+        for n in range(100):
+            store.append("ticket_created", {"user_id": n})
+            if n % 10 == 0:
+                await asyncio.sleep(0.01)
+        await store.close()
+
+    asyncio.run(scenario())
+    assert rotated_in and not any(rotated_in)
+    assert os.path.exists(path + ".1.gz")
+    # Старше backups файлы удалены, остальные события читаются по порядку
+    ids = [record["data"]["user_id"] for record in store.read()]
+    assert ids == list(range(ids[0], 100))
+    assert store.summarize()["ticket_created"] == len(ids)
+
+
+def test_append_without_writer_is_synchronous(tmp_path):
+    path = str(tmp_path / "events.jsonl")
+    store = support.EventStore(path, max_bytes=10 ** 6, backups=1)
+    store.append("user_banned", {"user_id": 1})
+    assert [record["type"] for record in store.read()] == ["user_banned"]
+    asyncio.run(store.close())
@@ -0,0 +1,60 @@
+import os
+
+from telegram import User
+
+import support
+
+
+def make_db(path, compact_every=3):
+    return support.SupportDB(path, flush_interval_ms=0, journal=True, compact_every=compact_every)
+
+
+def test_replay_after_compaction_and_crash(tmp_path, monkeypatch):
+    # Относительное имя, как у DB_FILE
+    monkeypatch.chdir(tmp_path)
+    path = "support_db.json"
+    db = make_db(path)
+    for uid in range(1, 11):
+        db.register_user(User(id=uid, first_name="u", is_bot=False, username=f"user{uid}"))
+    # Компактизация уже прошла, живой сегмент журнала должен остаться на диске
+    assert os.path.exists(db._journal_file.name)
+    # Падение процесса: close() не вызывается, хвост есть только в журнале
+    del db
+
+    reopened = make_db(path)
+    assert reopened.count_users() == 10
+    assert reopened.get_username(10) == "user10"
+
+
+def test_replay_without_snapshot(tmp_path):
+    path = str(tmp_path / "support_db.json")
+    db = make_db(path, compact_every=1000)
+    db.register_user(User(id=7, first_name="u", is_bot=False, username="seven"))
+    del db
+
+    assert not os.path.exists(path)
+    assert make_db(path).get_username(7) == "seven"
+
+
+def test_torn_tail_does_not_swallow_later_records(tmp_path):
+    path = str(tmp_path / "support_db.json")
+    db = make_db(path, compact_every=1000)
+    db.register_user(User(id=1, first_name="u", is_bot=False, username="one"))
+    del db
+    db = make_db(path, compact_every=1000)
+    # Падение посреди записи: в живом сегменте осталась недописанная строка
+    db._journal_file.write('{"s": 2, "op": "se')
+    db._journal_file.flush()
+    torn = db._journal_file.name
+    del db
+
+    db = make_db(path, compact_every=1000)
+    # Новый процесс пишет в тот же сегмент: запись не должна склеиться с обрывком
+    assert db._journal_file.name == torn
+    db.register_user(User(id=2, first_name="u", is_bot=False, username="two"))
+    db.register_user(User(id=3, first_name="u", is_bot=False, username="three"))
+    del db
+
+    reopened = make_db(path, compact_every=1000)
+    assert reopened.count_users() == 3
+    assert reopened.get_username(3) == "three"
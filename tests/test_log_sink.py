@@ -0,0 +1,55 @@
+import asyncio
+
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest
+
+import support
+
+
+class FakeBot:
+    """Отклоняет как Telegram любой текст с незакрытым тегом <x>"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, text, **kwargs):
+        if "<x>" in text:
+            raise BadRequest("Can't parse entities: unclosed start tag")
+        self.sent.append(text)
+
+
+def test_pack_splits_between_whole_events():
+    sink = support.LogSink(0)
+    texts = ["a" * 3000, "<b>" + "b" * 2000 + "</b>", "c" * 10, "d" * 5000]
+    batches = sink.pack(texts)
+    assert batches == [[texts[0]], [texts[1], texts[2]], [texts[3]]]
+    assert [text for batch in batches for text in batch] == texts
+    for batch in batches[:-1]:
+        assert len(sink.SEPARATOR.join(batch)) <= MessageLimit.MAX_TEXT_LENGTH
+
+
+def test_rejected_batch_is_sent_event_by_event():
+    sink = support.LogSink(0)
+    sink.bot = FakeBot()
+    asyncio.run(sink._send_batch(["первое", "<x> сломанное", "третье"]))
+    # Потерялось только событие, которое Telegram не принимает и отдельно
+    assert sink.bot.sent == ["первое", "третье"]
+
+
+def test_user_fields_are_escaped():
+    text = support.render_log("user_banned", {
+        "user_id": 7, "username": "<i>", "agent_num": 1, "agent_username": "a&b", "agent_id": 2,
+        "reason": "спам <b>жирным"})
+    assert "спам &lt;b&gt;жирным" in text
+    assert "@&lt;i&gt;" in text and "@a&amp;b" in text
+    assert "<b>жирным" not in text
+
+
+def test_message_short_is_cut_after_escaping():
+    data = {"agent_num": 1, "agent_username": "a", "agent_id": 2, "user_id": 7, "username": "u",
+            "message": "x" * 97 + "<<"}
+    text = support.render_log("agent_message_sent", data)
+    # 97 символов и &lt; целиком не влезают в 100: сущность не разрывается, а отбрасывается
+    assert f"{'x' * 97}..." in text
+    data["message"] = "<" * 30
+    assert f"{'&lt;' * 25}..." in support.render_log("agent_message_sent", data)
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+from telegram.error import Forbidden
+
+import support
+
+AGENT_ID = 555
+USER_ID = 777
+THREAD_ID = 300
+
+
+class FakeBot:
+    """Запоминает пересылки альбомов; с fail=True Telegram их отклоняет"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.albums = []
+
+    async def copy_messages(self, chat_id, from_chat_id, message_ids, message_thread_id=None):
+        if self.fail:
+            raise Forbidden("bot was blocked by the user")
+        self.albums.append((chat_id, message_ids))
+
+
+def album_part(bot, message_id):
+    agent = User(id=AGENT_ID, first_name="a", is_bot=False, username="agent")
+    message = Message(message_id=message_id, date=datetime.now(), from_user=agent, media_group_id="album",
+                      chat=Chat(id=support.SUPPORT_CHAT_ID, type=Chat.SUPERGROUP, is_forum=True),
+                      message_thread_id=THREAD_ID, is_topic_message=True)
+    message.set_bot(bot)
+    return Update(update_id=message_id, message=message)
+
+
+def relay_album(monkeypatch, bot):
+    db = support.SupportDB("media_groups_db.json", flush_interval_ms=0)
+    db.add_agent(AGENT_ID)
+    db.open_ticket(str(USER_ID), THREAD_ID, 1)
+    monkeypatch.setattr(support, "db", db)
+    monkeypatch.setattr(support, "media_groups", support.MediaGroupBuffer(0.01))
+    context = SimpleNamespace(bot=bot, user_data={})
+
+    async def scenario():
+        for message_id in (11, 12, 13):
+            await support.handle_msg(album_part(bot, message_id), context)
+        await support.media_groups.close()
+
+    asyncio.run(scenario())
+    return db
+
+
+def test_album_counts_as_one_reply(monkeypatch):
+    bot = FakeBot()
+    db = relay_album(monkeypatch, bot)
+    assert bot.albums == [(USER_ID, [11, 12, 13])]
+    assert db.get_agent(AGENT_ID)["replies"] == 1
+
+
+def test_failed_album_is_reported_like_single_message(monkeypatch, caplog):
+    with caplog.at_level(logging.ERROR, logger=support.logger.name):
+        db = relay_album(monkeypatch, FakeBot(fail=True))
+    assert db.get_agent(AGENT_ID)["replies"] == 0
+    assert [record.getMessage() for record in caplog.records] == [
+        f"Failed to forward message to {USER_ID}: bot was blocked by the user"]
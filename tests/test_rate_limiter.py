@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+from telegram.error import NetworkError, TimedOut
+
+import support
+
+real_sleep = asyncio.sleep
+
+
+def limiter():
+    return support.SupportRateLimiter(1000, 1000, 20, max_retries=3, support_chat_rate=1000)
+
+
+def request(limiter, endpoint, error, chat_id=5):
+    calls = []
+
+    async def callback():
+        calls.append(endpoint)
+        if len(calls) == 1:
+            raise error
+        return True
+
+    async def scenario():
+        return await limiter.process_request(callback, (), {}, endpoint, {"chat_id": chat_id}, None)
+
+    return calls, scenario
+
+
+def test_timed_out_send_is_not_retried(monkeypatch):
+    monkeypatch.setattr(asyncio, "sleep", lambda _: real_sleep(0))
+    calls, scenario = request(limiter(), "sendMessage", TimedOut())
+    with pytest.raises(TimedOut):
+        asyncio.run(scenario())
+    assert calls == ["sendMessage"]
+
+
+def test_timed_out_edit_and_network_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(asyncio, "sleep", lambda _: real_sleep(0))
+    calls, scenario = request(limiter(), "editMessageText", TimedOut())
+    assert asyncio.run(scenario()) is True
+    assert len(calls) == 2
+    calls, scenario = request(limiter(), "sendMessage", NetworkError("Bad Gateway"))
+    assert asyncio.run(scenario()) is True
+    assert len(calls) == 2
+
+
+def test_support_chat_has_its_own_bucket():
+    rate_limiter = limiter()
+    assert rate_limiter.chat_bucket(support.SUPPORT_CHAT_ID).rate == 1000
+    assert rate_limiter.chat_bucket(-100777).rate == 20 / 60
+
+
+def test_support_chat_default_follows_group_limit():
+    rate_limiter = support.SupportRateLimiter(1000, 1000, 20, 3, support.RATE_LIMIT_SUPPORT_CHAT)
+    bucket = rate_limiter.chat_bucket(support.SUPPORT_CHAT_ID)
+    assert bucket is not rate_limiter.chat_bucket(-100777)
+    assert bucket.rate == 20 / 60
+
+    async def scenario():
+        # Запас — 20 сообщений сразу, 21-е ждёт токена около трёх секунд
+        for _ in range(20):
+            await asyncio.wait_for(bucket.acquire(support.PRIORITY_STAFF), 0.1)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(bucket.acquire(support.PRIORITY_STAFF), 0.5)
+
+    asyncio.run(scenario())
+
+
+def test_log_queue_drops_oldest():
+    async def scenario():
+        sink = support.LogSink(0, max_size=3)
+        for n in range(5):
+            sink.put("ticket_created", {"n": n})
+        return [sink.queue.get_nowait()[1]["n"] for _ in range(sink.queue.qsize())]
+
+    assert asyncio.run(scenario()) == [2, 3, 4]
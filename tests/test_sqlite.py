@@ -0,0 +1,121 @@
+import asyncio
+
+from telegram import User
+
+import support
+
+
+def user(uid, username=None):
+    return User(id=uid, first_name="u", is_bot=False, username=username)
+
+
+def fill(db):
+    """Одинаковая история изменений для обоих хранилищ"""
+    for uid in range(1, 31):
+        db.register_user(user(uid, f"User{uid}" if uid % 4 else None))
+        for _ in range(uid % 5):
+            db.increment_ticket(uid)
+    for uid in range(1, 11):
+        db.open_ticket(uid, 100 + uid, 500 + uid)
+    for uid in (2, 4, 6):
+        db.close_ticket(uid)
+    db.open_ticket(3, 200, 600, kind="complaints")
+    db.open_ticket(12, 201, 601, kind="complaints")
+    db.close_ticket(12, kind="complaints")
+    for uid in (20, 21, 22):
+        db.ban_user(uid, "спам", 1)
+    db.unban_user(21)
+    db.add_agent(5)
+    db.add_agent_stat(5, "replies")
+    db.take_chat(1, 1)
+
+
+def recount(db):
+    return {name: db._one(sql)[0] for name, sql in db.COUNTERS.items()}
+
+
+def test_migration_matches_json_backend(tmp_path):
+    json_path = str(tmp_path / "support_db.json")
+    sqlite_path = str(tmp_path / "support_db.sqlite3")
+    db = support.SupportDB(json_path, flush_interval_ms=0, journal=True, compact_every=40)
+    fill(db)
+    db.save_broadcast_job({"state": "running", "text": "привет", "cursor": 17, "sent": 3})
+    # Хвост изменений есть только в журнале
+    del db
+    support.migrate_json_to_sqlite(json_path, sqlite_path)
+
+    source = support.SupportDB(json_path, flush_interval_ms=0)
+    target = support.SQLiteSupportDB(sqlite_path)
+    for uid in range(0, 33):
+        for kind in ("tickets", "complaints"):
+            assert target.get_ticket(uid, kind) == source.get_ticket(uid, kind)
+        assert target.is_banned(uid) == source.is_banned(uid)
+        assert target.find_user_id(f"@user{uid}") == source.find_user_id(f"@user{uid}")
+    for thread_id in (101, 102, 103, 110, 111, 200, 201):
+        assert target.find_thread(thread_id) == source.find_thread(thread_id)
+    assert target.find_thread(103) == ("tickets", "3")
+    assert target.find_thread(200) == ("complaints", "3")
+    assert target.find_thread(102) is None and target.find_thread(201) is None
+    assert target.stats() == source.stats()
+    assert target.get_broadcast_job() == source.get_broadcast_job()
+
+
+def test_counters_follow_changes(tmp_path):
+    path = str(tmp_path / "support_db.sqlite3")
+    db = support.SQLiteSupportDB(path)
+    reference = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill(db)
+    fill(reference)
+    assert db.stats() == recount(db) == reference.stats()
+    # Повторное открытие, закрытие и бан уже открытого и забаненного не сбивают счётчики
+    db.open_ticket(1, 101, 501)
+    db.close_ticket(2)
+    db.ban_user(20, "ещё раз", 1)
+    assert db.stats() == recount(db)
+    asyncio.run(db.close())
+    reopened = support.SQLiteSupportDB(path)
+    assert reopened.stats() == recount(reopened)
+    assert reopened.stats()["open_tickets"] == 7
+
+
+def test_users_page_keyset(tmp_path):
+    db = support.SQLiteSupportDB(str(tmp_path / "support_db.sqlite3"))
+    reference = support.SupportDB(str(tmp_path / "support_db.json"), flush_interval_ms=0)
+    fill(db)
+    fill(reference)
+
+    def walk(store, order, prefix=None):
+        pages, cursor = [], None
+        while True:
+            items, cursor = store.users_page(order, cursor, limit=7, prefix=prefix)
+            pages.append(items)
+            if cursor is None:
+                return pages
+
+    for order, prefix in (("i", None), ("t", None), ("n", None), ("n", "user1")):
+        pages = walk(db, order, prefix)
+        assert pages == walk(reference, order, prefix)
+        flat = [uid for page in pages for uid, _ in page]
+        # Границы страниц не теряют и не повторяют пользователей
+        assert len(flat) == len(set(flat))
+        assert all(len(page) == 7 for page in pages[:-1])
+    assert len([uid for page in walk(db, "i") for uid, _ in page]) == 30
+    counts = [info["ticket_count"] for page in walk(db, "t") for _, info in page]
+    assert counts == sorted(counts, reverse=True)
+    assert [uid for page in walk(db, "n", "user1") for uid, _ in page] == ["1", "10", "11", "13", "14", "15",
+                                                                           "17", "18", "19"]
+
+
+def test_broadcast_job_round_trip(tmp_path):
+    path = str(tmp_path / "support_db.sqlite3")
+    db = support.SQLiteSupportDB(path)
+    assert db.get_broadcast_job() is None
+    job = {"state": "running", "text": "привет", "cursor": 42, "sent": 10, "failed": 1}
+    db.save_broadcast_job(job)
+    job["cursor"] = 99
+    assert db.get_broadcast_job()["cursor"] == 42
+    asyncio.run(db.close())
+    reopened = support.SQLiteSupportDB(path)
+    assert reopened.get_broadcast_job() == dict(job, cursor=42)
+    reopened.clear_broadcast_job()
+    assert reopened.get_broadcast_job() is None
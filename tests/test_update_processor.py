@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+import support
+
+
+def private_update(update_id, user_id):
+    user = User(id=user_id, first_name="u", is_bot=False)
+    message = Message(message_id=update_id, date=datetime.now(), chat=Chat(id=user_id, type=Chat.PRIVATE),
+                      from_user=user, text="hi")
+    return Update(update_id=update_id, message=message)
+
+
+def test_busy_key_does_not_block_other_keys():
+    async def scenario():
+        processor = support.KeyedUpdateProcessor(2)
+        release = asyncio.Event()
+        done = []
+
+        async def handler(name, wait=False):
+            if wait:
+                await release.wait()
+            done.append(name)
+
+        # Пачка апдейтов одного пользователя: первый висит, остальные ждут его лока
+        busy = [asyncio.create_task(processor.process_update(private_update(n, 1), handler(f"a{n}", wait=n == 0)))
+                for n in range(5)]
+        await asyncio.sleep(0)
+        other = asyncio.create_task(processor.process_update(private_update(10, 2), handler("b")))
+        await asyncio.wait_for(other, timeout=1)
+        assert done == ["b"]
+        assert processor.current_concurrent_updates == 1
+
+        release.set()
+        await asyncio.gather(*busy)
+        assert done == ["b", "a0", "a1", "a2", "a3", "a4"]
+        assert processor.current_concurrent_updates == 0
+
+    asyncio.run(scenario())
+
+
+def test_concurrency_limit_across_keys():
+    async def scenario():
+        processor = support.KeyedUpdateProcessor(2)
+        release = asyncio.Event()
+        running = []
+
+        async def handler():
+            running.append(processor.current_concurrent_updates)
+            await release.wait()
+
+        tasks = [asyncio.create_task(processor.process_update(private_update(n, n), handler())) for n in range(4)]
+        await asyncio.sleep(0.01)
+        assert processor.current_concurrent_updates == 2
+        release.set()
+        await asyncio.gather(*tasks)
+        assert max(running) == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "bench"))
+from webhook_harness import SUPPORT_PY, StubBotAPI, StubHandler  # noqa: E402
+
+pytest.importorskip("tornado")
+
+
+class PollingStubHandler(StubHandler):
+    """Отдаёт через getUpdates один /start, дальше пустые ответы"""
+
+    def do_POST(self):
+        if not self.path.endswith("/getUpdates"):
+            return super().do_POST()
+        self._params()
+        with self.server.lock:
+            self.server.calls["getUpdates"] += 1
+            first = self.server.calls["getUpdates"] == 1
+        if first:
+            result = [{"update_id": 1, "message": {
+                "message_id": 1, "date": int(time.time()), "text": "/start",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                "chat": {"id": 42, "type": "private", "first_name": "u"},
+                "from": {"id": 42, "is_bot": False, "first_name": "u", "username": "polled"}}}]
+        else:
+            time.sleep(0.2)
+            result = []
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_sqlite_survives_fallback_to_polling(tmp_path):
+    stub = StubBotAPI(free_port())
+    stub.RequestHandlerClass = PollingStubHandler
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    # Порт webhook уже занят: run_webhook падает после on_startup и on_shutdown, бот уходит в polling
+    busy = socket.socket()
+    busy.bind(("127.0.0.1", 0))
+    busy.listen()
+    port = busy.getsockname()[1]
+    env = dict(os.environ, SUPPORT_BOT_TOKEN="123456:stub", SUPPORT_DB_BACKEND="sqlite",
+               SUPPORT_BOT_API_URL=f"http://127.0.0.1:{stub.server_address[1]}",
+               SUPPORT_WEBHOOK_URL=f"http://127.0.0.1:{port}", SUPPORT_WEBHOOK_LISTEN="127.0.0.1",
+               SUPPORT_WEBHOOK_PORT=str(port), SUPPORT_WEBHOOK_SECRET="test-secret")
+    bot = subprocess.Popen([sys.executable, SUPPORT_PY], env=env, cwd=tmp_path,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        deadline = time.monotonic() + 30
+        # Ответ на /start уходит только после register_user в SQLite
+        while not stub.calls["sendMessage"] and bot.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.1)
+    finally:
+        bot.terminate()
+        output = bot.communicate(timeout=30)[0]
+        busy.close()
+        stub.shutdown()
+    assert "falling back to polling" in output
+    assert "ProgrammingError" not in output, output
+    assert stub.calls["sendMessage"], output
+    conn = sqlite3.connect(tmp_path / "support_db.sqlite3")
+    assert conn.execute("SELECT username FROM user_metadata WHERE uid = 42").fetchone() == ("polled",)
+    conn.close()